@@ -452,6 +452,22 @@ HYPERKITTY_DISABLE_SINGLETON_TASKS = False
 # with caution.
 # Default set to 10mins.
 HYPERKITTY_TASK_LOCK_TIMEOUT = 10 * 60
+# Delay the tasks by this number of seconds, to coalesce more identical calls
+# into a single run. The tasks are then run by the Django-Q scheduler.
+# HYPERKITTY_TASK_DEBOUNCE = 30
+# Minimum time between two updates of a list's properties from Mailman when
+# messages are archived, in seconds.
+HYPERKITTY_MAILMAN_SYNC_INTERVAL = 15 * 60
+# Function called with the name and the duration of each archiving stage, for
+# example to send them to a metrics system.
+# HYPERKITTY_TIMING_HOOK = 'mymodule.record_timing'
+# Spool the messages sent by Mailman in this directory and archive them later
+# in batches, instead of archiving them during the request.
+# HYPERKITTY_ARCHIVE_SPOOL = os.path.join(BASE_DIR, 'spool')
+# Keep the cached values in memory in each process for this number of
+# seconds, in front of the shared cache. The changes made by the other
+# processes are seen within a second.
+# HYPERKITTY_LOCAL_CACHE_TIMEOUT = 10
 
 
 try:
@@ -72,6 +72,14 @@ class EmailSerializer(EmailShortSerializer):
         return obj.get_votes()
 
 
+def _with_relations(query):
+    # Load the objects linked to by the serializer with the emails, instead
+    # of querying them for each email.
+    return query.select_related(
+        "mailinglist", "sender", "thread__mailinglist", "parent__mailinglist",
+        ).prefetch_related("children__mailinglist")
+
+
 class EmailList(generics.ListAPIView):
     """List emails"""
 
@@ -90,7 +98,7 @@ class EmailList(generics.ListAPIView):
                 ).order_by("thread_order")
         else:
             query = query.order_by("-archived_date")
-        return query
+        return _with_relations(query)
 
 
 class EmailListBySender(generics.ListAPIView):
@@ -107,7 +115,7 @@ class EmailListBySender(generics.ListAPIView):
             query = query.filter(sender__address=key)
         else:
             query = query.filter(sender__mailman_id=key)
-        return query.order_by("-archived_date")
+        return _with_relations(query.order_by("-archived_date"))
 
 
 class EmailDetail(generics.RetrieveAPIView):
@@ -21,9 +21,11 @@
 
 from django.shortcuts import get_object_or_404
 from django.core.exceptions import PermissionDenied
+from django.db.models import Manager
 from rest_framework import serializers, generics
 
 from hyperkitty.models import Thread, MailingList
+from hyperkitty.models.common import prefetch_cached_values
 from hyperkitty.lib.view_helpers import is_mlist_authorized
 from .utils import (
     MLChildHyperlinkedRelatedField,
@@ -31,6 +33,14 @@ from .utils import (
     )
 
 
+class ThreadListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        threads = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_cached_values(threads, ["subject"])
+        return super(ThreadListSerializer, self).to_representation(threads)
+
+
 class ThreadShortSerializer(serializers.HyperlinkedModelSerializer):
     url = MLChildHyperlinkedRelatedField(
         view_name='hk_api_thread_detail', read_only=True,
@@ -58,6 +68,7 @@ class ThreadShortSerializer(serializers.HyperlinkedModelSerializer):
         fields = ("url", "mailinglist", "thread_id", "subject", "date_active",
                   "starting_email", "emails", "votes_total",
                   "replies_count", "next_thread", "prev_thread")
+        list_serializer_class = ThreadListSerializer
 
     def get_replies_count(self, obj):
         return obj.emails_count - 1
@@ -28,27 +28,77 @@ missing email in the database, in case it was added in the meantime.
 
 This can happen if HK receives the reply before the original message (when a
 mail server in the chain has an issue, or in case of greylisting for example).
+
+Only the orphans or the parents archived since the previous run are looked at:
+the highest email id scanned by that run is stored in the cache. The ids are
+used instead of the archival dates because imported emails keep their
+historical dates.
 """
 
+import logging
+
+from django.core.cache import cache
+from django.db.models import Exists, Max, OuterRef, Q, Subquery
 from django_extensions.management.jobs import BaseJob
 from hyperkitty.models import Email
 
 
+log = logging.getLogger(__name__)
+
+LAST_ID_KEY = "job:orphan_emails:last_id"
+# Emails archived while the job runs may be committed after its query, with a
+# lower id than the ones already visible.
+LAST_ID_MARGIN = 1000
+
+
+def get_orphans(after_id=None, up_to_id=None):
+    """
+    Return the ``(orphan_id, parent_id)`` pairs of the emails that start a
+    thread but have an ``In-Reply-To`` header pointing to an archived email.
+
+    If ``after_id`` is set, only the pairs where the orphan or the parent has
+    a higher id are returned. If ``up_to_id`` is set, the emails with a higher
+    id are ignored.
+    """
+    emails = Email.objects.all()
+    if up_to_id is not None:
+        emails = emails.filter(id__lte=up_to_id)
+    parents = emails.filter(
+        mailinglist_id=OuterRef("mailinglist_id"),
+        message_id=OuterRef("in_reply_to"),
+        ).exclude(
+        # an email with the in-reply-to header pointing to itself, that's
+        # just bogus, ignore it.
+        id=OuterRef("id"))
+    orphans = emails.filter(
+        parent_id__isnull=True, in_reply_to__isnull=False)
+    if after_id is not None:
+        orphans = orphans.annotate(
+            new_parent=Exists(parents.filter(id__gt=after_id))
+            ).filter(Q(id__gt=after_id) | Q(new_parent=True))
+    return orphans.annotate(
+        found_parent_id=Subquery(parents.values("id")[:1])
+        ).filter(found_parent_id__isnull=False).order_by("id").values_list(
+        "id", "found_parent_id")
+
+
 class Job(BaseJob):
     help = "Reattach orphan emails"
     when = "daily"
 
     def execute(self):
-        orphan_starters = Email.objects.filter(
-            parent_id__isnull=True, in_reply_to__isnull=False)
-        for orphan_starter in orphan_starters:
-            parent = Email.objects.filter(
-                mailinglist=orphan_starter.mailinglist,
-                message_id=orphan_starter.in_reply_to).first()
-            if parent is None:
-                continue
-            if orphan_starter.id == parent.id:
-                # an email with the in-reply-to header pointing to itself,
-                # that's just bogus, ignore it.
-                continue
-            orphan_starter.set_parent(parent)
+        last_id = Email.objects.aggregate(last_id=Max("id"))["last_id"]
+        if last_id is None:
+            return
+        after_id = cache.get(LAST_ID_KEY)
+        for orphan_id, parent_id in get_orphans(after_id, last_id):
+            try:
+                # Fetch them now, the previous pairs may have changed their
+                # threads.
+                orphan = Email.objects.get(id=orphan_id)
+                parent = Email.objects.get(id=parent_id)
+                orphan.set_parent(parent)
+            except Exception as e:
+                log.exception("Could not reattach the email %s to %s: %s",
+                              orphan_id, parent_id, e)
+        cache.set(LAST_ID_KEY, max(last_id - LAST_ID_MARGIN, 0), None)
@@ -23,32 +23,232 @@ Analysis of messages or threads of messages
 Author: Aurelien Bompard <abompard@fedoraproject.org>
 """
 
-import networkx as nx
+from itertools import groupby
+
 from django.db import transaction
+from django.db.models import (
+    Case, CharField, F, IntegerField, Max, Q, Value, When)
+from django.utils.http import int_to_base36
+
+
+# Must match the length of the Email.thread_path column.
+THREAD_PATH_MAX_LENGTH = 255
+
+
+def get_thread_path(parent_path, email_id):
+    """
+    Return the materialized path of an email in its thread: the ids of its
+    ancestors and its own, in base 36, each followed by a dot. The replies
+    to an email are the emails whose path starts with that email's path.
+
+    Returns ``None`` if the parent has no path (the thread's starting email
+    must use an empty string), or if the path would be too long to store.
+    """
+    if parent_path is None:
+        return None
+    path = "%s%s." % (parent_path, int_to_base36(email_id))
+    if len(path) > THREAD_PATH_MAX_LENGTH:
+        return None
+    return path
 
 
 def compute_thread_order_and_depth(thread):
+    """
+    Compute the order, depth and path of the emails in a thread. Only the
+    emails whose position changed are updated.
+    """
     # Emails must be saved, there will be DB queries in this function.
-    graph = nx.DiGraph()
-    thread_pos = {"d": 0, "o": 0}  # depth, order
-
-    def walk_successors(msgid):
-        obj = graph.node[msgid]["obj"]
-        obj.thread_depth = thread_pos["d"]
-        obj.thread_order = thread_pos["o"]
-        obj.save(update_fields=["thread_depth", "thread_order"])
-        thread_pos["d"] += 1
-        thread_pos["o"] += 1
-        for succ in sorted(graph.successors(msgid),
-                           key=lambda m: graph.node[m]["num"]):
-            walk_successors(succ)
-        thread_pos["d"] -= 1
-    for index, email in enumerate(thread.emails.order_by("date")):
-        graph.add_node(email.id, num=index, obj=email)
-        if email.parent_id is not None:
-            graph.add_edge(email.parent_id, email.id)
-            if not nx.is_directed_acyclic_graph(graph):
-                # I don't want reply loops in my graph, thank you very much
-                graph.remove_edge(email.parent_id, email.id)
+    from hyperkitty.models.email import Email  # circular import
+    emails = Email.objects.filter(thread_id=thread.id).order_by(
+        "date", "id").values_list(
+        "id", "parent_id", "thread_order", "thread_depth", "thread_path")
+    changed = _get_changed_positions(list(emails), thread.starting_email_id)
+    with transaction.atomic():
+        _update_positions(changed, 500)
+
+
+def get_thread_positions(emails, starting_email_id):
+    """
+    Compute the order and depth of the emails in a thread, in memory.
+
+    :arg emails: an iterable of ``(id, parent_id)`` tuples, ordered by date.
+    :arg starting_email_id: the id of the thread's starting email.
+    :returns: a dict of ``id: (thread_order, thread_depth)``. The emails that
+        can't be reached from the starting email are missing.
+    """
+    children = {}
+    # Union-find structure: an email has a single parent, so linking an
+    # email to a parent of the same tree would create a reply loop.
+    roots = {}
+
+    def _find(email_id):
+        while roots.get(email_id, email_id) != email_id:
+            parent = roots[email_id]
+            roots[email_id] = roots.get(parent, parent)  # path halving
+            email_id = parent
+        return email_id
+    for email_id, parent_id in emails:
+        if parent_id is None:
+            continue
+        email_root = _find(email_id)
+        parent_root = _find(parent_id)
+        if email_root == parent_root:
+            continue  # Reply loop, ignore this link.
+        roots[email_root] = parent_root
+        # The emails are ordered by date, so are the children.
+        children.setdefault(parent_id, []).append(email_id)
+    # Iterative depth-first walk, to handle very deep threads.
+    positions = {}
+    stack = [(starting_email_id, 0)]
+    while stack:
+        email_id, depth = stack.pop()
+        positions[email_id] = (len(positions), depth)
+        stack.extend((child_id, depth + 1) for child_id
+                     in reversed(children.get(email_id, ())))
+    return positions
+
+
+def _get_changed_positions(emails, starting_email_id):
+    # The emails are (id, parent_id, thread_order, thread_depth, thread_path)
+    # tuples. The unreachable emails keep their position but lose their path,
+    # it could be stale.
+    parents = dict(email[:2] for email in emails)
+    positions = get_thread_positions(parents.items(), starting_email_id)
+    paths = {}
+    for email_id in sorted(positions, key=positions.get):
+        if email_id == starting_email_id:
+            paths[email_id] = get_thread_path("", email_id)
+        else:
+            paths[email_id] = get_thread_path(
+                paths[parents[email_id]], email_id)
+    changed = {}
+    for email_id, _parent_id, order, depth, path in emails:
+        if email_id in positions:
+            position = positions[email_id] + (paths[email_id], )
+        else:
+            position = (order, depth, None)
+        if position != (order, depth, path):
+            changed[email_id] = position
+    return changed
+
+
+def _update_positions(positions, batch_size):
+    # Django < 2.2 has no bulk_update(), build the same CASE expressions.
+    from hyperkitty.models.email import Email  # circular import
+    positions = sorted(positions.items())
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        Email.objects.filter(
+            id__in=[email_id for email_id, position in batch]
+        ).update(
+            thread_order=Case(
+                *[When(id=email_id, then=Value(order))
+                  for email_id, (order, depth, path) in batch],
+                output_field=IntegerField()),
+            thread_depth=Case(
+                *[When(id=email_id, then=Value(depth))
+                  for email_id, (order, depth, path) in batch],
+                output_field=IntegerField()),
+            thread_path=Case(
+                *[When(id=email_id, then=Value(path))
+                  for email_id, (order, depth, path) in batch],
+                output_field=CharField()),
+        )
+
+
+def compute_threads_order_and_depth(thread_ids, batch_size=500):
+    """
+    Compute the order, depth and path of the emails in many threads at once.
+
+    The threads are processed by batches of ``batch_size``. The emails of a
+    batch are read with a single query, and only the emails whose position
+    changed are updated, ``batch_size`` rows per query.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    from hyperkitty.models.thread import Thread  # circular import
+    thread_ids = sorted(set(thread_ids))
+    for start in range(0, len(thread_ids), batch_size):
+        batch = thread_ids[start:start + batch_size]
+        starting_emails = dict(Thread.objects.filter(
+            id__in=batch, starting_email__isnull=False
+            ).values_list("id", "starting_email_id"))
+        emails = Email.objects.filter(
+            thread_id__in=starting_emails
+            ).order_by("thread_id", "date", "id").values_list(
+            "thread_id", "id", "parent_id", "thread_order", "thread_depth",
+            "thread_path")
+        changed = {}
+        for thread_id, thread_emails in groupby(
+                emails.iterator(), key=lambda row: row[0]):
+            changed.update(_get_changed_positions(
+                [row[1:] for row in thread_emails],
+                starting_emails[thread_id]))
+        with transaction.atomic():
+            _update_positions(changed, batch_size)
+
+
+def insert_email_position(email, pending_ids=()):
+    """
+    Set the order, depth and path of a new email in its thread, without
+    recomputing the whole thread: the email takes its slot in its parent's
+    replies, and the following emails are shifted.
+
+    Returns ``False`` if the position can't be computed incrementally, for
+    example if the email already has replies or if the thread's positions
+    aren't up-to-date. The whole thread must then be recomputed with
+    :py:func:`compute_thread_order_and_depth`.
+
+    The emails in ``pending_ids`` are new emails that will be inserted
+    afterwards, they are ignored.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    from hyperkitty.models.thread import Thread  # circular import
     with transaction.atomic():
-        walk_successors(thread.starting_email.id)
+        # Serialize the insertions in the same thread.
+        list(Thread.objects.select_for_update().filter(
+            id=email.thread_id).values_list("id"))
+        emails = Email.objects.filter(thread_id=email.thread_id).exclude(
+            id__in=[email.id] + list(pending_ids))
+        if emails.filter(parent_id=email.id).exists() or \
+                emails.filter(thread_order__isnull=True).exists():
+            return False
+        if email.parent_id is None:
+            if emails.exists():
+                return False
+            order, depth = 0, 0
+            path = get_thread_path("", email.id)
+        else:
+            try:
+                parent_order, parent_depth, parent_path = emails.values_list(
+                    "thread_order", "thread_depth", "thread_path").get(
+                    id=email.parent_id)
+            except Email.DoesNotExist:
+                return False
+            if parent_order is None:
+                return False
+            depth = parent_depth + 1
+            path = get_thread_path(parent_path, email.id)
+            # The replies are sorted by date: take the place of the first
+            # reply that is more recent, or go after the parent's subtree.
+            order = emails.filter(
+                Q(date__gt=email.date) | Q(date=email.date, id__gt=email.id),
+                parent_id=email.parent_id,
+                ).order_by("date", "id").values_list(
+                "thread_order", flat=True).first()
+            if order is None:
+                order = emails.filter(
+                    thread_order__gt=parent_order,
+                    thread_depth__lte=parent_depth,
+                    ).order_by("thread_order").values_list(
+                    "thread_order", flat=True).first()
+            if order is None:
+                order = emails.aggregate(
+                    last=Max("thread_order"))["last"] + 1
+            emails.filter(thread_order__gte=order).update(
+                thread_order=F("thread_order") + 1)
+        Email.objects.filter(id=email.id).update(
+            thread_order=order, thread_depth=depth, thread_path=path)
+    email.thread_order = order
+    email.thread_depth = depth
+    email.thread_path = path
+    return True
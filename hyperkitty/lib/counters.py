@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Counters stored in the threads and emails tables.
+
+They are updated with ``F()`` expressions when emails and votes are added or
+removed, and can be recomputed in bulk with :py:func:`update_counters`.
+"""
+
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+
+THREAD_COUNTERS = (
+    "emails_count", "participants_count", "likes", "dislikes", "votes_total")
+EMAIL_COUNTERS = ("likes", "dislikes")
+
+
+def get_vote_changes(old_value, new_value):
+    """
+    Return the changes to the ``likes`` and ``dislikes`` counters when a
+    vote changes from ``old_value`` to ``new_value``. A value of ``None``
+    means that there is no vote.
+    """
+    changes = {"likes": 0, "dislikes": 0}
+    for value, delta in ((old_value, -1), (new_value, 1)):
+        if value == 1:
+            changes["likes"] += delta
+        elif value == -1:
+            changes["dislikes"] += delta
+    return changes
+
+
+def _update_counters(model, fields, counters):
+    # Django < 2.2 has no bulk_update(), build the same CASE expressions.
+    model.objects.filter(id__in=list(counters)).update(**{
+        field: Case(
+            *[When(id=pk, then=Value(values[index]))
+              for pk, values in counters.items()],
+            output_field=IntegerField())
+        for index, field in enumerate(fields)
+    })
+
+
+def update_counters(thread_ids, batch_size=500):
+    """
+    Recompute the counters of the threads and of their emails, in batches of
+    ``batch_size`` threads. Only the rows that were wrong are updated.
+
+    :return: the number of threads and the number of emails that were fixed.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    from hyperkitty.models.thread import Thread
+    from hyperkitty.models.vote import Vote
+    thread_ids = sorted(thread_ids)
+    fixed_threads = fixed_emails = 0
+    for start in range(0, len(thread_ids), batch_size):
+        batch = thread_ids[start:start + batch_size]
+        threads = {thread_id: [0, 0, 0, 0, 0] for thread_id in batch}
+        emails = {}
+        thread_emails = Email.objects.filter(thread_id__in=batch)
+        for thread_id, count in thread_emails.values_list(
+                "thread_id").annotate(count=Count("id")).order_by():
+            threads[thread_id][0] = count
+        for thread_id, _address, _name in thread_emails.values_list(
+                "thread_id", "sender_id", "sender_name").distinct():
+            threads[thread_id][1] += 1
+        votes = Vote.objects.filter(email__thread_id__in=batch).values_list(
+            "email_id", "email__thread_id", "value").annotate(
+            count=Count("id")).order_by()
+        for email_id, thread_id, value, count in votes:
+            if value not in (1, -1):
+                continue
+            index = 0 if value == 1 else 1
+            emails.setdefault(email_id, [0, 0])[index] += count
+            threads[thread_id][2 + index] += count
+        for counters in threads.values():
+            counters[4] = counters[2] - counters[3]
+        changed_threads = {
+            row[0]: threads[row[0]]
+            for row in Thread.objects.filter(id__in=batch).values_list(
+                "id", *THREAD_COUNTERS)
+            if list(row[1:]) != threads[row[0]]
+        }
+        # Only the emails that have votes, or had some.
+        changed_emails = {
+            row[0]: emails.get(row[0], [0, 0])
+            for row in thread_emails.filter(
+                Q(id__in=list(emails)) | ~Q(likes=0) | ~Q(dislikes=0)
+                ).values_list("id", *EMAIL_COUNTERS)
+            if list(row[1:]) != emails.get(row[0], [0, 0])
+        }
+        if changed_threads:
+            _update_counters(Thread, THREAD_COUNTERS, changed_threads)
+        if changed_emails:
+            _update_counters(Email, EMAIL_COUNTERS, changed_emails)
+        fixed_threads += len(changed_threads)
+        fixed_emails += len(changed_emails)
+    return fixed_threads, fixed_emails
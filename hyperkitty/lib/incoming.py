@@ -21,18 +21,22 @@
 #
 
 import re
+from collections import namedtuple, OrderedDict
 from email.message import EmailMessage
+from time import monotonic
 
 from django.conf import settings
-from django.db import DataError
+from django.db import DataError, IntegrityError, transaction
 from django.utils import timezone
 from django_mailman3.lib.scrub import Scrubber
 
+from hyperkitty.lib.timing import timed
 from hyperkitty.lib.utils import (
-    get_ref, parseaddr, parsedate, header_to_unicode, get_message_id)
+    get_ref, parseaddr, parsedate, header_to_unicode, get_message_id,
+    get_message_id_hash, BloomFilter, LRUCache)
 from hyperkitty.models import (
-    MailingList, Sender, Email, Attachment, ArchivePolicy)
-from hyperkitty.tasks import update_from_mailman, sender_mailman_id
+    MailingList, Sender, Email, Attachment, ArchivePolicy, Thread)
+from hyperkitty.tasks import sender_mailman_id
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,6 +44,24 @@ logger = logging.getLogger(__name__)
 
 UNIXFROM_DATE_RE = re.compile(r'^\s*[^\s]+@[^\s]+ (.*)$')
 
+# In-process caches of the mailing-lists and of the sender addresses known to
+# exist in the database, to spare the same lookups on every message. The
+# mailing-lists are only cached for a short time because their properties can
+# be changed by other processes.
+_mailinglists = LRUCache(maxsize=100, timeout=60)
+_senders = LRUCache(maxsize=10000, timeout=60 * 60)
+# Bloom filters of the Message-ID hashes of the emails archived in each
+# mailing-list, to reject the duplicates without parsing them. They use about
+# 10 bits per email. Building one reads all the hashes of the list, once per
+# process and list, then only the emails archived since the last refresh are
+# read, every KNOWN_MESSAGES_REFRESH seconds.
+_known_messages = LRUCache(maxsize=20)
+_KnownMessages = namedtuple(
+    "_KnownMessages", ["bloom", "last_id", "refreshed"])
+KNOWN_MESSAGES_REFRESH = 60
+# Room left in the filters for the new emails.
+KNOWN_MESSAGES_MARGIN = 10000
+
 
 class DuplicateMessage(Exception):
     """
@@ -47,30 +69,285 @@ class DuplicateMessage(Exception):
     """
 
 
+def clear_caches(list_name=None, address=None):
+    """
+    Forget the cached mailing-list or sender address, or everything if no
+    argument is given.
+    """
+    if list_name is None and address is None:
+        _mailinglists.clear()
+        _senders.clear()
+        _known_messages.clear()
+    if list_name is not None:
+        _mailinglists.delete(list_name)
+    if address is not None:
+        _senders.delete(address)
+
+
+def _cache_senders(addresses):
+    # Only cache the senders once they are committed, a rollback would make
+    # the cache lie.
+    def _set():
+        for address in addresses:
+            _senders.set(address, True)
+    transaction.on_commit(_set)
+
+
+def _get_known_messages(list_name):
+    known = _known_messages.get(list_name)
+    now = monotonic()
+    if known is not None and now - known.refreshed < KNOWN_MESSAGES_REFRESH:
+        return known.bloom
+    emails = Email.objects.filter(mailinglist__name=list_name)
+    if known is None or known.bloom.is_full():
+        bloom = BloomFilter(emails.count() + KNOWN_MESSAGES_MARGIN)
+        last_id = 0
+    else:
+        bloom, last_id = known.bloom, known.last_id
+        emails = emails.filter(id__gt=last_id)
+    for email_id, message_id_hash in emails.values_list(
+            "id", "message_id_hash").iterator():
+        bloom.add(message_id_hash)
+        last_id = max(last_id, email_id)
+    _known_messages.set(list_name, _KnownMessages(bloom, last_id, now))
+    return bloom
+
+
+def is_duplicate(list_name, message_id):
+    """
+    Tell if an email with this Message-ID is known to be archived in the
+    mailing-list, without parsing the message. A Bloom filter of the list's
+    emails is built on the first call, and its positive answers are confirmed
+    in the database, as it may give false positives and doesn't know about
+    the deleted emails.
+
+    A negative answer is not authoritative, the email may have been archived
+    by another process: :py:func:`add_to_list` and
+    :py:func:`add_many_to_list` check the database, they don't call this
+    function again.
+    """
+    with timed("dedup_filter"):
+        if get_message_id_hash(message_id) not in _get_known_messages(
+                list_name):
+            return False
+    with timed("dedup_check"):
+        return Email.objects.filter(
+            mailinglist__name=list_name, message_id=message_id).exists()
+
+
+def _remember_messages(list_name, message_id_hashes):
+    # Lists that have not been loaded yet will be read from the database
+    # anyway.
+    def _add():
+        known = _known_messages.get(list_name)
+        if known is not None:
+            known.bloom.update(message_id_hashes)
+    transaction.on_commit(_add)
+
+
+def _get_mailinglist(list_name):
+    mlist = _mailinglists.get(list_name)
+    if mlist is None:
+        mlist = MailingList.objects.get_or_create(name=list_name)[0]
+        if mlist.list_id is None:
+            # Sets the default list_id.
+            mlist.save()
+        # Don't cache a list that could be rolled back.
+        transaction.on_commit(lambda: _mailinglists.set(list_name, mlist))
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        mlist.schedule_mailman_update()
+    return mlist
+
+
 def add_to_list(list_name, message):
     assert isinstance(message, EmailMessage)
-    # timeit("1 start")
-    mlist = MailingList.objects.get_or_create(name=list_name)[0]
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        update_from_mailman.delay(mlist.name)
-    mlist.save()
+    with timed("list_lookup"):
+        mlist = _get_mailinglist(list_name)
     if mlist.archive_policy == ArchivePolicy.never.value:
         logger.info("Archiving disabled by list policy for %s", list_name)
         return
     if "Message-Id" not in message:
         raise ValueError("No 'Message-Id' header in email", message)
-    # timeit("2 after ml, before checking email & sender")
     msg_id = get_message_id(message)
-    if Email.objects.filter(mailinglist=mlist, message_id=msg_id).exists():
+    with timed("dedup_check"):
+        exists = Email.objects.filter(
+            mailinglist=mlist, message_id=msg_id).exists()
+    if exists:
         raise DuplicateMessage(msg_id)
+    with timed("header_parsing"):
+        email, attachments = _make_email(mlist, msg_id, message)
+    _save_email(email, attachments)
+    _remember_messages(list_name, [email.message_id_hash])
+    return email.message_id_hash
+
+
+def add_many_to_list(list_name, messages):
+    """
+    Archive a batch of messages to the same mailing-list.
+
+    This is equivalent to calling :py:func:`add_to_list` on each message in
+    order, but the database work is grouped: the mailing-list is looked up
+    once, senders, threads, emails and attachments are bulk-created, and the
+    parents are looked up with a single query. The thread and mailing-list
+    events (cache rebuilding, thread ordering) are fired once per batch.
+
+    Messages that are rejected do not stop the batch. The return value is a
+    list with, for each message, either its Message-ID hash or the exception
+    that prevented it from being archived (:py:class:`DuplicateMessage` or
+    :py:class:`ValueError`, also used for the database errors).
+    """
+    assert all(isinstance(message, EmailMessage) for message in messages)
+    msg_ids = []
+    for message in messages:
+        if "Message-Id" not in message:
+            msg_ids.append(ValueError(
+                "No 'Message-Id' header in email", message))
+        else:
+            msg_ids.append(get_message_id(message))
+
+    def _parse(index):
+        with timed("header_parsing"):
+            return _parse_email(messages[index])
+    return _add_many(list_name, msg_ids, _parse)
+
+
+ParsedMessage = namedtuple(
+    "ParsedMessage", ["message_id", "fields", "attachments"])
+
+
+def parse_message(message):
+    """
+    Do the archiving work that does not need the database: parsing the
+    headers and scrubbing the content. The returned
+    :py:class:`ParsedMessage` can be pickled, so this work can be done in
+    other processes, and is archived with :py:func:`add_parsed_to_list`.
+
+    Raises :py:class:`ValueError` if the message can't be archived.
+    """
+    assert isinstance(message, EmailMessage)
+    if "Message-Id" not in message:
+        raise ValueError("No 'Message-Id' header in email", message)
+    with timed("header_parsing"):
+        fields, attachments = _parse_email(message)
+    return ParsedMessage(get_message_id(message), fields, attachments)
+
+
+def add_parsed_to_list(list_name, parsed_messages):
+    """
+    Archive a batch of messages returned by :py:func:`parse_message`, like
+    :py:func:`add_many_to_list` does.
+    """
+    assert all(isinstance(parsed, ParsedMessage)
+               for parsed in parsed_messages)
+    return _add_many(
+        list_name, [parsed.message_id for parsed in parsed_messages],
+        lambda index: parsed_messages[index][1:])
+
+
+def _add_many(list_name, messages_ids, parse):
+    # The messages_ids items may be the exception rejecting the message. The
+    # parse function returns the Email fields and the attachments of the
+    # message at the given index.
+    with timed("list_lookup"):
+        mlist = _get_mailinglist(list_name)
+    results = [None] * len(messages_ids)
+    if mlist.archive_policy == ArchivePolicy.never.value:
+        logger.info("Archiving disabled by list policy for %s", list_name)
+        return results
+    # Duplicates, in the database and inside the batch.
+    msg_ids = OrderedDict()
+    for index, msg_id in enumerate(messages_ids):
+        if isinstance(msg_id, Exception):
+            results[index] = msg_id
+            continue
+        if msg_id in msg_ids:
+            results[index] = DuplicateMessage(msg_id)
+            continue
+        msg_ids[msg_id] = index
+    with timed("dedup_check"):
+        existing = set(Email.objects.filter(
+            mailinglist=mlist, message_id__in=msg_ids.keys()
+            ).values_list("message_id", flat=True))
+    emails = []
+    for msg_id, index in msg_ids.items():
+        if msg_id in existing:
+            results[index] = DuplicateMessage(msg_id)
+            continue
+        try:
+            fields, attachments = parse(index)
+        except ValueError as e:
+            results[index] = e
+            continue
+        email = Email(mailinglist=mlist, message_id=msg_id, **fields)
+        emails.append((index, email, attachments))
+    if not emails:
+        return results
+    try:
+        with transaction.atomic():
+            _bulk_save(mlist, emails)
+    except (DataError, IntegrityError) as e:
+        # One of the emails could not be stored, fall back to the regular
+        # path to only reject that one. The instances may have been modified
+        # by the failed attempt, start from fresh copies.
+        logger.info("Could not archive the batch at once (%s), archiving "
+                    "the messages one by one", e)
+        for index, email, attachments in emails:
+            email = Email(**{
+                name: getattr(email, name) for name in _EMAIL_FIELDS})
+            try:
+                with transaction.atomic():
+                    _save_email(email, attachments)
+            except ValueError as e:
+                results[index] = e
+            except (DataError, IntegrityError) as e:
+                results[index] = ValueError(str(e))
+            else:
+                results[index] = email.message_id_hash
+                _remember_messages(list_name, [email.message_id_hash])
+        return results
+    for index, email, attachments in emails:
+        results[index] = email.message_id_hash
+    _remember_messages(
+        list_name, [email.message_id_hash for index, email, att in emails])
+    with timed("signal_handlers"):
+        _on_emails_created(mlist, [email for index, email, att in emails])
+    return results
+
+
+# The fields that _make_email() sets, the mailing-list and the Message-ID
+# are not returned by _parse_email().
+_EMAIL_FIELDS = (
+    "mailinglist", "message_id", "in_reply_to", "archived_date",
+    "sender_name", "sender_id", "subject", "date", "timezone", "content",
+)
+
+
+def _make_email(mlist, msg_id, message):
+    """
+    Build an unsaved :py:class:`Email` instance from a message, and return it
+    along with the scrubbed attachments. The sender is not created, but the
+    ``sender_id`` attribute is set.
+    """
+    fields, attachments = _parse_email(message)
     email = Email(mailinglist=mlist, message_id=msg_id)
-    email.in_reply_to = get_ref(message)  # Find thread id
+    for name, value in fields.items():
+        setattr(email, name, value)
+    return email, attachments
+
+
+def _parse_email(message):
+    """
+    Return the values of the :py:class:`Email` fields for a message, and the
+    scrubbed attachments. The database is not used.
+    """
+    fields = {}
+    fields["in_reply_to"] = get_ref(message)  # Find thread id
     if message.get_unixfrom() is not None:
         mo = UNIXFROM_DATE_RE.match(message.get_unixfrom())
         if mo:
             archived_date = parsedate(mo.group(1))
             if archived_date is not None:
-                email.archived_date = archived_date
+                fields["archived_date"] = archived_date
 
     # Sender
     try:
@@ -88,18 +365,15 @@ def add_to_list(list_name, message):
             sender_address = "{}@example.com".format(sender_address)
         else:
             sender_address = "unknown@example.com"
-    email.sender_name = from_name
-    sender = Sender.objects.get_or_create(address=sender_address)[0]
-    email.sender = sender
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        sender_mailman_id.delay(sender.pk)
-    # timeit("3 after sender, before email content")
+    fields["sender_name"] = from_name
+    fields["sender_id"] = sender_address
 
     # Headers
-    email.subject = header_to_unicode(message.get('Subject'))
-    if email.subject is not None:
+    subject = header_to_unicode(message.get('Subject'))
+    if subject is not None:
         # limit subject size to 512, it's a varchar field
-        email.subject = email.subject[:512]
+        subject = subject[:512]
+    fields["subject"] = subject
     msg_date = parsedate(message.get("Date"))
     if msg_date is None:
         # Absent or unparseable date
@@ -107,19 +381,34 @@ def add_to_list(list_name, message):
     utcoffset = msg_date.utcoffset()
     if msg_date.tzinfo is not None:
         msg_date = msg_date.astimezone(timezone.utc)  # store in UTC
-    email.date = msg_date
+    fields["date"] = msg_date
     if utcoffset is None:
-        email.timezone = 0
+        fields["timezone"] = 0
     else:
         # in minutes
-        email.timezone = int(
+        fields["timezone"] = int(
             ((utcoffset.days * 24 * 60 * 60) + utcoffset.seconds) / 60)
 
     # Content
-    scrubber = Scrubber(message)
-    # warning: scrubbing modifies the msg in-place
-    email.content, attachments = scrubber.scrub()
-    # timeit("4 after email content, before signals")
+    with timed("scrubbing"):
+        scrubber = Scrubber(message)
+        # warning: scrubbing modifies the msg in-place
+        fields["content"], attachments = scrubber.scrub()
+    return fields, attachments
+
+
+def _save_email(email, attachments):
+    """
+    Store an email built by :py:func:`_make_email` in the database, along with
+    its sender and its attachments.
+    """
+    # Sender
+    with timed("sender_resolution"):
+        if not _senders.get(email.sender_id):
+            Sender.objects.get_or_create(address=email.sender_id)
+            _cache_senders([email.sender_id])
+        if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+            sender_mailman_id.delay(email.sender_id)
 
     # TODO: detect category?
 
@@ -134,33 +423,173 @@ def add_to_list(list_name, message):
     # careful with task dependencies if you ever do this.
     # Plus, it has "premature optimization" written all over it.
     if email.in_reply_to is not None:
-        try:
-            ref_msg = Email.objects.get(
-                mailinglist=email.mailinglist,
-                message_id=email.in_reply_to)
-        except Email.DoesNotExist:
-            # the parent may not be archived (on partial imports), create a new
-            # thread for now.
-            pass
-        else:
+        with timed("parent_lookup"):
+            try:
+                ref_msg = Email.objects.get(
+                    mailinglist=email.mailinglist,
+                    message_id=email.in_reply_to)
+            except Email.DoesNotExist:
+                # the parent may not be archived (on partial imports), create
+                # a new thread for now.
+                ref_msg = None
+        if ref_msg is not None:
             # re-use parent's thread-id
             email.parent = ref_msg
             email.thread_id = ref_msg.thread_id
 
-    try:
-        email.save()
-    except DataError as e:
-        raise ValueError(str(e))
+    # The signal handlers are timed separately.
+    with timed("save"):
+        try:
+            email.save()
+        except DataError as e:
+            raise ValueError(str(e))
 
     # Attachments (email must have been saved before)
-    for attachment in attachments:
-        counter, name, content_type, encoding, content = attachment
-        if Attachment.objects.filter(email=email, counter=counter).exists():
-            continue
-        att = Attachment.objects.create(
-            email=email, counter=counter, name=name, content_type=content_type,
-            encoding=encoding)
-        att.set_content(content)
-        att.save()
+    with timed("attachments"):
+        for attachment in attachments:
+            counter, name, content_type, encoding, content = attachment
+            if Attachment.objects.filter(
+                    email=email, counter=counter).exists():
+                continue
+            att = Attachment.objects.create(
+                email=email, counter=counter, name=name,
+                content_type=content_type, encoding=encoding)
+            att.set_content(content)
+            att.save()
 
-    return email.message_id_hash
+
+def _set_ids(model, instances, lookup, **filters):
+    """
+    Set the primary keys on bulk-created instances, on database backends that
+    can't return them from the INSERT statement.
+    """
+    if all(instance.pk is not None for instance in instances):
+        return
+    ids = dict(model.objects.filter(
+        **{"%s__in" % lookup: [getattr(i, lookup) for i in instances]},
+        **filters).values_list(lookup, "pk"))
+    for instance in instances:
+        instance.pk = ids[getattr(instance, lookup)]
+
+
+def _bulk_save(mlist, emails):
+    """
+    Insert the emails and their attachments using as few queries as
+    possible. The emails' signals are not sent, the caller must run
+    :py:func:`_on_emails_created` afterwards.
+    """
+    # Senders
+    with timed("sender_resolution"):
+        addresses = set(email.sender_id for index, email, att in emails)
+        unknown = set(a for a in addresses if not _senders.get(a))
+        if unknown:
+            existing = set(Sender.objects.filter(
+                address__in=unknown).values_list("address", flat=True))
+            Sender.objects.bulk_create([
+                Sender(address=address) for address in unknown - existing])
+            _cache_senders(unknown)
+
+    # Parents. Only previous emails in the batch can be used as parents, as
+    # if the emails had been added one by one. The emails are inserted by
+    # generation, so that the parents have an id when their replies are
+    # inserted.
+    with timed("parent_lookup"):
+        db_parents = {
+            message_id: (parent_id, thread_id)
+            for message_id, parent_id, thread_id in Email.objects.filter(
+                mailinglist=mlist,
+                message_id__in=set(email.in_reply_to for index, email, att
+                                   in emails if email.in_reply_to is not None)
+                ).values_list("message_id", "id", "thread_id")
+        }
+        batch_emails = {}  # message_id -> (email, generation)
+        batch_parents = {}  # message_id -> parent email
+        generations = []
+        starters = []
+        for index, email, attachments in emails:
+            generation = 0
+            if email.in_reply_to in db_parents:
+                email.parent_id, email.thread_id = db_parents[
+                    email.in_reply_to]
+            elif email.in_reply_to in batch_emails:
+                parent, parent_generation = batch_emails[email.in_reply_to]
+                batch_parents[email.message_id] = parent
+                generation = parent_generation + 1
+            else:
+                starters.append(email)
+            batch_emails[email.message_id] = (email, generation)
+            if len(generations) <= generation:
+                generations.append([])
+            generations[generation].append(email)
+
+    # Threads
+    with timed("save"):
+        threads = {
+            thread.thread_id: thread for thread in Thread.objects.filter(
+                mailinglist=mlist,
+                thread_id__in=[email.message_id_hash for email in starters])
+        }
+        if threads and Email.objects.filter(
+                thread__in=threads.values(), parent_id__isnull=True).exists():
+            # Let Email.on_pre_save() complain about the duplicate thread
+            # starter.
+            raise IntegrityError("There can be only one email with "
+                                 "parent_id==None in the same thread")
+        new_threads = [
+            Thread(mailinglist=mlist, thread_id=email.message_id_hash,
+                   date_active=email.date)
+            for email in starters if email.message_id_hash not in threads]
+        Thread.objects.bulk_create(new_threads)
+        _set_ids(Thread, new_threads, "thread_id", mailinglist=mlist)
+        threads.update((thread.thread_id, thread) for thread in new_threads)
+        for email in starters:
+            email.thread = threads[email.message_id_hash]
+        with timed("signal_handlers"):
+            mlist.on_threads_added(new_threads)
+
+        # Emails
+        for generation in generations:
+            for email in generation:
+                if email.message_id in batch_parents:
+                    email.parent = batch_parents[email.message_id]
+                    email.thread_id = email.parent.thread_id
+            Email.objects.bulk_create(generation)
+            _set_ids(Email, generation, "message_id", mailinglist=mlist)
+
+    # Attachments
+    with timed("attachments"):
+        new_attachments = []
+        for index, email, attachments in emails:
+            for counter, name, content_type, encoding, content in attachments:
+                att = Attachment(
+                    email=email, counter=counter, name=name,
+                    content_type=content_type, encoding=encoding)
+                att.set_content(content)
+                new_attachments.append(att)
+        Attachment.objects.bulk_create(new_attachments)
+
+
+def _on_emails_created(mlist, emails):
+    """
+    Run the equivalent of :py:meth:`Email.on_post_created` for bulk-created
+    emails, grouping the work by thread.
+    """
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        for address in set(email.sender_id for email in emails):
+            sender_mailman_id.delay(address)
+    by_thread = OrderedDict()
+    for email in emails:
+        by_thread.setdefault(email.thread_id, []).append(email)
+    for thread in Thread.objects.filter(id__in=by_thread.keys()):
+        thread_emails = by_thread[thread.id]
+        if thread.starting_email_id is None:
+            # Spare Thread.find_starting_email() a query.
+            starters = [e for e in thread_emails if e.parent_id is None]
+            if starters:
+                thread.starting_email = starters[0]
+        thread.on_emails_added(thread_emails)
+    mlist.on_emails_added(emails)
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        from hyperkitty.tasks import check_emails_orphans
+        for email in emails:
+            check_emails_orphans.mark_dirty(email.id)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Fast reading of mbox files.
+
+:py:class:`MboxReader` yields the raw messages of an mbox file without parsing
+them. Plain files are memory-mapped and indexed with a single pass over the
+data, so the number of messages is known before the first one is read.
+Compressed files (``.gz`` and ``.xz``) are read as a stream.
+
+The messages are split like the :py:mod:`mailbox` module does: on the lines
+starting with ``From``, dropping the empty line before the separator.
+"""
+
+import gzip
+import lzma
+import mmap
+import re
+from array import array
+from bisect import bisect_right
+
+
+FROM_LINE_RE = re.compile(br"^From ", re.MULTILINE)
+
+COMPRESSED_OPENERS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+
+class MboxReader:
+    """
+    Iterate over the messages of an mbox file.
+
+    The items are tuples of the unixfrom line (without the ``From`` prefix)
+    and the raw message. For plain files the raw messages are
+    :py:class:`memoryview` slices of the mapped file, they are only valid
+    until the reader is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._opener = None
+        for extension, opener in COMPRESSED_OPENERS.items():
+            if path.endswith(extension):
+                self._opener = opener
+        self._file = None
+        self._mmap = None
+        self._offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        if self._file is not None:
+            return
+        self._file = open(self.path, "rb")
+        try:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self._offsets = array("Q")
+            return
+        if hasattr(self._mmap, "madvise"):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        # The regular expression engine scans the mapped file in C, only the
+        # separators' positions are stored.
+        self._offsets = array(
+            "Q", (mo.start() for mo in FROM_LINE_RE.finditer(self._mmap)))
+
+    def is_compressed(self):
+        return self._opener is not None
+
+    def __len__(self):
+        """
+        The number of messages. Compressed files can't be counted without
+        reading them, a :py:class:`TypeError` is raised for those.
+        """
+        if self.is_compressed():
+            raise TypeError("The messages of a compressed mbox can't be "
+                            "counted in advance")
+        self._open()
+        return len(self._offsets)
+
+    def __iter__(self):
+        for offset, unixfrom, raw_message in self.messages():
+            yield unixfrom, raw_message
+
+    def messages(self, after=None):
+        """
+        Iterate over the messages, with their position in the file.
+
+        The items are tuples of the offset of the message's separator, the
+        unixfrom line and the raw message. If ``after`` is given, only the
+        messages starting after this offset are returned: the importer uses
+        it to resume from a checkpoint.
+        """
+        if self.is_compressed():
+            return self._iter_stream(after)
+        return self._iter_mmap(after)
+
+    def _iter_stream(self, after):
+        unixfrom = None
+        start = None
+        lines = []
+
+        def _get_raw(lines):
+            if lines and lines[-1] == b"\n":
+                lines = lines[:-1]
+            return b"".join(lines)
+        with self._opener(self.path, "rb") as stream:
+            position = 0
+            if after is not None:
+                # Still decompresses the data, but doesn't split it.
+                position = stream.seek(after)
+            for line in stream:
+                if line.startswith(b"From "):
+                    if unixfrom is not None and (
+                            after is None or start > after):
+                        yield start, unixfrom, _get_raw(lines)
+                    start = position
+                    unixfrom = line[5:].rstrip(b"\n").decode(
+                        "ascii", "replace")
+                    lines = []
+                elif unixfrom is not None:
+                    # The data before the first separator is ignored.
+                    lines.append(line)
+                position += len(line)
+        if unixfrom is not None and (after is None or start > after):
+            yield start, unixfrom, _get_raw(lines)
+
+    def _iter_mmap(self, after):
+        self._open()
+        first = 0
+        if after is not None:
+            first = bisect_right(self._offsets, after)
+        if first >= len(self._offsets):
+            return
+        data = memoryview(self._mmap)
+        starts = self._offsets[first:]
+        ends = self._offsets[first + 1:]
+        ends.append(len(self._mmap))
+        for start, end in zip(starts, ends):
+            from_end = self._mmap.find(b"\n", start, end)
+            if from_end == -1:
+                from_end = end  # Separator on the last line.
+            unixfrom = self._mmap[start + 5:from_end].decode(
+                "ascii", "replace")
+            # Like the mailbox module, drop the empty line before the
+            # separator.
+            if end - from_end >= 2 and self._mmap[end - 2:end] == b"\n\n":
+                end -= 1
+            yield start, unixfrom, data[min(from_end + 1, end):end]
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Some messages are still referenced, the mapping will be
+                # closed when they are garbage-collected.
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._offsets = None
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Spool for the messages sent by Mailman.
+
+When the ``HYPERKITTY_ARCHIVE_SPOOL`` setting is set to a directory, the
+archiving API endpoint only stores the incoming messages in this directory,
+and answers Mailman right away. The messages are archived later, in batches,
+by :py:func:`process_spool`.
+
+There is one sub-directory per mailing-list, and one file per message. The
+first line of a file is the message's unixfrom line, which may be empty, and
+the rest is the raw message. Files are written in a temporary directory and
+moved in place once complete, so that a partial file is never processed.
+"""
+
+import os
+import time
+from email import message_from_binary_file
+from email.message import EmailMessage
+from email.policy import default
+from uuid import uuid4
+
+from django.conf import settings
+from lockfile import AlreadyLocked, LockFailed
+from lockfile.pidlockfile import PIDLockFile
+
+from hyperkitty.lib.incoming import add_many_to_list, DuplicateMessage
+from hyperkitty.lib.utils import check_pid
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TMP_DIR = ".tmp"
+FAILED_DIR = ".failed"
+LOCK_FILE = ".lock"
+
+
+def get_spool_dir():
+    return getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL", None)
+
+
+def spool_message(list_name, raw_message, unixfrom=None):
+    """
+    Store a raw message in the spool, to be archived later.
+    """
+    if "/" in list_name or list_name.startswith("."):
+        raise ValueError("Invalid list name: %s" % list_name)
+    spool_dir = get_spool_dir()
+    tmp_dir = os.path.join(spool_dir, TMP_DIR)
+    list_dir = os.path.join(spool_dir, list_name)
+    for folder in (tmp_dir, list_dir):
+        os.makedirs(folder, exist_ok=True)
+    # The file names sort in the arrival order.
+    filename = "%.6f-%s.msg" % (time.time(), uuid4().hex)
+    tmp_path = os.path.join(tmp_dir, filename)
+    if unixfrom:
+        unixfrom = " ".join(unixfrom.splitlines())
+    with open(tmp_path, "wb") as f:
+        f.write((unixfrom or "").encode("ascii", "replace") + b"\n")
+        f.write(raw_message)
+    os.rename(tmp_path, os.path.join(list_dir, filename))
+
+
+def _read_message(path):
+    with open(path, "rb") as f:
+        unixfrom = f.readline().rstrip(b"\r\n").decode("ascii")
+        if not f.peek(1):
+            return None
+        msg = message_from_binary_file(
+            f, _class=EmailMessage, policy=default)
+    if unixfrom:
+        msg.set_unixfrom(unixfrom)
+    return msg
+
+
+def _set_failed(list_name, path):
+    failed_dir = os.path.join(get_spool_dir(), FAILED_DIR, list_name)
+    os.makedirs(failed_dir, exist_ok=True)
+    os.rename(path, os.path.join(failed_dir, os.path.basename(path)))
+
+
+def _process_list(list_name, list_dir, batch_size):
+    filenames = sorted(
+        f for f in os.listdir(list_dir) if not f.startswith("."))
+    count = 0
+    for start in range(0, len(filenames), batch_size):
+        paths = []
+        messages = []
+        for filename in filenames[start:start + batch_size]:
+            path = os.path.join(list_dir, filename)
+            msg = _read_message(path)
+            if msg is None:
+                logger.warning("Empty spooled email: %s", path)
+                _set_failed(list_name, path)
+                continue
+            paths.append(path)
+            messages.append(msg)
+        results = add_many_to_list(list_name, messages)
+        for path, msg, result in zip(paths, messages, results):
+            if isinstance(result, ValueError):
+                logger.warning(
+                    "Could not archive the spooled email %s with message-id "
+                    "'%s': %s", path, msg.get("Message-Id", None), result)
+                _set_failed(list_name, path)
+                continue
+            if isinstance(result, DuplicateMessage):
+                logger.info("Duplicate email with message-id '%s'",
+                            result.args[0])
+            os.remove(path)
+            count += 1
+    return count
+
+
+def process_spool(batch_size=100):
+    """
+    Archive the spooled messages, in batches of ``batch_size`` messages.
+
+    The messages that can't be archived are moved to the ``.failed``
+    sub-directory. Returns the number of processed messages.
+    """
+    spool_dir = get_spool_dir()
+    if spool_dir is None or not os.path.isdir(spool_dir):
+        return 0
+    lock = PIDLockFile(os.path.join(spool_dir, LOCK_FILE))
+    try:
+        lock.acquire(timeout=-1)
+    except AlreadyLocked:
+        if check_pid(lock.read_pid()):
+            logger.debug("The spool is already being processed")
+            return 0
+        else:
+            lock.break_lock()
+            lock.acquire(timeout=-1)
+    except LockFailed as e:
+        logger.warning("Could not obtain a lock on the spool (%s)", e)
+        return 0
+    count = 0
+    try:
+        for list_name in sorted(os.listdir(spool_dir)):
+            list_dir = os.path.join(spool_dir, list_name)
+            if list_name.startswith(".") or not os.path.isdir(list_dir):
+                continue
+            count += _process_list(list_name, list_dir, batch_size)
+    finally:
+        lock.release()
+    return count
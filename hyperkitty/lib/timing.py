@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Timing of the archiving stages.
+
+The code to time is wrapped in the :py:func:`timed` context manager. The
+durations are aggregated in per-stage histograms, logged at the DEBUG level
+in the ``hyperkitty.lib.timing`` logger, and sent to the metrics hooks: the
+callable referenced by the ``HYPERKITTY_TIMING_HOOK`` setting (a dotted path)
+and the ones registered with :py:func:`add_hook`. Hooks are called with the
+stage name and the duration in seconds.
+
+Stages can be nested: the duration recorded for a stage excludes the time
+spent in the stages it contains, so that the durations add up.
+"""
+
+import importlib
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+#: Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Histogram:
+    """
+    Distribution of the durations of a stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # The last bucket is for the durations above all the bounds.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        for index, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in BUCKETS] + ["+Inf"]
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "buckets": dict(zip(bounds, self.buckets)),
+        }
+
+
+_histograms = {}
+_lock = threading.Lock()
+_local = threading.local()
+_hooks = []
+
+
+def add_hook(hook):
+    """Call ``hook(stage, duration)`` for every timed stage."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _get_setting_hook():
+    path = getattr(settings, "HYPERKITTY_TIMING_HOOK", None)
+    if not path:
+        return None
+    if callable(path):
+        return path
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def record(stage, duration):
+    """Record the duration of a stage, in seconds."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.add(duration)
+    logger.debug("%s: %.6fs", stage, duration)
+    hooks = list(_hooks)
+    setting_hook = _get_setting_hook()
+    if setting_hook is not None:
+        hooks.append(setting_hook)
+    for hook in hooks:
+        try:
+            hook(stage, duration)
+        except Exception as e:
+            logger.exception("Timing hook %r failed: %s", hook, e)
+
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block as ``stage``."""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    # Each frame holds the time spent in the nested stages.
+    stack.append(0.0)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        duration = perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += duration
+        record(stage, duration - nested)
+
+
+def get_timings():
+    """
+    Return the histograms of all the stages recorded since the start of the
+    process (or the last :py:func:`reset`), as dicts indexed by stage name.
+    """
+    with _lock:
+        return {stage: histogram.as_dict()
+                for stage, histogram in _histograms.items()}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def format_summary():
+    """
+    Return a line for each stage with its total and mean durations, slowest
+    first.
+    """
+    timings = get_timings()
+    return [
+        "%s: %d calls, %.3fs total, %.6fs mean" % (
+            stage, timing["count"], timing["total"], timing["mean"])
+        for stage, timing in sorted(
+            timings.items(), key=lambda item: item[1]["total"],
+            reverse=True)
+        ]
+
+
+def log_summary(level=logging.INFO):
+    for line in format_summary():
+        logger.log(level, line)
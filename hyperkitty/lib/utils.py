@@ -27,12 +27,15 @@ import os
 import os.path
 import re
 from base64 import b32encode
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import timedelta
 from email.parser import BytesHeaderParser, HeaderParser
 from email.policy import default
 from hashlib import sha1
 from tempfile import gettempdir
+from threading import Lock
+from time import monotonic
 
 import dateutil.parser
 import dateutil.tz
@@ -110,13 +113,30 @@ def parseaddr(address):
     return from_name, from_email
 
 
+# Dates in the strict RFC 2822 format, that the standard library can parse
+# faster than dateutil, with the same result. Anything else is left to
+# dateutil.
+RFC2822_DATE_RE = re.compile(
+    r"^(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), *)?"
+    r"\d{1,2} +(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +"
+    r"[12]\d{3} +\d{2}:\d{2}:\d{2} +[+-]\d{4}$", re.ASCII)
+
+
 def parsedate(datestring):
     if datestring is None:
         return None
-    try:
-        parsed = dateutil.parser.parse(datestring)
-    except ValueError:
-        return None
+    parsed = None
+    datestring = str(datestring)
+    if RFC2822_DATE_RE.match(datestring):
+        try:
+            parsed = email.utils.parsedate_to_datetime(datestring)
+        except (TypeError, ValueError, OverflowError):
+            pass  # Let dateutil decide
+    if parsed is None:
+        try:
+            parsed = dateutil.parser.parse(datestring)
+        except ValueError:
+            return None
     try:
         offset = parsed.utcoffset()
     except ValueError:
@@ -135,8 +155,13 @@ def header_to_unicode(header):
     if header is None:
         header = str(header)
     if isinstance(header, str):
+        if _is_plain_header(header):
+            # Nothing to decode, do what the parser would do.
+            return header.lstrip(" \t")
         msg = HeaderParser(policy=default).parsestr('dummy: ' + header)
     elif isinstance(header, bytes):
+        if _is_plain_header(header):
+            return header.decode("ascii").lstrip(" \t")
         msg = BytesHeaderParser(policy=default).parsebytes(b'dummy: ' + header)
     else:
         raise ValueError('header must be str or bytes, but is ' + type(header))
@@ -144,6 +169,47 @@ def header_to_unicode(header):
     return msg['dummy']
 
 
+def _is_plain_header(header):
+    """
+    Headers in printable ASCII without encoded words don't need the email
+    parser.
+    """
+    if isinstance(header, bytes):
+        return PLAIN_HEADER_BYTES_RE.match(header) is not None
+    return PLAIN_HEADER_RE.match(header) is not None
+
+
+PLAIN_HEADER_RE = re.compile(r"^(?:[ \t!-<>-~]|=(?!\?))*$")
+PLAIN_HEADER_BYTES_RE = re.compile(br"^(?:[ \t!-<>-~]|=(?!\?))*$")
+
+
+def split_mbox(mbox_file):
+    """
+    Split an mbox file (or any iterable of lines as bytes) into messages.
+
+    Yields tuples of the unixfrom line (without the ``From`` prefix, or None)
+    and the raw message as bytes.
+    """
+    unixfrom = None
+    lines = []
+
+    def _get_raw(lines):
+        # Like the mailbox module, drop the empty line before the separator.
+        if lines and not lines[-1].strip():
+            lines = lines[:-1]
+        return b"".join(lines)
+    for line in mbox_file:
+        if line.startswith(b"From "):
+            if lines:
+                yield unixfrom, _get_raw(lines)
+            unixfrom = line[5:].decode("ascii", "replace").rstrip()
+            lines = []
+        else:
+            lines.append(line)
+    if lines:
+        yield unixfrom, _get_raw(lines)
+
+
 def stripped_subject(mlist, subject):
     if mlist is None:
         return subject
@@ -211,16 +277,92 @@ def pgsql_disable_indexscan():
             cursor.execute("SET enable_indexscan = ON")
 
 
-# import time
-# from collections import defaultdict
-# LASTTIME = None
-# TIMES = defaultdict(list)
-#
-# def timeit(name):
-#     global LASTTIME
-#     now = time.time()
-#     if LASTTIME is not None:
-#         spent = now - LASTTIME
-#         TIMES[name].append(spent)
-#         print("{}: {}".format(name, spent))
-#     LASTTIME = now
+class LRUCache:
+    """
+    A small in-process cache, bounded to ``maxsize`` entries, that evicts the
+    least recently used entries first. Entries older than ``timeout`` seconds
+    are ignored. It is safe to use from several threads.
+    """
+
+    def __init__(self, maxsize, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.timeout is not None:
+            expires = monotonic() + self.timeout
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self):
+        now = monotonic()
+        with self._lock:
+            return [value for value, expires in self._data.values()
+                    if expires is None or expires >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BloomFilter:
+    """
+    A set of strings with a fixed memory usage of ``bits_per_item`` bits per
+    item, for up to ``capacity`` items. Membership tests may give false
+    positives, but no false negatives. Items can't be removed.
+    """
+
+    def __init__(self, capacity, bits_per_item=10, hashes=7):
+        self.capacity = max(capacity, 1)
+        self.size = self.capacity * bits_per_item
+        self.hashes = hashes
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = int.from_bytes(
+            sha1(item.encode("utf-8")).digest()[:16], "big")
+        first, step = digest & 0xffffffffffffffff, (digest >> 64) | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def is_full(self):
+        """Tell if the false positive rate is above the expected one."""
+        return self.count > self.capacity
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
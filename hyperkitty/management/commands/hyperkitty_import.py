@@ -23,12 +23,15 @@
 Import the content of a mbox file into the database.
 """
 
-import mailbox
+import json
+import multiprocessing
 import os
 import re
 from datetime import datetime
 from email.utils import make_msgid, unquote
 from email import message_from_bytes, policy
+from email.parser import BytesHeaderParser
+from itertools import islice
 from traceback import print_exc
 from math import floor
 
@@ -40,12 +43,17 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction, Error as DatabaseError
 from django.utils.timezone import utc
 
-from hyperkitty.lib.incoming import add_to_list, DuplicateMessage
+from hyperkitty.lib.incoming import (
+    add_to_list, add_parsed_to_list, is_duplicate, parse_message,
+    DuplicateMessage)
+from hyperkitty.lib.timing import format_summary
 from hyperkitty.lib.mailman import sync_with_mailman
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.mbox import MboxReader
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
+from hyperkitty.lib.counters import update_counters
 from hyperkitty.lib.utils import get_message_id
 from hyperkitty.management.utils import setup_logging
-from hyperkitty.models import Email, Thread
+from hyperkitty.models import Email
 
 
 TEXTWRAP_RE = re.compile(r"\n\s*")
@@ -87,16 +95,73 @@ class ProgressMarker(object):
             self.stdout.flush()
 
 
+class ImportCheckpoint(object):
+    """
+    The progress of an import, saved in a JSON file to resume the import if it
+    is interrupted. The ids of the threads to compute are appended to a
+    separate file, as they are only known to grow.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.threads_path = path + ".threads"
+        self.state = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path) as checkpoint_file:
+            self.state = json.load(checkpoint_file)
+        return self.state
+
+    def save(self, **values):
+        self.state.update(values)
+        # Never leave a partially written file.
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(self.state, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def add_thread_ids(self, thread_ids):
+        with open(self.threads_path, "a") as threads_file:
+            threads_file.writelines(
+                "%d\n" % thread_id for thread_id in sorted(thread_ids))
+
+    def load_thread_ids(self):
+        if not os.path.exists(self.threads_path):
+            return set()
+        with open(self.threads_path) as threads_file:
+            # Ignore a partially written last line.
+            return set(int(line) for line in threads_file
+                       if line.endswith("\n"))
+
+    def delete(self):
+        for path in (self.path, self.threads_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 class DbImporter(object):
     """
     Import email messages into the HyperKitty database using its API.
     """
 
+    # Number of messages stored at once by the parallel import.
+    BATCH_SIZE = 100
+
     def __init__(self, list_address, options, stdout, stderr):
         self.list_address = list_address
         self.verbose = options["verbosity"] >= 2
         self.since = options.get("since")
+        self.jobs = options.get("jobs") or 1
         self.impacted_thread_ids = set()
+        # The impacted threads not written in the checkpoint yet.
+        self._unsaved_thread_ids = set()
+        self.checkpoint = None
+        self.checkpoint_every = options.get("checkpoint_every") or 0
+        self.commit_every = options.get("commit_every") or 1
+        self._unsaved = 0
         self.stdout = stdout
         self.stderr = stderr
 
@@ -134,87 +199,302 @@ class DbImporter(object):
             return None
         return date
 
-    def from_mbox(self, mbfile):
+    def _get_duplicate_id(self, msg_raw):
+        # Reject the emails that are already archived before they are parsed
+        # and scrubbed, only their headers are read. Returns the Message-ID
+        # of a duplicate.
+        headers_end = msg_raw.find(b"\n\n")
+        if headers_end == -1:
+            headers_end = len(msg_raw)
+        headers = BytesHeaderParser().parsebytes(msg_raw[:headers_end])
+        if not isinstance(headers["Message-Id"], str):
+            return None
+        msg_id = get_message_id(headers)
+        try:
+            if is_duplicate(self.list_address, msg_id):
+                return msg_id
+        except UnicodeError:
+            pass
+        return None
+
+    def _fix_message(self, msg_raw, unixfrom):
+        # Parse the message and fix its headers. Returns None if the message
+        # is too old to be imported.
+        message = message_from_bytes(msg_raw, policy=policy.default)
+        # Fix missing and wierd Date: headers.
+        date = (self._get_date(message, "date") or
+                self._get_date(message, "resent-date"))
+        if unixfrom and not date:
+            date = " ".join(unixfrom.split()[1:])
+        if date:
+            try:
+                message.replace_header('date', date)
+            except KeyError:
+                message['Date'] = date
+        if self._is_too_old(message):
+            return None
+        # Un-wrap the subject line if necessary
+        if message["subject"]:
+            message.replace_header(
+                "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
+        if unixfrom:
+            message.set_unixfrom(unixfrom)
+        if message['message-id'] is None:
+            message['Message-ID'] = make_msgid('generated')
+        return message
+
+    def _get_error_lines(self, message, error):
+        lines = ["Failed adding message %s: %s"
+                 % (message.get("Message-ID"), error)]
+        if len(error.args) == 2:
+            try:
+                lines.append(
+                    "%s from %s about %s"
+                    % (error.args[0], error.args[1].get("From"),
+                       error.args[1].get("Subject")))
+            except UnicodeDecodeError:
+                pass
+        return lines
+
+    def add_impacted_threads(self, thread_ids):
+        thread_ids = set(thread_ids) - self.impacted_thread_ids
+        self.impacted_thread_ids.update(thread_ids)
+        self._unsaved_thread_ids.update(thread_ids)
+
+    def save_checkpoint(self, **values):
+        if self.checkpoint is None:
+            return
+        try:
+            # The threads must be saved before the progress that covers them.
+            self.checkpoint.add_thread_ids(self._unsaved_thread_ids)
+            self._unsaved_thread_ids = set()
+            self.checkpoint.save(**values)
+        except OSError as e:
+            self.stderr.write(
+                "Could not save the checkpoint, the import will not be "
+                "resumable: %s" % e)
+            self.checkpoint = None
+        self._unsaved = 0
+
+    def _message_done(self, mbfile, offset, msg_id, progress_marker,
+                      count=1):
+        # Save a checkpoint every checkpoint_every messages. The messages
+        # before the offset must have been committed.
+        self._unsaved += count
+        if self.checkpoint_every and self._unsaved >= self.checkpoint_every:
+            self.save_checkpoint(
+                path=mbfile, offset=offset, count=progress_marker.count,
+                message_id=msg_id)
+
+    def from_mbox(self, mbfile, after=None, count=0):
         """
         Insert all the emails contained in an mbox file into the database.
 
         :arg mbfile: a mailbox file
+        :arg after: only import the messages after this offset in the file,
+            to resume an import from a checkpoint
+        :arg count: the number of messages before this offset
         """
-        mbox = mailbox.mbox(mbfile)
         progress_marker = ProgressMarker(self.verbose, self.stdout)
-        if not self.since:
-            progress_marker.total = len(mbox)
-        for msg in mbox:
-            # FIXME: this converts mailbox.mboxMessage to
-            # email.message.EmailMessage
-            msg_raw = msg.as_bytes(unixfrom=False)
-            unixfrom = msg.get_from()
-            message = message_from_bytes(msg_raw, policy=policy.default)
-            # Fix missing and wierd Date: headers.
-            date = (self._get_date(message, "date") or
-                    self._get_date(message, "resent-date"))
-            if unixfrom and not date:
-                date = " ".join(unixfrom.split()[1:])
-            if date:
-                try:
-                    message.replace_header('date', date)
-                except KeyError:
-                    message['Date'] = date
-            if self._is_too_old(message):
-                continue
-            progress_marker.tick(message["Message-Id"])
-            # Un-wrap the subject line if necessary
-            if message["subject"]:
-                message.replace_header(
-                    "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
-            if unixfrom:
-                message.set_unixfrom(unixfrom)
-            if message['message-id'] is None:
-                message['Message-ID'] = make_msgid('generated')
-            # Now insert the message
+        progress_marker.count = count
+        with MboxReader(mbfile) as mbox:
+            if not self.since and not mbox.is_compressed():
+                progress_marker.total = len(mbox)
+            messages = mbox.messages(after)
+            if self.jobs > 1:
+                self._from_mbox_parallel(mbfile, messages, progress_marker)
+            else:
+                self._from_mbox_serial(mbfile, messages, progress_marker)
+        # self.store.search_index.flush() # Now commit to the search index
+        progress_marker.finish()
+
+    def _from_mbox_serial(self, mbfile, messages, progress_marker):
+        # Group the messages in transactions of commit_every messages. Each
+        # message is added in a savepoint, a failure only rolls back that
+        # message.
+        while True:
+            group = list(islice(messages, self.commit_every))
+            if not group:
+                break
+            with transaction.atomic():
+                for offset, unixfrom, msg_raw in group:
+                    msg_id = self._import_message(
+                        unixfrom, bytes(msg_raw), progress_marker)
+            # The checkpoint must only cover committed messages.
+            self._message_done(
+                mbfile, offset, msg_id, progress_marker, len(group))
+
+    def _is_known_duplicate(self, msg_raw, progress_marker):
+        # Returns the Message-ID of the message if it is already archived.
+        duplicate_id = self._get_duplicate_id(msg_raw)
+        if duplicate_id is not None:
+            progress_marker.tick(duplicate_id)
+            if self.verbose:
+                self.stderr.write(
+                    "Duplicate email with message-id '%s'" % duplicate_id)
+        return duplicate_id
+
+    def _import_message(self, unixfrom, msg_raw, progress_marker):
+        # Returns the Message-ID of the message, or None if it is too old.
+        duplicate_id = self._is_known_duplicate(msg_raw, progress_marker)
+        if duplicate_id is not None:
+            return duplicate_id
+        message = self._fix_message(msg_raw, unixfrom)
+        if message is None:
+            return None
+        msg_id = str(message["Message-Id"])
+        progress_marker.tick(message["Message-Id"])
+        # Now insert the message
+        try:
+            with transaction.atomic():
+                add_to_list(self.list_address, message)
+        except DuplicateMessage as e:
+            if self.verbose:
+                self.stderr.write(
+                    "Duplicate email with message-id '%s'" % e.args[0])
+            return msg_id
+        except (LookupError, UnicodeError, ValueError) as e:
+            for line in self._get_error_lines(message, e):
+                self.stderr.write(line)
+            # Don't reraise the exception
+            return msg_id
+        except DatabaseError:
             try:
-                with transaction.atomic():
-                    add_to_list(self.list_address, message)
-            except DuplicateMessage as e:
+                print_exc(file=self.stderr)
+            except UnicodeError:
+                pass
+            self.stderr.write(
+                "Message %s failed to import, skipping"
+                % unquote(message["Message-Id"]))
+            return msg_id
+        email = Email.objects.get(
+            mailinglist__name=self.list_address,
+            message_id=get_message_id(message))
+        # Store the list of impacted threads to be able to compute the
+        # thread_order and thread_depth values
+        self.add_impacted_threads([email.thread_id])
+        progress_marker.count_imported += 1
+        return msg_id
+
+    def _parse(self, raw_message):
+        # Run in the worker processes, must not use the database. Returns
+        # None if the message is too old, or its Message-ID and either the
+        # ParsedMessage or the error lines.
+        unixfrom, msg_raw = raw_message
+        message = self._fix_message(msg_raw, unixfrom)
+        if message is None:
+            return None
+        msg_id = str(message["Message-Id"])
+        try:
+            return msg_id, parse_message(message), None
+        except (LookupError, UnicodeError, ValueError) as e:
+            return msg_id, None, self._get_error_lines(message, e)
+
+    def _from_mbox_parallel(self, mbfile, messages, progress_marker):
+        # The worker processes parse and scrub the messages, this process
+        # stores them in order, in batches. A window of messages is parsed
+        # while the previous one is stored, to bound the memory usage.
+        window = self.jobs * self.BATCH_SIZE
+        # The workers are forked to inherit the importer, they never use the
+        # database connection.
+        context = multiprocessing.get_context("fork")
+        with context.Pool(self.jobs, _init_worker, (self, )) as pool:
+            pending = None
+            while True:
+                offsets = []
+                raw_messages = []
+                for offset, unixfrom, msg_raw in islice(messages, window):
+                    offsets.append(offset)
+                    msg_raw = bytes(msg_raw)
+                    # The workers can't use the database, reject the known
+                    # duplicates here before sending them.
+                    if self._is_known_duplicate(msg_raw, progress_marker):
+                        continue
+                    raw_messages.append((unixfrom, msg_raw))
+                if not offsets:
+                    break
+                parsing = (offsets, pool.map_async(
+                    _parse_in_worker, raw_messages,
+                    chunksize=self.BATCH_SIZE // 10))
+                if pending is not None:
+                    self._store(mbfile, *pending, progress_marker)
+                pending = parsing
+            if pending is not None:
+                self._store(mbfile, *pending, progress_marker)
+
+    def _store(self, mbfile, offsets, parsing, progress_marker):
+        batch = []
+        msg_id = None
+        for result in parsing.get():
+            if result is None:
+                continue  # Too old
+            msg_id, parsed, error_lines = result
+            progress_marker.tick(msg_id)
+            if error_lines:
+                for line in error_lines:
+                    self.stderr.write(line)
+                continue
+            batch.append(parsed)
+            if len(batch) >= self.BATCH_SIZE:
+                self._store_batch(batch, progress_marker)
+                batch = []
+        if batch:
+            self._store_batch(batch, progress_marker)
+        self._message_done(
+            mbfile, offsets[-1], msg_id, progress_marker, len(offsets))
+
+    def _store_batch(self, batch, progress_marker):
+        try:
+            with transaction.atomic():
+                results = add_parsed_to_list(self.list_address, batch)
+        except DatabaseError:
+            # Store the messages one by one, each in a savepoint, to only
+            # skip the failing ones.
+            results = [self._store_one(parsed) for parsed in batch]
+        hashes = []
+        for parsed, result in zip(batch, results):
+            if isinstance(result, DuplicateMessage):
                 if self.verbose:
                     self.stderr.write(
-                        "Duplicate email with message-id '%s'" % e.args[0])
-                continue
-            except (LookupError, UnicodeError, ValueError) as e:
+                        "Duplicate email with message-id '%s'"
+                        % result.args[0])
+            elif isinstance(result, Exception):
                 self.stderr.write("Failed adding message %s: %s"
-                                  % (message.get("Message-ID"), e))
-                if len(e.args) == 2:
-                    try:
-                        self.stderr.write(
-                            "%s from %s about %s"
-                            % (e.args[0], e.args[1].get("From"),
-                               e.args[1].get("Subject")))
-                    except UnicodeDecodeError:
-                        pass
-                # Don't reraise the exception
-                continue
-            except DatabaseError:
-                try:
-                    print_exc(file=self.stderr)
-                except UnicodeError:
-                    pass
-                self.stderr.write(
-                    "Message %s failed to import, skipping"
-                    % unquote(message["Message-Id"]))
-                continue
-            email = Email.objects.get(
-                mailinglist__name=self.list_address,
-                message_id=get_message_id(message))
-            # # Commit every time to be able to rollback on error
-            # if not transaction.get_autocommit():
-            #     transaction.commit()
-            # Store the list of impacted threads to be able to compute the
-            # thread_order and thread_depth values
-            self.impacted_thread_ids.add(email.thread_id)
-            progress_marker.count_imported += 1
-        # self.store.search_index.flush() # Now commit to the search index
-        progress_marker.finish()
-        mbox.close()
+                                  % (parsed.message_id, result))
+            elif result is not None:
+                hashes.append(result)
+        self.add_impacted_threads(Email.objects.filter(
+            mailinglist__name=self.list_address, message_id_hash__in=hashes
+            ).values_list("thread_id", flat=True))
+        progress_marker.count_imported += len(hashes)
+
+    def _store_one(self, parsed):
+        # Returns the result of add_parsed_to_list() for a single message,
+        # or None if it failed.
+        try:
+            with transaction.atomic():
+                return add_parsed_to_list(self.list_address, [parsed])[0]
+        except DatabaseError:
+            try:
+                print_exc(file=self.stderr)
+            except UnicodeError:
+                pass
+            self.stderr.write(
+                "Message %s failed to import, skipping" % parsed.message_id)
+            return None
+
+
+# The importer used by the worker processes of the parallel import.
+_worker_importer = None
+
+
+def _init_worker(importer):
+    global _worker_importer
+    _worker_importer = importer
+
+
+def _parse_in_worker(raw_message):
+    return _worker_importer._parse(raw_message)
 
 
 class Command(BaseCommand):
@@ -244,6 +524,28 @@ class Command(BaseCommand):
             '--ignore-mtime',
             action='store_true', default=False,
             help="do not check mbox mtimes (slower)")
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help="parse the messages in this number of processes, they are "
+                 "stored by the main process in batches")
+        parser.add_argument(
+            '--commit-every', type=int, default=1,
+            help="commit the database transaction every N messages, faster "
+                 "on PostgreSQL (default: %(default)s). The parallel import "
+                 "commits each batch.")
+        parser.add_argument(
+            '--checkpoint',
+            help="the file where the progress of the import is saved. "
+                 "Defaults to the first mbox file name with a "
+                 "'.checkpoint' suffix.")
+        parser.add_argument(
+            '--checkpoint-every', type=int, default=1000,
+            help="save the progress of the import every N messages, 0 to "
+                 "disable (default: %(default)s)")
+        parser.add_argument(
+            '--resume',
+            action='store_true', default=False,
+            help="resume an interrupted import from its checkpoint")
 
     def _check_options(self, options):
         if not options.get("list_address"):
@@ -259,6 +561,13 @@ class Command(BaseCommand):
             if not os.path.exists(mbfile):
                 raise CommandError("No such file: %s" % mbfile)
         options["verbosity"] = int(options.get("verbosity", "1"))
+        if options.get("jobs", 1) < 1:
+            raise CommandError("The number of jobs must be at least 1.")
+        if options.get("commit_every", 1) < 1:
+            raise CommandError(
+                "The number of messages per transaction must be at least 1.")
+        if not options.get("checkpoint"):
+            options["checkpoint"] = options["mbox"][0] + ".checkpoint"
         if options["since"]:
             try:
                 options["since"] = parse_date(options["since"])
@@ -268,29 +577,73 @@ class Command(BaseCommand):
             except ValueError as e:
                 raise CommandError("invalid value for '--since': %s" % e)
 
+    def _load_checkpoint(self, checkpoint, list_address, options):
+        if not checkpoint.exists():
+            raise CommandError(
+                "No checkpoint to resume from in %s" % checkpoint.path)
+        try:
+            state = checkpoint.load()
+        except ValueError as e:
+            raise CommandError(
+                "Invalid checkpoint in %s: %s" % (checkpoint.path, e))
+        mbox = [os.path.abspath(mbfile) for mbfile in options["mbox"]]
+        if (state.get("list_address") != list_address or
+                state.get("mbox") != mbox):
+            raise CommandError(
+                "The checkpoint in %s is for another import: %s to %s"
+                % (checkpoint.path, ", ".join(state.get("mbox", [])),
+                   state.get("list_address")))
+        if state.get("since") and not options["since"]:
+            options["since"] = parse_date(state["since"])
+        return state
+
     def handle(self, *args, **options):
         self._check_options(options)
         setup_logging(self, options["verbosity"])
         # main
         list_address = options["list_address"].lower()
-        # Keep autocommit on SQLite:
-        # https://docs.djangoproject.com/en/1.8/topics/db/transactions/#savepoints-in-sqlite
-        # if (settings.DATABASES["default"]["ENGINE"]
-        #     != "django.db.backends.sqlite3":
-        #     transaction.set_autocommit(False)
         settings.HYPERKITTY_BATCH_MODE = True
+        checkpoint = ImportCheckpoint(options["checkpoint"])
+        if options["resume"]:
+            state = self._load_checkpoint(checkpoint, list_address, options)
+        else:
+            state = None
+            if checkpoint.exists() and options["verbosity"] >= 1:
+                self.stdout.write(
+                    "Overwriting the checkpoint of a previous import in %s, "
+                    "use --resume to resume it" % checkpoint.path)
+            checkpoint.delete()
+            checkpoint.state = {
+                "list_address": list_address,
+                "mbox": [os.path.abspath(mbfile)
+                         for mbfile in options["mbox"]],
+                "done": [],
+            }
         # Only import emails newer than the latest email in the DB
         latest_email_date = Email.objects.filter(
                 mailinglist__name=list_address
             ).values("date").order_by("-date").first()
-        if latest_email_date and not options["since"]:
+        if latest_email_date and not options["since"] and state is None:
             options["since"] = latest_email_date["date"]
         if options["since"] and options["verbosity"] >= 2:
             self.stdout.write(
                 "Only emails after %s will be imported" % options["since"])
+        if options["since"]:
+            checkpoint.state["since"] = options["since"].isoformat()
         importer = DbImporter(list_address, options, self.stdout, self.stderr)
+        if options["checkpoint_every"]:
+            importer.checkpoint = checkpoint
+        if state is not None:
+            # They are already in the checkpoint.
+            importer.impacted_thread_ids.update(
+                thread_id for thread_id in checkpoint.load_thread_ids()
+                if thread_id > state.get("threads_done_up_to", 0))
         # disable mailman client for now
         for mbfile in options["mbox"]:
+            mbfile_path = os.path.abspath(mbfile)
+            if (state is not None and state.get("stage") == "threads" or
+                    mbfile_path in checkpoint.state["done"]):
+                continue
             if options["verbosity"] >= 1:
                 self.stdout.write("Importing from mbox file %s to %s"
                                   % (mbfile, list_address))
@@ -302,28 +655,45 @@ class Command(BaseCommand):
                         self.stdout.write('Mailbox file for %s is too old'
                                           % list_address)
                     continue
-            importer.from_mbox(mbfile)
+            if state is not None and state.get("path") == mbfile_path:
+                if options["verbosity"] >= 1:
+                    self.stdout.write(
+                        "Resuming after message %s (%d messages read)"
+                        % (state["message_id"], state["count"]))
+                importer.from_mbox(
+                    mbfile_path, after=state["offset"], count=state["count"])
+            else:
+                importer.from_mbox(mbfile_path)
+            importer.save_checkpoint(
+                done=checkpoint.state["done"] + [mbfile_path],
+                path=None, offset=None, count=0, message_id=None)
             if options["verbosity"] >= 2:
                 total_in_list = Email.objects.filter(
                     mailinglist__name=list_address).count()
                 self.stdout.write('  %s emails are stored into the database'
                                   % total_in_list)
+        if options["verbosity"] >= 2:
+            self.stdout.write("Time spent in each archiving stage:")
+            for line in format_summary():
+                self.stdout.write("  %s" % line)
         if options["verbosity"] >= 1:
             self.stdout.write("Computing thread structure")
         # Work on batches of thread ids to avoid creating a huge SQL request
-        # (it's an IN statement)
-        thread_ids = list(importer.impacted_thread_ids)
+        # (it's an IN statement), and to save the progress.
+        thread_ids = sorted(importer.impacted_thread_ids)
         while thread_ids:
-            thread_ids_batch = thread_ids[:100]
-            thread_ids = thread_ids[100:]
-            for thread in Thread.objects.filter(id__in=thread_ids_batch):
-                compute_thread_order_and_depth(thread)
+            thread_ids_batch = thread_ids[:1000]
+            thread_ids = thread_ids[1000:]
+            compute_threads_order_and_depth(thread_ids_batch)
+            update_counters(thread_ids_batch)
+            # The thread ids are processed in order.
+            importer.save_checkpoint(
+                stage="threads", threads_done_up_to=thread_ids_batch[-1])
+        checkpoint.delete()
         if not options["no_sync_mailman"]:
             if options["verbosity"] >= 1:
                 self.stdout.write("Synchronizing properties with Mailman")
             sync_with_mailman()
-            # if not transaction.get_autocommit():
-            #     transaction.commit()
         if options["verbosity"] >= 1:
             self.stdout.write("Warming up cache")
         call_command("hyperkitty_warm_up_cache", list_address)
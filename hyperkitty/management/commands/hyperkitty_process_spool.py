@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Archive the messages stored in the spool by the Mailman archiving endpoint.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.spool import get_spool_dir, process_spool
+from hyperkitty.management.utils import setup_logging
+
+
+class Command(BaseCommand):
+    help = "Archive the messages in the spool"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=100,
+            help="number of messages to archive at once")
+        parser.add_argument(
+            '-i', '--interval', type=int, default=None,
+            help="keep running and check the spool every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        if get_spool_dir() is None:
+            raise CommandError(
+                "The HYPERKITTY_ARCHIVE_SPOOL setting is not set.")
+        while True:
+            count = process_spool(options["batch_size"])
+            if options["verbosity"] >= 2:
+                self.stdout.write("%s messages archived" % count)
+            if options["interval"] is None:
+                break
+            if not count:
+                time.sleep(options["interval"])
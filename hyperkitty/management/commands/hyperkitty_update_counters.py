@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Recompute the counters stored in the threads and emails.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.counters import update_counters
+from hyperkitty.management.utils import setup_logging
+from hyperkitty.models import MailingList, Thread
+
+
+class Command(BaseCommand):
+    help = "Recompute the counters of the threads and emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument('mlists', nargs='*')
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=500,
+            help="number of threads to update at once")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        threads = Thread.objects.all()
+        if options["mlists"]:
+            unknown = set(options["mlists"]) - set(
+                MailingList.objects.filter(
+                    name__in=options["mlists"]).values_list(
+                    "name", flat=True))
+            if unknown:
+                raise CommandError(
+                    "Unknown mailing-lists: %s" % ", ".join(sorted(unknown)))
+            threads = threads.filter(mailinglist__name__in=options["mlists"])
+        fixed_threads, fixed_emails = update_counters(
+            threads.values_list("id", flat=True), options["batch_size"])
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "Fixed the counters of %d threads and %d emails"
+                % (fixed_threads, fixed_emails))
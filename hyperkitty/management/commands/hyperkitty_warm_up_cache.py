@@ -75,6 +75,3 @@ class Command(BaseCommand):
     def warm_up_thread(self, thread):
         for cached_value in thread.cached_values.values():
             cached_value.warm_up()
-        for email in thread.emails.all():
-            for cached_value in email.cached_values.values():
-                cached_value.warm_up()
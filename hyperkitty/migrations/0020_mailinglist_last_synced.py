@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0019_auto_20190127_null_description'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailinglist',
+            name='last_synced',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,75 @@
+from itertools import groupby
+
+from django.db import migrations, models
+from django.utils.http import int_to_base36
+
+
+def _get_paths(emails, starting_email_id):
+    # Same paths as hyperkitty.lib.analysis.get_thread_path(), the emails
+    # that can't be reached from the starting email keep no path.
+    children = {}
+    for email_id, parent_id in emails:
+        if parent_id is not None:
+            children.setdefault(parent_id, []).append(email_id)
+    paths = {}
+    to_visit = [(starting_email_id, "")]
+    while to_visit:
+        email_id, parent_path = to_visit.pop()
+        if email_id in paths:
+            continue  # Reply loop
+        path = "%s%s." % (parent_path, int_to_base36(email_id))
+        if len(path) > 255:
+            continue
+        paths[email_id] = path
+        to_visit.extend(
+            (child_id, path) for child_id in children.get(email_id, []))
+    return paths
+
+
+def populate_thread_paths(apps, schema_editor):
+    Thread = apps.get_model("hyperkitty", "Thread")
+    Email = apps.get_model("hyperkitty", "Email")
+    starting_emails = list(Thread.objects.filter(
+        starting_email__isnull=False
+        ).order_by("id").values_list("id", "starting_email_id"))
+    for start in range(0, len(starting_emails), 500):
+        batch = dict(starting_emails[start:start + 500])
+        emails = Email.objects.filter(
+            thread_id__in=list(batch)
+            ).order_by("thread_id").values_list("thread_id", "id", "parent_id")
+        paths = {}
+        for thread_id, thread_emails in groupby(
+                emails, key=lambda row: row[0]):
+            paths.update(_get_paths(
+                [row[1:] for row in thread_emails], batch[thread_id]))
+        _update_paths(Email, paths)
+
+
+def _update_paths(Email, paths):
+    paths = sorted(paths.items())
+    for start in range(0, len(paths), 500):
+        batch = paths[start:start + 500]
+        Email.objects.filter(
+            id__in=[email_id for email_id, path in batch]
+        ).update(thread_path=models.Case(
+            *[models.When(id=email_id, then=models.Value(path))
+              for email_id, path in batch],
+            output_field=models.CharField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0020_mailinglist_last_synced'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='thread_path',
+            field=models.CharField(
+                blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(
+            populate_thread_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,110 @@
+from django.db import migrations, models
+
+
+def populate_counters(apps, schema_editor):
+    # Use single UPDATE queries where possible, it's much faster than the
+    # models.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE hyperkitty_thread SET emails_count = (
+                SELECT COUNT(*) FROM hyperkitty_email
+                WHERE hyperkitty_email.thread_id = hyperkitty_thread.id
+            )
+            """)
+        cursor.execute("""
+            UPDATE hyperkitty_email SET
+                likes = (
+                    SELECT COUNT(*) FROM hyperkitty_vote
+                    WHERE hyperkitty_vote.email_id = hyperkitty_email.id
+                    AND hyperkitty_vote.value = 1
+                ),
+                dislikes = (
+                    SELECT COUNT(*) FROM hyperkitty_vote
+                    WHERE hyperkitty_vote.email_id = hyperkitty_email.id
+                    AND hyperkitty_vote.value = -1
+                )
+            WHERE id IN (SELECT email_id FROM hyperkitty_vote)
+            """)
+        cursor.execute("""
+            UPDATE hyperkitty_thread SET
+                likes = (
+                    SELECT SUM(likes) FROM hyperkitty_email
+                    WHERE hyperkitty_email.thread_id = hyperkitty_thread.id
+                ),
+                dislikes = (
+                    SELECT SUM(dislikes) FROM hyperkitty_email
+                    WHERE hyperkitty_email.thread_id = hyperkitty_thread.id
+                )
+            WHERE id IN (
+                SELECT thread_id FROM hyperkitty_email
+                WHERE likes > 0 OR dislikes > 0
+            )
+            """)
+        cursor.execute(
+            "UPDATE hyperkitty_thread SET votes_total = likes - dislikes")
+    # The participants are the distinct (address, name) pairs, count them in
+    # Python.
+    Thread = apps.get_model("hyperkitty", "Thread")
+    Email = apps.get_model("hyperkitty", "Email")
+    thread_ids = list(
+        Thread.objects.order_by("id").values_list("id", flat=True))
+    for start in range(0, len(thread_ids), 500):
+        batch = thread_ids[start:start + 500]
+        counts = {}
+        for thread_id, _address, _name in Email.objects.filter(
+                thread_id__in=batch).values_list(
+                "thread_id", "sender_id", "sender_name").distinct():
+            counts[thread_id] = counts.get(thread_id, 0) + 1
+        if not counts:
+            continue
+        Thread.objects.filter(id__in=list(counts)).update(
+            participants_count=models.Case(
+                *[models.When(id=thread_id, then=models.Value(count))
+                  for thread_id, count in counts.items()],
+                output_field=models.IntegerField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0021_email_thread_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='dislikes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='likes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='dislikes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='emails_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='likes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='participants_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='votes_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    PendingItem = apps.get_model("hyperkitty", "PendingItem")
+    seen = set()
+    duplicates = []
+    for item_id, func_name, value in PendingItem.objects.order_by(
+            "id").values_list("id", "func_name", "value"):
+        if (func_name, value) in seen:
+            duplicates.append(item_id)
+        seen.add((func_name, value))
+    for start in range(0, len(duplicates), 500):
+        PendingItem.objects.filter(
+            id__in=duplicates[start:start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0023_pendingitem'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='pendingitem',
+            name='func_name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='pendingitem',
+            name='value',
+            field=models.CharField(max_length=400),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pendingitem',
+            unique_together={('func_name', 'value')},
+        ),
+    ]
@@ -31,3 +31,4 @@ from .profile import Profile
 from .sender import Sender
 from .vote import Vote
 from .tag import Tagging, Tag
+from .task import PendingItem
@@ -20,13 +20,123 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from time import monotonic
+
+from django.conf import settings
 from django.core.cache import cache
+from django.db import models
+
+from hyperkitty.lib.utils import LRUCache
+
+
+class LocalCache(object):
+    """
+    A process-local tier in front of the shared cache, for the cached values.
+    It is enabled by the ``HYPERKITTY_LOCAL_CACHE_TIMEOUT`` setting, the
+    maximum age of its entries in seconds.
+
+    Each change to a cached value increments the version of its key in the
+    shared cache. A local entry is dropped when another process has changed
+    its version, which is read at most every ``check_interval`` seconds.
+    """
+
+    check_interval = 1
+
+    def __init__(self, maxsize=10000):
+        self._entries = LRUCache(maxsize)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "HYPERKITTY_LOCAL_CACHE_TIMEOUT", 0)
+
+    def _get_version_key(self, key):
+        return "%s:version" % key
+
+    def get_versions(self, keys):
+        """
+        Return the versions of the keys in the shared cache. They must be read
+        before the values that will be stored locally.
+        """
+        if not self.timeout or not keys:
+            return {}
+        versions = cache.get_many(
+            [self._get_version_key(key) for key in keys])
+        return {key: versions.get(self._get_version_key(key), 0)
+                for key in keys}
+
+    def get_many(self, keys):
+        if not self.timeout:
+            return {}
+        now = monotonic()
+        values = {}
+        to_check = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            value, stored, version, checked = entry
+            if now - stored > self.timeout:
+                self._entries.delete(key)
+            elif now - checked >= self.check_interval:
+                to_check[key] = entry
+            else:
+                values[key] = value
+        for key, version in self.get_versions(list(to_check)).items():
+            value, stored, local_version, _checked = to_check[key]
+            if version != local_version:
+                # Changed by another process.
+                self._entries.delete(key)
+                continue
+            self._entries.set(key, (value, stored, version, now))
+            values[key] = value
+        return values
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, values, versions):
+        """Store the values, with the versions read from the shared cache."""
+        if not self.timeout:
+            return
+        now = monotonic()
+        for key, value in values.items():
+            if key in versions:
+                self._entries.set(key, (value, now, versions[key], now))
+
+    def changed(self, values):
+        """The values have been changed in the shared cache."""
+        for key in values:
+            self._entries.delete(key)
+        if not self.timeout:
+            return
+        versions = {}
+        for key in values:
+            version_key = self._get_version_key(key)
+            cache.add(version_key, 0, None)
+            try:
+                versions[key] = cache.incr(version_key)
+            except ValueError:
+                pass  # Evicted in the meantime, don't keep it locally.
+        self.set_many(values, versions)
+
+    def clear(self):
+        self._entries.clear()
+
+
+local_cache = LocalCache()
 
 
 class CachedValue(object):
 
     cache_key = None
     timeout = None
+    # When set, only one process rebuilds a missing value, the other ones get
+    # the previous value, which is kept under a shadow key for stale_timeout
+    # seconds. This is the time after which the rebuild lock expires.
+    lock_timeout = None
+    stale_timeout = None
+    # Set by prefetch_cached_values(), for the current request only.
+    _prefetched = None
 
     def _get_cache_key(self, *args, **kwargs):
         if self.cache_key is not None:
@@ -44,15 +154,53 @@ class CachedValue(object):
 
     def rebuild(self, *args, **kwargs):
         """Overwrite the value in the cache."""
+        self._prefetched = None
         value = self.get_value(*args, **kwargs)
-        cache.set(self._get_cache_key(*args, **kwargs), value, self.timeout)
+        self.set_value(value, *args, **kwargs)
         return value
 
+    def set_value(self, value, *args, **kwargs):
+        """Store a value in the cache."""
+        cache_key = self._get_cache_key(*args, **kwargs)
+        cache.set(cache_key, value, self.timeout)
+        if self.lock_timeout is not None:
+            cache.set("%s:stale" % cache_key, value, self.stale_timeout)
+        local_cache.changed({cache_key: value})
+
+    def _rebuild_once(self, cache_key, *args, **kwargs):
+        """
+        Rebuild a missing value, unless another process is already doing it.
+        In that case, return the previous value.
+        """
+        if self.lock_timeout is None:
+            return self.rebuild(*args, **kwargs)
+        lock_key = "%s:lock" % cache_key
+        if not cache.add(lock_key, True, self.lock_timeout):
+            value = cache.get("%s:stale" % cache_key)
+            if value is not None:
+                return value
+            # There is no previous value, compute it but let the process that
+            # holds the lock store it.
+            return self.get_value(*args, **kwargs)
+        try:
+            return self.rebuild(*args, **kwargs)
+        finally:
+            cache.delete(lock_key)
+
     def get_or_set(self, *args, **kwargs):
         """Return the cached value, rebuilding the cache if necessary."""
-        value = cache.get(self._get_cache_key(*args, **kwargs))
+        if self._prefetched is not None and not args and not kwargs:
+            return self._prefetched
+        cache_key = self._get_cache_key(*args, **kwargs)
+        value = local_cache.get(cache_key)
+        if value is not None:
+            return value
+        versions = local_cache.get_versions([cache_key])
+        value = cache.get(cache_key)
         if value is None:
-            value = self.rebuild(*args, **kwargs)
+            value = self._rebuild_once(cache_key, *args, **kwargs)
+        else:
+            local_cache.set_many({cache_key: value}, versions)
         return value
 
     def __call__(self, *args, **kwargs):
@@ -72,32 +220,50 @@ class ModelCachedValue(CachedValue):
                 self.cache_key)
         raise NotImplementedError
 
+    @classmethod
+    def get_values(cls, instances):
+        """
+        Get the values that must be cached for many instances, as a dict
+        indexed by the instances' primary keys. Subclasses should override it
+        to use a single query.
+        """
+        return {
+            instance.pk: cls(instance).get_value() for instance in instances
+        }
 
-class VotesCachedValue(ModelCachedValue):
 
-    cache_key = "votes"
+class CountersMixin(object):
+    """
+    A model with counter columns, that are updated with ``F()`` expressions.
+    The counters are not written by a full ``save()``, which would overwrite
+    them with the values that were loaded.
+    """
 
-    def get_value(self):
-        from .thread import Thread
-        from .email import Email
-        from .vote import Vote
-        if isinstance(self.instance, Thread):
-            filters = {"email__thread_id": self.instance.id}
-        elif isinstance(self.instance, Email):
-            filters = {"email_id": self.instance.id}
-        else:
-            ValueError("The 'votes' cached value only accepts 'Email' "
-                       "and 'Thread' instance")
-        votes = list(Vote.objects.filter(**filters).values_list(
-            "value", flat=True))
-        return (
-                len([v for v in votes if v == 1]),
-                len([v for v in votes if v == -1]),
-            )
-
-    def get_or_set(self):
-        votes = super(VotesCachedValue, self).get_or_set()
-        likes, dislikes = votes
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and \
+                kwargs.get("update_fields") is None and \
+                not kwargs.get("force_insert"):
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.counter_fields]
+        super(CountersMixin, self).save(*args, **kwargs)
+
+    def change_counters(self, **changes):
+        """Add the values to the counters, and reload them."""
+        changes = {
+            field: delta for field, delta in changes.items() if delta}
+        if not changes:
+            return
+        self.__class__.objects.filter(pk=self.pk).update(**{
+            field: models.F(field) + delta
+            for field, delta in changes.items()})
+        self.refresh_from_db(fields=list(changes))
+
+    def get_votes(self):
+        likes, dislikes = self.likes, self.dislikes
         # XXX: use an Enum?
         if likes - dislikes >= 10:
             status = "likealot"
@@ -106,3 +272,54 @@ class VotesCachedValue(ModelCachedValue):
         else:
             status = "neutral"
         return {"likes": likes, "dislikes": dislikes, "status": status}
+
+
+def prefetch_cached_values(instances, names):
+    """
+    Load the cached values called ``names`` for all the ``instances`` at once.
+
+    The values are read from the cache with a single ``get_many`` call, and
+    the missing ones are rebuilt with one call to ``get_values()`` for each
+    kind of value. They are then attached to the instances, where the
+    properties will find them without querying the cache again.
+    """
+    cached_values = {}
+    for instance in instances:
+        for name in names:
+            cached_value = instance.cached_values[name]
+            cached_values.setdefault(
+                cached_value._get_cache_key(), []).append(cached_value)
+    if not cached_values:
+        return
+    values = local_cache.get_many(list(cached_values))
+    missing_keys = [key for key in cached_values if key not in values]
+    versions = local_cache.get_versions(missing_keys)
+    from_cache = {
+        cache_key: value for cache_key, value
+        in cache.get_many(missing_keys).items() if value is not None}
+    local_cache.set_many(from_cache, versions)
+    values.update(from_cache)
+    # Rebuild the missing values, grouped by class and model.
+    missing = {}
+    for cache_key, cached_value_list in cached_values.items():
+        if cache_key in values:
+            continue
+        cached_value = cached_value_list[0]
+        group = (cached_value.__class__, cached_value.instance.__class__)
+        missing.setdefault(group, []).append(cached_value)
+    for (cls, _model), cached_value_list in missing.items():
+        new_values = cls.get_values(
+            [cached_value.instance for cached_value in cached_value_list])
+        rebuilt = {}
+        for cached_value in cached_value_list:
+            value = new_values.get(cached_value.instance.pk)
+            if value is not None:
+                rebuilt[cached_value._get_cache_key()] = value
+        if not rebuilt:
+            continue
+        cache.set_many(rebuilt, cls.timeout)
+        local_cache.changed(rebuilt)
+        values.update(rebuilt)
+    for cache_key, value in values.items():
+        for cached_value in cached_values[cache_key]:
+            cached_value._prefetched = value
@@ -25,11 +25,12 @@ import re
 from email.message import EmailMessage
 
 from django.conf import settings
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
 from django.utils.timezone import now, get_fixed_timezone
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from .common import VotesCachedValue
+from hyperkitty.lib.counters import EMAIL_COUNTERS, update_counters
+from .common import CountersMixin
 from .mailinglist import MailingList
 from .thread import Thread
 from .vote import Vote
@@ -38,7 +39,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class Email(models.Model):
+class Email(CountersMixin, models.Model):
     """
     An archived email, from a mailing-list. It is identified by both the list
     name and the message id.
@@ -65,14 +66,16 @@ class Email(models.Model):
     archived_date = models.DateTimeField(default=now, db_index=True)
     thread_depth = models.IntegerField(default=0)
     thread_order = models.IntegerField(null=True, blank=True, db_index=True)
+    # Materialized path, see hyperkitty.lib.analysis.get_thread_path()
+    thread_path = models.CharField(
+        max_length=255, null=True, blank=True, db_index=True)
+    # Counters, see hyperkitty.lib.counters
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
 
-    ADDRESS_REPLACE_RE = re.compile(r"([\w.+-]+)@([\w.+-]+)")
+    counter_fields = EMAIL_COUNTERS
 
-    def __init__(self, *args, **kwargs):
-        super(Email, self).__init__(*args, **kwargs)
-        self.cached_values = {
-            "votes": VotesCachedValue(self),
-        }
+    ADDRESS_REPLACE_RE = re.compile(r"([\w.+-]+)@([\w.+-]+)")
 
     def __lt__(self, other):
         return self.date < other.date
@@ -80,9 +83,6 @@ class Email(models.Model):
     class Meta:
         unique_together = ("mailinglist", "message_id")
 
-    def get_votes(self):
-        return self.cached_values["votes"]()
-
     def vote(self, value, user):
         # Checks if the user has already voted for this message.
         existing = self.votes.filter(user=user).first()
@@ -102,27 +102,44 @@ class Email(models.Model):
             vote = Vote(email=self, user=user, value=value)
             vote.save()
 
+    def _get_subthread(self):
+        # Return a queryset of this email and all the replies to it.
+        emails = Email.objects.filter(thread_id=self.thread_id)
+        if self.thread_path is not None and not emails.filter(
+                thread_path__isnull=True).exists():
+            return emails.filter(thread_path__startswith=self.thread_path)
+        # Some paths are missing, walk down the replies in memory.
+        children = {}
+        for email_id, parent_id in emails.values_list("id", "parent_id"):
+            children.setdefault(parent_id, []).append(email_id)
+        subthread = set()
+        to_visit = [self.id]
+        while to_visit:
+            email_id = to_visit.pop()
+            if email_id in subthread:
+                continue  # Reply loop
+            subthread.add(email_id)
+            to_visit.extend(children.get(email_id, []))
+        return Email.objects.filter(id__in=subthread)
+
     def set_parent(self, parent):
         if self.id == parent.id:
             raise ValueError("An email can't be its own parent")
-        # Compute the subthread
-        subthread = [self]
-
-        def _collect_children(current_email):
-            children = list(current_email.children.all())
-            if not children:
-                return
-            subthread.extend(children)
-            for child in children:
-                _collect_children(child)
-        _collect_children(self)
+        # The positions must be recomputed with the move, or not at all.
+        with transaction.atomic():
+            self._set_parent(parent)
+            compute_thread_order_and_depth(parent.thread)
+
+    def _set_parent(self, parent):
+        subthread = self._get_subthread()
+        parent_in_subthread = subthread.filter(id=parent.id).exists()
         # now set my new parent value
         old_parent_id = self.parent_id
         self.parent = parent
         self.save(update_fields=["parent_id"])
         # If my future parent is in my current subthread, I need to set its
         # parent to my current parent
-        if parent in subthread:
+        if parent_in_subthread:
             parent.parent_id = old_parent_id
             parent.save(update_fields=["parent_id"])
             # do it after setting the new parent_id to avoid having two
@@ -130,16 +147,16 @@ class Email(models.Model):
         if self.thread_id != parent.thread_id:
             # we changed the thread, reattach the subthread
             former_thread = self.thread
-            for child in subthread:
-                child.thread = parent.thread
-                child.save(update_fields=["thread_id"])
-                if child.date > parent.thread.date_active:
-                    parent.thread.date_active = child.date
+            last_date = subthread.aggregate(last=models.Max("date"))["last"]
+            subthread.update(thread=parent.thread)
+            self.thread = parent.thread
+            if last_date > parent.thread.date_active:
+                parent.thread.date_active = last_date
             parent.thread.save()
+            update_counters([former_thread.id, parent.thread_id])
             # if we were the starting email, or former thread may be empty
-            if former_thread.emails.count() == 0:
+            if not former_thread.emails.exists():
                 former_thread.delete()
-        compute_thread_order_and_depth(parent.thread)
 
     def as_message(self, escape_addresses=True):
         # http://wordeology.com/computer/how-to-send-good-unicode-email-with-python.html
@@ -205,8 +222,8 @@ class Email(models.Model):
         self.mailinglist.on_email_added(self)
         if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
             # For batch imports, let the cron job do the work
-            from hyperkitty.tasks import check_orphans
-            check_orphans.delay(self.id)
+            from hyperkitty.tasks import check_emails_orphans
+            check_emails_orphans.mark_dirty(self.id)
 
     def on_pre_save(self):
         self._set_message_id_hash()
@@ -263,8 +280,7 @@ class Email(models.Model):
             mlist.on_email_deleted(self)
 
     def on_vote_added(self, vote):
-        from hyperkitty.tasks import rebuild_email_cache_votes
-        rebuild_email_cache_votes.delay(self.id)
+        self.change_counters(**vote.counter_changes)
 
     on_vote_deleted = on_vote_added
 
@@ -21,6 +21,7 @@
 #
 
 import datetime
+from collections.abc import Sequence
 from enum import Enum
 from urllib.error import HTTPError
 
@@ -65,6 +66,7 @@ class MailingList(models.Model):
         choices=[(p.value, p.name) for p in ArchivePolicy],
         default=ArchivePolicy.public.value)
     created_at = models.DateTimeField(default=now)
+    last_synced = models.DateTimeField(null=True)
 
     MAILMAN_ATTRIBUTES = (
         "display_name", "description", "subject_prefix",
@@ -181,6 +183,7 @@ class MailingList(models.Model):
             "created_at": convert_date,
             "archive_policy": lambda p: ArchivePolicy[p].value,
         }
+        changed = False
         for propname in self.MAILMAN_ATTRIBUTES:
             try:
                 value = getattr(mm_list, propname)
@@ -188,8 +191,35 @@ class MailingList(models.Model):
                 value = mm_list.settings[propname]
             if propname in converters:
                 value = converters[propname](value)
-            setattr(self, propname, value)
-        self.save()
+            if getattr(self, propname) != value:
+                setattr(self, propname, value)
+                changed = True
+        self.last_synced = now()
+        if changed:
+            self.save()
+        else:
+            # Only record the sync date.
+            MailingList.objects.filter(pk=self.pk).update(
+                last_synced=self.last_synced)
+
+    def schedule_mailman_update(self):
+        """
+        Schedule an update of the list properties from Mailman, unless one
+        happened (or was scheduled) less than
+        ``HYPERKITTY_MAILMAN_SYNC_INTERVAL`` seconds ago.
+        """
+        from hyperkitty.tasks import update_from_mailman
+        interval = getattr(
+            settings, "HYPERKITTY_MAILMAN_SYNC_INTERVAL", 15 * 60)
+        if (self.last_synced is not None and
+                now() - self.last_synced
+                < datetime.timedelta(seconds=interval)):
+            return
+        # Only the first caller in the interval schedules the update.
+        cache_key = "MailingList:%s:mailman_update_scheduled" % self.pk
+        if not cache.add(cache_key, True, interval):
+            return
+        update_from_mailman.delay(self.name)
 
     # Events (signal callbacks)
 
@@ -199,7 +229,10 @@ class MailingList(models.Model):
             self.list_id = self.name.replace("@", ".")
 
     def on_thread_added(self, thread):
-        self.cached_values["recent_threads"].add_thread(thread)
+        self.on_threads_added([thread])
+
+    def on_threads_added(self, threads):
+        self.cached_values["recent_threads"].add_threads(threads)
 
     def on_thread_deleted(self, thread):
         from hyperkitty.tasks import (
@@ -214,18 +247,23 @@ class MailingList(models.Model):
             self.name, thread.date_active.year, thread.date_active.month)
 
     def on_email_added(self, email):
+        self.on_emails_added([email])
+
+    def on_emails_added(self, emails):
         if getattr(settings, "HYPERKITTY_BATCH_MODE", False):
             # Cache handling will be done at the end of the import
             # process.
             return
         # Rebuild the cached values.
         from hyperkitty.tasks import (
-            rebuild_mailinglist_cache_recent,
-            rebuild_mailinglist_cache_for_month,
+            rebuild_mailinglists_cache_recent,
+            rebuild_mailinglists_cache_for_month,
             )
-        rebuild_mailinglist_cache_recent.delay(self.name)
-        rebuild_mailinglist_cache_for_month.delay(
-            self.name, email.date.year, email.date.month)
+        rebuild_mailinglists_cache_recent.mark_dirty(self.name)
+        months = set((email.date.year, email.date.month) for email in emails)
+        for year, month in sorted(months):
+            rebuild_mailinglists_cache_for_month.mark_dirty(
+                (self.name, year, month))
 
     def on_email_deleted(self, email):
         # Don't use on_email_added, it will try appending to the
@@ -247,9 +285,38 @@ class MailingList(models.Model):
     on_vote_deleted = on_vote_added
 
 
+class LazyThreads(Sequence):
+    """
+    The threads with the given ids, in the same order. They are loaded with a
+    single query on first access, so slicing beforehand only loads the
+    threads that are needed.
+    """
+
+    def __init__(self, thread_ids):
+        self.thread_ids = thread_ids
+        self._threads = None
+
+    def _get_threads(self):
+        if self._threads is None:
+            threads = Thread.objects.select_related(
+                "starting_email", "category").in_bulk(self.thread_ids)
+            self._threads = [
+                threads[pk] for pk in self.thread_ids if pk in threads]
+        return self._threads
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and self._threads is None:
+            return LazyThreads(self.thread_ids[index])
+        return self._get_threads()[index]
+
+    def __len__(self):
+        return len(self._get_threads())
+
+
 class RecentThreads(ModelCachedValue):
 
     cache_key = "recent_threads"
+    lock_timeout = 60
 
     def get_value(self):
         # Only cache the list of thread ids, or it may go over memcached's size
@@ -267,20 +334,26 @@ class RecentThreads(ModelCachedValue):
 
     def get_or_set(self):
         thread_ids = super(RecentThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
+        return LazyThreads(thread_ids)
 
     def add_thread(self, thread):
-        # Add the thread to the recent_threads.
+        self.add_threads([thread])
+
+    def add_threads(self, threads):
+        # Add the threads to the recent_threads.
         # Just append to the cache, a daily cron job will rebuild
         # the cache entirely to remove older threads.
+        if not threads:
+            return
         recent_thread_ids = self.get_value()
         if recent_thread_ids is None:
             recent_thread_ids = []
-        if thread.id in recent_thread_ids:
-            # If the thread is already recent, make it the most recent.
-            recent_thread_ids.remove(thread.id)
-        recent_thread_ids.insert(0, thread.id)
-        cache.set(self._get_cache_key(), recent_thread_ids, None)
+        for thread in threads:
+            if thread.id in recent_thread_ids:
+                # If the thread is already recent, make it the most recent.
+                recent_thread_ids.remove(thread.id)
+            recent_thread_ids.insert(0, thread.id)
+        self.set_value(recent_thread_ids)
         cache.set("%s_count" % self._get_cache_key(),
                   len(recent_thread_ids), None)
 
@@ -344,56 +417,38 @@ class TopThreads(ModelCachedValue):
     """Threads with the most answers."""
 
     cache_key = "top_threads"
+    lock_timeout = 60
 
     def get_value(self):
-        # Filter on the recent_threads ids instead of re-using the date
-        # filter, otherwise the Sum will be computed for every thread
-        # regardless of their date.
         begin_date, end_date = self.instance.get_recent_dates()
-        recent_thread_ids = self.instance.get_threads_between(
-            begin_date, end_date).values("id")
-        threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Count("emails")).order_by("-emails__count")[:20]
-        # (not sure about using .values_list() here because of the annotation)
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads]
+        return list(self.instance.get_threads_between(
+            begin_date, end_date).order_by(
+            "-emails_count").values_list("id", flat=True)[:20])
 
     def get_or_set(self):
         thread_ids = super(TopThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
+        return LazyThreads(thread_ids)
 
 
 class PopularThreads(ModelCachedValue):
     """Threads with the most votes."""
 
     cache_key = "popular_threads"
+    lock_timeout = 60
 
     def get_value(self):
-        # Filter on the recent_threads ids instead of re-using the date
-        # filter, otherwise the Sum will be computed for every thread
-        # regardless of their date.
         begin_date, end_date = self.instance.get_recent_dates()
-        recent_thread_ids = self.instance.get_threads_between(
-            begin_date, end_date).values("id")
-        threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Sum("emails__votes__value")).order_by(
-            "-emails__votes__value__sum")[:20]
-        # (not sure about using .values_list() here because of the annotation)
-        for thread in threads:
-            value = thread.emails__votes__value__sum
-            if value is None:
-                value = 0
-            cache.set("Thread:%s:votes_total" % thread.id, value, None)
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads if t.votes_total > 0]
+        return list(self.instance.get_threads_between(
+            begin_date, end_date).filter(votes_total__gt=0).order_by(
+            "-votes_total").values_list("id", flat=True)[:20])
 
     def get_or_set(self):
         thread_ids = super(PopularThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
+        return LazyThreads(thread_ids)
 
 
 class FirstDate(ModelCachedValue):
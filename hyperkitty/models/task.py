@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+import json
+
+from django.db import IntegrityError, models, transaction
+
+
+class PendingItem(models.Model):
+    """
+    An argument waiting for the next run of a batched task. The arguments are
+    stored in the database so that they are shared by all the processes and
+    are only visible once the changes that produced them are committed. Each
+    argument is only stored once until it is processed.
+    """
+    func_name = models.CharField(max_length=100)
+    value = models.CharField(max_length=400)
+
+    class Meta:
+        unique_together = ("func_name", "value")
+
+    @classmethod
+    def add(cls, func_name, item):
+        value = json.dumps(item)
+        if cls.objects.filter(func_name=func_name, value=value).exists():
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(func_name=func_name, value=value)
+        except IntegrityError:
+            pass  # Added by another process in the meantime.
+
+    def get_item(self):
+        item = json.loads(self.value)
+        if isinstance(item, list):
+            # Tuples are stored as JSON arrays, and must stay hashable.
+            item = tuple(item)
+        return item
+
+    def __str__(self):
+        return "%s(%s)" % (self.func_name, self.value)
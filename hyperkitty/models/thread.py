@@ -25,15 +25,17 @@ from django.conf import settings
 from django.db import models
 from django.utils.timezone import now, utc
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from .common import ModelCachedValue, VotesCachedValue
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, insert_email_position)
+from hyperkitty.lib.counters import THREAD_COUNTERS
+from .common import CountersMixin, ModelCachedValue
 
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-class Thread(models.Model):
+class Thread(CountersMixin, models.Model):
     """
     A thread of archived email, from a mailing-list. It is identified by both
     the list name and the thread id.
@@ -49,15 +51,19 @@ class Thread(models.Model):
     starting_email = models.OneToOneField(
         "Email", related_name="started_thread", null=True,
         on_delete=models.SET_NULL)
+    # Counters, see hyperkitty.lib.counters
+    emails_count = models.IntegerField(default=0)
+    participants_count = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
+    votes_total = models.IntegerField(default=0)
+
+    counter_fields = THREAD_COUNTERS
 
     def __init__(self, *args, **kwargs):
         super(Thread, self).__init__(*args, **kwargs)
         self.cached_values = {
-            "participants_count": ParticipantsCount(self),
-            "emails_count": EmailsCount(self),
             "subject": Subject(self),
-            "votes": VotesCachedValue(self),
-            "votes_total": VotesTotal(self),
         }
 
     class Meta:
@@ -74,10 +80,6 @@ class Thread(models.Model):
                 "sender__address", "sender_name").distinct()
             ]
 
-    @property
-    def participants_count(self):
-        return self.cached_values["participants_count"]()
-
     def replies_after(self, date):
         return self.emails.filter(date__gt=date)
 
@@ -98,21 +100,10 @@ class Thread(models.Model):
     #     self.category_id = category.id
     # category = property(_get_category, _set_category)
 
-    @property
-    def emails_count(self):
-        return self.cached_values["emails_count"]()
-
     @property
     def subject(self):
         return self.cached_values["subject"]()
 
-    def get_votes(self):
-        return self.cached_values["votes"]()
-
-    @property
-    def votes_total(self):
-        return self.cached_values["votes_total"]()
-
     @property
     def prev_thread(self):  # TODO: Make it a relationship
         return Thread.objects.filter(
@@ -163,57 +154,68 @@ class Thread(models.Model):
         self.mailinglist.on_thread_deleted(self)
 
     def on_email_added(self, email):
+        self.on_emails_added([email])
+
+    def on_emails_added(self, emails):
         self.find_starting_email()
-        self.date_active = email.date
+        self.date_active = emails[-1].date
         if self.starting_email is None:
-            self.starting_email = email
+            self.starting_email = emails[0]
         self.save()
         if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-            # Cache handling and thread positions will be handled at the end of
-            # the import process.
+            # Counters, cache handling and thread positions will be handled at
+            # the end of the import process.
             from hyperkitty.tasks import (
-                rebuild_thread_cache_new_email,
-                compute_thread_positions,
+                rebuild_threads_cache_new_email,
+                compute_threads_positions,
                 )
-            rebuild_thread_cache_new_email.delay(self.id)
-            compute_thread_positions.delay(self.id)
+            self._count_new_emails(emails)
+            rebuild_threads_cache_new_email.mark_dirty(self.id)
+            # New replies are usually inserted in place, the whole thread is
+            # only recomputed when that's not possible.
+            for index, email in enumerate(emails):
+                pending_ids = [e.id for e in emails[index + 1:]]
+                if not insert_email_position(email, pending_ids):
+                    compute_threads_positions.mark_dirty(self.id)
+                    break
+
+    def _count_new_emails(self, emails):
+        # Only count the senders that had not posted to this thread yet.
+        senders = set((email.sender_id, email.sender_name) for email in emails)
+        known_senders = set(self.emails.exclude(
+            id__in=[email.id for email in emails]).filter(
+            sender_id__in=[sender_id for sender_id, name in senders]
+            ).values_list("sender_id", "sender_name"))
+        self.change_counters(
+            emails_count=len(emails),
+            participants_count=len(senders - known_senders))
 
     def on_email_deleted(self, email):
-        from hyperkitty.tasks import rebuild_thread_cache_new_email
+        from hyperkitty.tasks import rebuild_threads_cache_new_email
         # update or cleanup thread
         if self.emails.count() == 0:
             self.delete()
         else:
+            sender_left = not self.emails.filter(
+                sender_id=email.sender_id,
+                sender_name=email.sender_name).exists()
+            self.change_counters(
+                emails_count=-1, participants_count=-int(sender_left))
             if self.starting_email is None:
                 self.find_starting_email()
                 self.save(update_fields=["starting_email"])
             compute_thread_order_and_depth(self)
             self.date_active = self.emails.order_by("-date").first().date
-            rebuild_thread_cache_new_email.delay(self.id)
+            rebuild_threads_cache_new_email.delay(self.id)
 
     def on_vote_added(self, vote):
-        from hyperkitty.tasks import rebuild_thread_cache_votes
-        rebuild_thread_cache_votes.delay(self.id)
+        changes = vote.counter_changes
+        self.change_counters(
+            votes_total=changes["likes"] - changes["dislikes"], **changes)
 
     on_vote_deleted = on_vote_added
 
 
-class ParticipantsCount(ModelCachedValue):
-
-    cache_key = "participants_count"
-
-    def get_value(self):
-        return len(self.instance.participants)
-
-
-class EmailsCount(ModelCachedValue):
-
-    cache_key = "emails_count"
-
-    def get_value(self):
-        return self.instance.emails.count()
-
-
 class Subject(ModelCachedValue):
 
     cache_key = "subject"
@@ -221,14 +223,16 @@ class Subject(ModelCachedValue):
     def get_value(self):
         return self.instance.starting_email.subject
 
-
-class VotesTotal(ModelCachedValue):
-
-    cache_key = "votes_total"
-
-    def get_value(self):
-        votes = self.instance.get_votes()
-        return votes["likes"] - votes["dislikes"]
+    @classmethod
+    def get_values(cls, threads):
+        from .email import Email
+        subjects = dict(Email.objects.filter(
+            id__in=[thread.starting_email_id for thread in threads]
+            ).values_list("id", "subject"))
+        return {
+            thread.pk: subjects.get(thread.starting_email_id)
+            for thread in threads
+        }
 
 
 class LastView(models.Model):
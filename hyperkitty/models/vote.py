@@ -23,6 +23,8 @@
 from django.conf import settings
 from django.db import models
 
+from hyperkitty.lib.counters import get_vote_changes
+
 
 class Vote(models.Model):
     """
@@ -37,12 +39,23 @@ class Vote(models.Model):
     class Meta:
         unique_together = ("email", "user")
 
+    def __init__(self, *args, **kwargs):
+        super(Vote, self).__init__(*args, **kwargs)
+        # The value in the database, to update the counters on changes.
+        self._stored_value = self.value if self.pk is not None else None
+        self.counter_changes = None
+
     def on_post_save(self):
+        self.counter_changes = get_vote_changes(
+            self._stored_value, self.value)
+        self._stored_value = self.value
         self.email.on_vote_added(self)
         self.email.thread.on_vote_added(self)
         self.email.mailinglist.on_vote_added(self)
 
     def on_post_delete(self):
+        self.counter_changes = get_vote_changes(self._stored_value, None)
+        self._stored_value = None
         self.email.on_vote_deleted(self)
         self.email.thread.on_vote_deleted(self)
         self.email.mailinglist.on_vote_deleted(self)
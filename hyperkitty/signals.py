@@ -25,10 +25,13 @@ from django.db.models.signals import (
 from django.dispatch import receiver
 from django_mailman3.signals import mailinglist_created, mailinglist_modified
 
+from hyperkitty.lib.incoming import clear_caches
 from hyperkitty.lib.mailman import import_list_from_mailman
+from hyperkitty.lib.timing import timed
 from hyperkitty.models.email import Email, Attachment
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.profile import Profile
+from hyperkitty.models.sender import Sender
 from hyperkitty.models.thread import Thread
 from hyperkitty.models.vote import Vote
 
@@ -48,7 +51,8 @@ def Email_on_pre_save(sender, **kwargs):
 @receiver(post_save, sender=Email)
 def Email_on_post_save(sender, **kwargs):
     if kwargs["created"]:
-        kwargs["instance"].on_post_created()
+        with timed("signal_handlers"):
+            kwargs["instance"].on_post_created()
     else:
         kwargs["instance"].on_post_save()
 
@@ -77,6 +81,19 @@ def MailingList_set_list_id(sender, **kwargs):
     kwargs["instance"].on_pre_save()
 
 
+@receiver(post_save, sender=MailingList)
+@receiver(post_delete, sender=MailingList)
+def MailingList_clear_ingestion_cache(sender, **kwargs):
+    clear_caches(list_name=kwargs["instance"].name)
+
+
+# Sender
+
+@receiver(post_delete, sender=Sender)
+def Sender_clear_ingestion_cache(sender, **kwargs):
+    clear_caches(address=kwargs["instance"].address)
+
+
 # Profile
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
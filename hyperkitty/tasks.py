@@ -26,13 +26,18 @@ Author: Aurelien Bompard <abompard@fedoraproject.org>
 import importlib
 import logging
 from binascii import crc32
+from collections import OrderedDict
+from datetime import timedelta
 from functools import wraps
 
 from django.conf import settings
 from django.core.cache.utils import make_template_fragment_key
 from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now
 from django_q.conf import Conf
-from django_q.tasks import AsyncTask
+from django_q.models import Schedule
+from django_q.tasks import AsyncTask, schedule
 from mailmanclient import MailmanConnectionError
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
@@ -40,12 +45,61 @@ from hyperkitty.lib.utils import run_with_lock
 from hyperkitty.models.email import Email
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.sender import Sender
+from hyperkitty.models.task import PendingItem
 from hyperkitty.models.thread import Thread
 from hyperkitty.search_indexes import update_index
 
 log = logging.getLogger(__name__)
 
 
+#: Names of the functions decorated with :py:meth:`SingletonAsync.task` or
+#: :py:meth:`SingletonAsync.batch_task`, used to collect the metrics.
+_TASK_NAMES = []
+
+#: Paths of the functions decorated with :py:meth:`SingletonAsync.batch_task`.
+_BATCH_TASKS = []
+
+#: Number of stored arguments of batched tasks deleted per query.
+PENDING_BATCH_SIZE = 500
+
+TASK_METRICS = ("enqueued", "coalesced", "dropped")
+
+
+def _func_path(func):
+    if callable(func):
+        return "{}.{}".format(func.__module__, func.__name__)
+    return func
+
+
+def _incr_metric(task_name, metric):
+    key = "task:metrics:{}:{}".format(task_name, metric)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass  # Evicted in the meantime, it's only a metric.
+
+
+def get_task_metrics():
+    """Return the counts of enqueued, coalesced and dropped task calls.
+
+    The dropped calls are the items of batched tasks that failed and were
+    discarded.
+
+    :return: a dict with the task names as keys and a dict of counts, indexed
+             by metric name, as values.
+    """
+    keys = {
+        "task:metrics:{}:{}".format(task_name, metric): (task_name, metric)
+        for task_name in _TASK_NAMES for metric in TASK_METRICS
+        }
+    values = cache.get_many(list(keys))
+    metrics = {}
+    for key, (task_name, metric) in keys.items():
+        metrics.setdefault(task_name, {})[metric] = values.get(key, 0)
+    return metrics
+
+
 def unlock_and_call(func, cache_key, *args, **kwargs):
     """This method is a wrapper that will actually be called by the workers.
 
@@ -66,6 +120,89 @@ def unlock_and_call(func, cache_key, *args, **kwargs):
     return func(*args, **kwargs)
 
 
+def add_pending(func_name, item):
+    """Store an argument for the next run of a batched task.
+
+    The arguments are stored in the database, in the current transaction: a
+    batch only sees them once the changes that produced them are committed.
+    """
+    PendingItem.add(func_name, item)
+
+
+def _get_pending(func_name):
+    return list(PendingItem.objects.filter(
+        func_name=func_name).order_by("id"))
+
+
+def _delete_pending(pending):
+    # Only delete the rows that were read, others may have been committed
+    # in the meantime.
+    ids = [item.id for item in pending]
+    for start in range(0, len(ids), PENDING_BATCH_SIZE):
+        PendingItem.objects.filter(
+            id__in=ids[start:start + PENDING_BATCH_SIZE]).delete()
+
+
+def _unique_items(pending):
+    return list(OrderedDict.fromkeys(item.get_item() for item in pending))
+
+
+def pop_pending(func_name):
+    """Return and remove the arguments stored for a batched task.
+
+    Duplicate arguments are only returned once.
+    """
+    pending = _get_pending(func_name)
+    _delete_pending(pending)
+    return _unique_items(pending)
+
+
+def run_batch(func_name):
+    """Run a batched task with all the arguments stored since its last run.
+
+    If the function fails, it is called again for each argument, and the
+    arguments that still fail are logged and dropped. The arguments are
+    removed once processed.
+
+    :param str func_name: dotted path of the function to call.
+    """
+    pending = _get_pending(func_name)
+    if not pending:
+        return
+    module, name = func_name.rsplit('.', 1)
+    func = getattr(importlib.import_module(module), name)
+    items = _unique_items(pending)
+    try:
+        with transaction.atomic():
+            func(items)
+    except Exception as e:
+        log.warning("Failed to run the batched task %s on %d items, running "
+                    "it on each item: %s", func_name, len(items), e)
+        for item in items:
+            try:
+                with transaction.atomic():
+                    func([item])
+            except Exception as e:
+                log.exception("Dropping the item %r of the batched task %s: "
+                              "%s", item, func_name, e)
+                _incr_metric(name, "dropped")
+    _delete_pending(pending)
+
+
+def run_dirty_batches():
+    """Run all the batched tasks that have pending items.
+
+    The items marked dirty with the ``mark_dirty()`` method of the batched
+    tasks are only processed here, this is meant to be called periodically.
+    """
+    for func_path in _BATCH_TASKS:
+        try:
+            run_batch(func_path)
+        except Exception as e:
+            log.exception("Failed to run the batched task %s: %s",
+                          func_path, e)
+
+
 def process_task_result(task):
     """Hook to process the result of async tasks.
 
@@ -88,11 +225,15 @@ class SingletonAsync(AsyncTask):
     """A singleton task implementation.
 
     A singleton task does not enqueue the function if there's already one in
-    the queue.
+    the queue with the same arguments: the call is coalesced into the pending
+    task.
 
     The cache is used for locking: the lock is acquired when the run() method
-    is executed. If there's already an identical task in the queue, it will
-    return this task's id.
+    is executed, and released when the worker starts the task.
+
+    If the ``HYPERKITTY_TASK_DEBOUNCE`` setting is set to a number of seconds,
+    the task is not queued right away but scheduled to run after this delay,
+    and all the identical calls in the meantime are coalesced into it.
     """
 
     #: This is the timeout after which the cache entry for a task will
@@ -109,15 +250,19 @@ class SingletonAsync(AsyncTask):
     # However, this shouldn't cause any harm though and if there is someone
     # else looking at it in future, wondering what is the use of it, feel-free
     # to get-rid of it
+    #: Delay before a task is queued, to coalesce more calls into it.
+    DEBOUNCE = getattr(settings, 'HYPERKITTY_TASK_DEBOUNCE', 0)
 
     def __init__(self, func, *args, **kwargs):
         # We use the function's name along with hashed arguments to make sure
         # that we have only single function in queue with same arguments.
         # No space allowed in memcached keys. Use CRC32 on the arguments
         # to have a fast and sufficiently unique way to identify tasks.
-        func_name = func.__name__ if callable(func) else func
-        self._cache_key = "task:status:%s:%s".format(
-            func_name,
+        self._func_path = _func_path(func)
+        self._task_name = kwargs.get("task_name") or \
+            self._func_path.rsplit(".", 1)[-1]
+        self._cache_key = "task:status:{}:{}".format(
+            self._func_path,
             crc32((repr(args) + repr(kwargs)).encode('utf-8')) & 0xffffffff
         )
         # Call the Original AsyncTask class with required parameters.
@@ -150,15 +295,18 @@ class SingletonAsync(AsyncTask):
                 at all.  To find out if a task is there in a queue, we use
                 Django's cache framework to store a unique key, which is a hash
                 of function name all it's arguments.
+
+        :return: the id of the queued task, or None if the call was coalesced
+                 into a pending task or scheduled for later.
         """
         # This overrides the AsyncTask.run() method.
         # First, check if there is a function with same args in queue already.
-        pending_id = cache.get(self._cache_key, default=None)
-        if pending_id is not None:
+        # Adding the key is atomic, only one caller can take the lock.
+        if not cache.add(self._cache_key, True, self.LOCK_EXPIRE):
             # This means that there is a task in the queue already, so we call
-            # ourselves "started" (yeah, air-quotes), and return the id of
-            # original function.
+            # ourselves "started" (yeah, air-quotes).
             self.started = True
+            _incr_metric(self._task_name, "coalesced")
             # Log that we are not going to actually queue this function call.
             log.debug(
                 'Skipping task "{0}" with args "{1}" and kwargs "{2}"'.format(
@@ -167,16 +315,53 @@ class SingletonAsync(AsyncTask):
                     self.kwargs
                 )
             )
-            return pending_id
+            return None
         # There is no task in the queue that matches the function, or the
         # previous version of this task was executed more than self.LOCK_EXPIRE
         # seconds ago.
-        self.id = super().run()
-        # Set the cache key to make sure that task is scheduled and added to
-        # the queue. This expired in self.LOCK_EXPIRE seconds, so there can
-        # effectively be multiple instances of same task.
-        cache.set(self._cache_key, self.id, self.LOCK_EXPIRE)
-        return self.id
+        try:
+            if self.DEBOUNCE:
+                self._schedule()
+            else:
+                self.id = super().run()
+        except Exception:
+            cache.delete(self._cache_key)
+            raise
+        _incr_metric(self._task_name, "enqueued")
+        return self.id or None
+
+    def _schedule(self):
+        func_kwargs = self.kwargs.copy()
+        func_kwargs.pop("hook", None)
+        task_name = func_kwargs.pop("task_name", None)
+        # The schedule is stored in the database, the functions must be
+        # referenced by their path.
+        func, cache_key = self.args[:2]
+        schedule(
+            _func_path(unlock_and_call),
+            _func_path(func), cache_key, *self.args[2:],
+            hook=_func_path(process_task_result),
+            schedule_type=Schedule.ONCE,
+            next_run=now() + timedelta(seconds=self.DEBOUNCE),
+            q_options={"task_name": task_name},
+            **func_kwargs)
+        self.started = True
+
+    @classmethod
+    def _delay(cls, func, *args, **kwargs):
+        # In certain cases, we don't want to use singleton locking, when:
+        # 1. we want to run synchronously
+        # 2. global django-q settings is set to run as synchronous task
+        # 3. the user especially wants to disable singleton locking
+        async_class = cls
+        if getattr(settings, "HYPERKITTY_DISABLE_SINGLETON_TASKS", False):
+            async_class = AsyncTask
+        # Use a more intuitive task name, if one isn't already set.
+        if "task_name" not in kwargs:
+            kwargs["task_name"] = func.__name__ if callable(func) else func
+        # Create the task.
+        task = async_class(func, *args, **kwargs)
+        return task.run()
 
     @classmethod
     def task(cls, func):
@@ -191,24 +376,42 @@ class SingletonAsync(AsyncTask):
                 # Singleton locking does not work on sync calls because the
                 # lock is placed after the run() call (to have the task id).
                 return func(*args, **kwargs)
-            # Use a more intuitive task name
-            async_class = cls
-            # In certain cases, we don't want to use singleton locking, when:
-            # 1. we want to run synchronously
-            # 2. global django-q settings is set to run as synchronous task
-            # 3. the user especially wants to disable singleton locking
-            if getattr(settings, "HYPERKITTY_DISABLE_SINGLETON_TASKS", False):
-                # Singleton locking does not work on sync calls because the
-                # lock is placed after the run() call (to have the task id).
-                async_class = AsyncTask
-            # Use a more intuitive task name, if one isn't already set.
-            if "task_name" not in kwargs:
-                kwargs["task_name"] = func.__name__ if callable(func) else func
-            # Create the task.
-            task = async_class(func, *args, **kwargs)
-            return task.run()
+            return cls._delay(func, *args, **kwargs)
         # Add a delay method to the function we are going is going to wrap.
         func.delay = delay
+        _TASK_NAMES.append(func.__name__)
+        return func
+
+    @classmethod
+    def batch_task(cls, func):
+        """A decorator that converts a function into a batched async task.
+
+        The decorated function must accept a list of items. Its ``delay()``
+        method takes a single item, which is added to the pending items, and
+        queues a singleton task that will call the function once with all
+        the pending items. This way, many calls in a short time result in a
+        single run.
+
+        The ``mark_dirty()`` method only adds the item to the pending items,
+        without queuing anything: they will be processed by the next call to
+        :py:func:`run_dirty_batches`.
+        """
+        func_path = _func_path(func)
+
+        def delay(item):
+            if Conf.SYNC:
+                return func([item])
+            add_pending(func_path, item)
+            return cls._delay(run_batch, func_path, task_name=func.__name__)
+
+        def mark_dirty(item):
+            if Conf.SYNC:
+                return func([item])
+            add_pending(func_path, item)
+        func.delay = delay
+        func.mark_dirty = mark_dirty
+        _TASK_NAMES.append(func.__name__)
+        _BATCH_TASKS.append(func_path)
         return func
 
 
@@ -252,6 +455,29 @@ def rebuild_mailinglist_cache_for_month(mlist_name, year, month):
     mlist.cached_values["participants_count_for_month"].rebuild(year, month)
 
 
+@SingletonAsync.batch_task
+def rebuild_mailinglists_cache_recent(mlist_names):
+    for mlist in MailingList.objects.filter(name__in=mlist_names):
+        for cached_value in mlist.recent_cached_values:
+            cached_value.rebuild()
+
+
+@SingletonAsync.batch_task
+def rebuild_mailinglists_cache_for_month(months):
+    """
+    Rebuild the monthly cached values of mailing-lists.
+
+    :param months: a list of (mailing-list name, year, month) tuples.
+    """
+    mlists = MailingList.objects.in_bulk(
+        set(month[0] for month in months), field_name="name")
+    for mlist_name, year, month in months:
+        if mlist_name not in mlists:
+            continue
+        mlists[mlist_name].cached_values[
+            "participants_count_for_month"].rebuild(year, month)
+
+
 @SingletonAsync.task
 def rebuild_thread_cache_new_email(thread_id):
     try:
@@ -261,9 +487,24 @@ def rebuild_thread_cache_new_email(thread_id):
             "Cannot rebuild the thread cache: thread %s does not exist.",
             thread_id)
         return
-    for cached_key in ["participants_count", "emails_count"]:
-        thread.cached_values[cached_key].rebuild()
-    # Don't forget the cached template fragment.
+    _rebuild_thread_cache_new_email(thread)
+
+
+@SingletonAsync.batch_task
+def rebuild_threads_cache_new_email(thread_ids):
+    threads = Thread.objects.filter(id__in=thread_ids)
+    for thread in threads:
+        _rebuild_thread_cache_new_email(thread)
+    missing = set(thread_ids) - set(thread.id for thread in threads)
+    if missing:
+        log.warning(
+            "Cannot rebuild the thread cache: threads %s do not exist.",
+            ", ".join(str(thread_id) for thread_id in sorted(missing)))
+
+
+def _rebuild_thread_cache_new_email(thread):
+    # The counters are stored in the thread, only the cached template
+    # fragment must be rebuilt.
     cache.delete(make_template_fragment_key(
         "thread_participants", [thread.id]))
 
@@ -287,6 +528,12 @@ def compute_thread_positions(thread_id):
     compute_thread_order_and_depth(thread)
 
 
+@SingletonAsync.batch_task
+def compute_threads_positions(thread_ids):
+    for thread in Thread.objects.filter(id__in=thread_ids):
+        compute_thread_order_and_depth(thread)
+
+
 @SingletonAsync.task
 def update_from_mailman(mlist_name):
     mlist = MailingList.objects.get(name=mlist_name)
@@ -315,6 +562,16 @@ def check_orphans(email_id):
         log.warning(
             "Cannot check for orphans: email %s does not exist.", email_id)
         return
+    _check_orphans(email)
+
+
+@SingletonAsync.batch_task
+def check_emails_orphans(email_ids):
+    for email in Email.objects.filter(id__in=email_ids):
+        _check_orphans(email)
+
+
+def _check_orphans(email):
     orphans = Email.objects.filter(
             mailinglist=email.mailinglist,
             in_reply_to=email.message_id,
@@ -326,16 +583,3 @@ def check_orphans(email_id):
         )
     for orphan in orphans:
         orphan.set_parent(email)
-
-
-@SingletonAsync.task
-def rebuild_thread_cache_votes(thread_id):
-    thread = Thread.objects.get(id=thread_id)
-    for cached_key in ["votes", "votes_total"]:
-        thread.cached_values[cached_key].rebuild()
-
-
-@SingletonAsync.task
-def rebuild_email_cache_votes(email_id):
-    email = Email.objects.get(id=email_id)
-    email.cached_values["votes"].rebuild()
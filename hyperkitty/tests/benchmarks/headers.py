@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Micro-benchmark of the date and header parsing functions used when archiving.
+
+It runs :py:func:`hyperkitty.lib.utils.parsedate` and
+:py:func:`hyperkitty.lib.utils.header_to_unicode` on a corpus of real-world
+headers, compares the results with the reference implementations (that always
+use dateutil and the email parser), and prints the timings::
+
+    python -m hyperkitty.tests.benchmarks.headers [iterations]
+"""
+
+import os
+import sys
+from datetime import timedelta
+from email.parser import HeaderParser
+from email.policy import default
+from timeit import timeit
+
+import dateutil.parser
+
+
+CORPUS = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    "testdata", "headers-corpus.txt")
+
+
+def get_corpus():
+    """
+    Return the dates and the other headers of the corpus, as two lists.
+    """
+    dates = []
+    headers = []
+    with open(CORPUS, encoding="utf-8") as corpus:
+        for line in corpus:
+            name, value = line.rstrip("\n").split(":", 1)
+            # Only remove the separator space.
+            if value.startswith(" "):
+                value = value[1:]
+            if name == "Date":
+                dates.append(value)
+            else:
+                headers.append(value)
+    return dates, headers
+
+
+def reference_parsedate(datestring):
+    from django.utils import timezone
+    if datestring is None:
+        return None
+    try:
+        parsed = dateutil.parser.parse(datestring)
+    except ValueError:
+        return None
+    try:
+        offset = parsed.utcoffset()
+    except ValueError:
+        offset = None
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    if offset is not None and abs(offset) > timedelta(hours=13):
+        parsed = parsed.astimezone(timezone.utc)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def reference_header_to_unicode(header):
+    return HeaderParser(policy=default).parsestr('dummy: ' + header)['dummy']
+
+
+def same_date(date1, date2):
+    """Compare the dates and their offsets, not only the instants."""
+    if date1 is None or date2 is None:
+        return date1 is date2
+    return (date1 == date2 and date1.utcoffset() == date2.utcoffset())
+
+
+def check(dates, headers):
+    from hyperkitty.lib.utils import header_to_unicode, parsedate
+    errors = []
+    for datestring in dates:
+        if not same_date(parsedate(datestring),
+                         reference_parsedate(datestring)):
+            errors.append(datestring)
+    for header in headers:
+        if header_to_unicode(header) != reference_header_to_unicode(header):
+            errors.append(header)
+    return errors
+
+
+def run(iterations):
+    from hyperkitty.lib.utils import header_to_unicode, parsedate
+    dates, headers = get_corpus()
+    errors = check(dates, headers)
+    if errors:
+        print("Different results for:")
+        for error in errors:
+            print("  %r" % error)
+        return 1
+    print("%d dates and %d headers, %d iterations, identical results."
+          % (len(dates), len(headers), iterations))
+    for name, func, ref_func, values in (
+            ("parsedate", parsedate, reference_parsedate, dates),
+            ("header_to_unicode", header_to_unicode,
+             reference_header_to_unicode, headers)):
+        durations = []
+        for f in (ref_func, func):
+            durations.append(timeit(
+                lambda: [f(value) for value in values], number=iterations))
+        print("%-18s reference: %.3fs  current: %.3fs  speedup: x%.1f"
+              % (name, durations[0], durations[1],
+                 durations[0] / durations[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "hyperkitty.tests.settings_test")
+    import django
+    django.setup()
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    sys.exit(run(iterations))
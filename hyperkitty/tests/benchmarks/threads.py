@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Benchmark of the thread structure computation.
+
+It runs :py:func:`hyperkitty.lib.analysis.get_thread_positions` on synthetic
+threads of 10000 messages or more (a flat thread, a single chain of replies,
+and random reply trees), and prints the timings::
+
+    python -m hyperkitty.tests.benchmarks.threads [size]
+
+If networkx is installed, the results are also compared with the former
+implementation, on smaller threads because it is quadratic.
+"""
+
+import os
+import random
+import sys
+from time import perf_counter
+
+
+def make_threads(size):
+    """
+    Return the synthetic threads as lists of ``(id, parent_id)`` tuples,
+    ordered by date, in a dict indexed by the thread shape.
+    """
+    rand = random.Random(42)
+    return {
+        "flat": [(1, None)] + [(num, 1) for num in range(2, size + 1)],
+        "chain": [(1, None)] + [
+            (num, num - 1) for num in range(2, size + 1)],
+        "random": [(1, None)] + [
+            (num, rand.randint(1, num - 1)) for num in range(2, size + 1)],
+        # Replies to later messages create reply loops.
+        "loops": [(1, None)] + [
+            (num, rand.randint(1, size)) for num in range(2, size + 1)],
+        }
+
+
+def reference_positions(emails, starting_email_id):
+    # The networkx-based algorithm used until HyperKitty 1.3.
+    import networkx as nx
+    graph = nx.DiGraph()
+    positions = {}
+    for index, (email_id, parent_id) in enumerate(emails):
+        graph.add_node(email_id, num=index)
+    for email_id, parent_id in emails:
+        if parent_id is not None:
+            graph.add_edge(parent_id, email_id)
+            if not nx.is_directed_acyclic_graph(graph):
+                graph.remove_edge(parent_id, email_id)
+    stack = [(starting_email_id, 0)]
+    while stack:
+        email_id, depth = stack.pop()
+        positions[email_id] = (len(positions), depth)
+        successors = sorted(graph.successors(email_id),
+                            key=lambda m: graph.nodes[m]["num"])
+        stack.extend((succ, depth + 1) for succ in reversed(successors))
+    return positions
+
+
+def timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def run(size):
+    from hyperkitty.lib.analysis import get_thread_positions
+    try:
+        import networkx  # noqa: F401
+    except ImportError:
+        reference_size = None
+    else:
+        reference_size = min(size, 500)
+    if reference_size is not None:
+        for name, emails in make_threads(reference_size).items():
+            reference, ref_duration = timed(reference_positions, emails, 1)
+            positions, duration = timed(get_thread_positions, emails, 1)
+            if positions != reference:
+                print("Different results for the %s thread" % name)
+                return 1
+            print("%-6s %6d messages  reference: %.3fs  current: %.3fs  "
+                  "speedup: x%.1f" % (
+                      name, reference_size, ref_duration, duration,
+                      ref_duration / duration))
+    for name, emails in make_threads(size).items():
+        positions, duration = timed(get_thread_positions, emails, 1)
+        print("%-6s %6d messages  current: %.3fs  (%d reachable)"
+              % (name, size, duration, len(positions)))
+    return 0
+
+
+if __name__ == "__main__":
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "hyperkitty.tests.settings_test")
+    import django
+    django.setup()
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sys.exit(run(size))
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import json
 import os.path
 import mailbox
 from email.message import EmailMessage
-from email import message_from_file
+from email import message_from_file, message_from_bytes
 from io import StringIO
 from datetime import datetime
 from unittest import SkipTest
@@ -12,12 +14,14 @@ from traceback import format_exc
 from mock import patch, Mock
 from django.conf import settings
 from django.core.management import call_command
-from django.db import DEFAULT_DB_ALIAS
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, DataError, DatabaseError
 from django.utils.timezone import utc
 
 from hyperkitty.management.commands.hyperkitty_import import Command
-from hyperkitty.lib.incoming import add_to_list
-from hyperkitty.models import MailingList, Email
+from hyperkitty.lib.incoming import (
+    add_to_list, add_parsed_to_list, clear_caches)
+from hyperkitty.models import MailingList, Email, Thread
 from hyperkitty.tests.utils import TestCase, get_test_file
 
 
@@ -33,6 +37,13 @@ class CommandTestCase(TestCase):
     def tearDown(self):
         settings.HYPERKITTY_BATCH_MODE = False
 
+    def _get_computed_threads(self, mock_compute):
+        thread_ids = []
+        for call in mock_compute.call_args_list:
+            thread_ids.extend(call[0][0])
+        self.assertEqual(len(thread_ids), len(set(thread_ids)))
+        return list(Thread.objects.filter(id__in=thread_ids))
+
     def test_impacted_threads(self):
         # existing message
         msg1 = EmailMessage()
@@ -53,16 +64,38 @@ class CommandTestCase(TestCase):
         # do the import
         output = StringIO()
         with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
+                   ".compute_threads_order_and_depth") as mock_compute:
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
-        self.assertEqual(mock_compute.call_count, 1)
-        thread = mock_compute.call_args[0][0]
+        threads = self._get_computed_threads(mock_compute)
+        self.assertEqual(len(threads), 1)
+        thread = threads[0]
         self.assertEqual(thread.emails.count(), 1)
         self.assertEqual(thread.starting_email.message_id, "msg2")
 
+    def test_counters(self):
+        # The thread counters are computed at the end of the import.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for num in range(1, 4):
+            msg = EmailMessage()
+            msg["From"] = "dummy%d@example.com" % (num % 2)
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Date"] = "01 Feb 2015 12:0%d:00" % num
+            if num > 1:
+                msg["In-Reply-To"] = "<msg1>"
+            msg.set_payload("msg%d" % num)
+            mbox.add(msg)
+        mbox.close()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 3)
+        self.assertEqual(thread.participants_count, 2)
+
     def test_since_auto(self):
         # When there's mail already and the "since" option is not used, it
         # defaults to the last email's date
@@ -394,15 +427,366 @@ class CommandTestCase(TestCase):
         # do the import
         output = StringIO()
         with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
+                   ".compute_threads_order_and_depth") as mock_compute:
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
         called_thread_ids = set([
-            call[0][0].starting_email.message_id
-            for call in mock_compute.call_args_list
+            thread.starting_email.message_id
+            for thread in self._get_computed_threads(mock_compute)
             ])
         self.assertEqual(
             called_thread_ids,
             set([("msg%d" % i) for i in range(250)]))
+
+    def test_known_duplicate(self):
+        # Known duplicates are skipped before being parsed.
+        msg1 = EmailMessage()
+        msg1["From"] = "dummy@example.com"
+        msg1["Message-ID"] = "<msg1>"
+        msg1["Date"] = "01 Jan 2015 12:00:00"
+        msg1.set_payload("msg1")
+        add_to_list("list@example.com", msg1)
+        clear_caches()
+        msg2 = EmailMessage()
+        msg2["From"] = "dummy@example.com"
+        msg2["Message-ID"] = "<msg2>"
+        msg2["Date"] = "01 Feb 2015 12:00:00"
+        msg2.set_payload("msg2")
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.add(msg1)
+        mbox.add(msg2)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".message_from_bytes",
+                   side_effect=message_from_bytes) as mfb:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(mfb.call_count, 1)
+        self.assertIn("Duplicate email with message-id 'msg1'",
+                      output.getvalue())
+        self.assertEqual(Email.objects.count(), 2)
+
+    def _make_threads_mbox(self, count, thread_length):
+        # Each thread spans several import batches.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(count):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            if i % thread_length:
+                msg["In-Reply-To"] = "<msg%d>" % (i - 1)
+            msg["Date"] = "01 Jan 2015 12:00:00"
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+
+    def test_parallel(self):
+        self._make_threads_mbox(250, 7)
+        output = StringIO()
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".compute_threads_order_and_depth") as mock_compute:
+            kw = self.common_cmd_args.copy()
+            kw["stdout"] = kw["stderr"] = output
+            kw["jobs"] = 2
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(Email.objects.count(), 250)
+        for email in Email.objects.all():
+            num = int(email.message_id[3:])
+            if num % 7:
+                self.assertEqual(email.parent.message_id,
+                                 "msg%d" % (num - 1))
+            else:
+                self.assertIsNone(email.parent)
+            self.assertEqual(email.thread.starting_email.message_id,
+                             "msg%d" % (num - num % 7))
+        called_thread_ids = set([
+            thread.starting_email.message_id
+            for thread in self._get_computed_threads(mock_compute)
+            ])
+        self.assertEqual(
+            called_thread_ids,
+            set([("msg%d" % i) for i in range(0, 250, 7)]))
+
+    def test_parallel_errors(self):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg["Date"] = "01 Jan 2015 12:00:00"
+        msg.set_payload("msg1")
+        mbox.add(msg)
+        mbox.add(msg)
+        msg = EmailMessage()
+        msg["From"] = "Dummy <dümmy@example.com>"
+        msg["Message-ID"] = "<msg2>"
+        msg["Date"] = "01 Jan 2015 12:00:00"
+        msg.set_payload("msg2")
+        mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["jobs"] = 2
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertIn("Duplicate email with message-id 'msg1'",
+                      output.getvalue())
+        self.assertIn("Failed adding message <msg2>", output.getvalue())
+        self.assertIn("Non-ascii sender address from Dummy",
+                      output.getvalue())
+
+    def test_parallel_known_duplicate(self):
+        # Known duplicates are not sent to the workers.
+        msg1 = EmailMessage()
+        msg1["From"] = "dummy@example.com"
+        msg1["Message-ID"] = "<msg1>"
+        msg1["Date"] = "01 Jan 2015 12:00:00"
+        msg1.set_payload("msg1")
+        add_to_list("list@example.com", msg1)
+        clear_caches()
+        msg2 = EmailMessage()
+        msg2["From"] = "dummy@example.com"
+        msg2["Message-ID"] = "<msg2>"
+        msg2["Date"] = "01 Feb 2015 12:00:00"
+        msg2.set_payload("msg2")
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.add(msg1)
+        mbox.add(msg2)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["jobs"] = 2
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_parsed_to_list",
+                   side_effect=add_parsed_to_list) as aptl:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        stored = [parsed.message_id for call in aptl.call_args_list
+                  for parsed in call[0][1]]
+        self.assertEqual(stored, ["msg2"])
+        self.assertIn("Duplicate email with message-id 'msg1'",
+                      output.getvalue())
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_parallel_database_error(self):
+        # A database error only skips the failing message of the batch.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for num in range(1, 4):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Date"] = "01 Jan 2015 12:00:00"
+            msg.set_payload("msg%d" % num)
+            mbox.add(msg)
+        mbox.close()
+
+        def failing_add(list_address, batch):
+            if "msg2" in [parsed.message_id for parsed in batch]:
+                raise DatabaseError("msg2")
+            return add_parsed_to_list(list_address, batch)
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["jobs"] = 2
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_parsed_to_list", side_effect=failing_add):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["msg1", "msg3"])
+        self.assertIn("Message msg2 failed to import, skipping",
+                      output.getvalue())
+        self.assertNotIn("Message msg1 failed", output.getvalue())
+
+    def test_jobs_invalid(self):
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["jobs"] = 0
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.close()
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+
+    def test_compressed(self):
+        self._make_threads_mbox(10, 3)
+        mbox_path = os.path.join(self.tmpdir, "test.mbox")
+        with open(mbox_path, "rb") as mbox_file:
+            with gzip.open(mbox_path + ".gz", "wb") as gz_file:
+                gz_file.write(mbox_file.read())
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import', mbox_path + ".gz", **kw)
+        self.assertEqual(Email.objects.count(), 10)
+        self.assertEqual(
+            Email.objects.get(message_id="msg2").parent.message_id, "msg1")
+        # The number of messages is not known in advance.
+        self.assertIn("<msg9> (9)\n", output.getvalue())
+
+    def _crash_import(self, count, crash_at, **options):
+        # Interrupt an import at the given message.
+        self._make_threads_mbox(count, 3)
+
+        def _add_to_list(list_name, message):
+            if message["Message-Id"] == "<msg%d>" % crash_at:
+                raise RuntimeError("Interrupted")
+            return add_to_list(list_name, message)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw.update(options)
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_to_list", side_effect=_add_to_list):
+            self.assertRaises(
+                RuntimeError, call_command, 'hyperkitty_import',
+                os.path.join(self.tmpdir, "test.mbox"), **kw)
+
+    def test_checkpoint(self):
+        self._crash_import(10, 5, checkpoint_every=2)
+        checkpoint_path = os.path.join(self.tmpdir, "test.mbox.checkpoint")
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.assertEqual(checkpoint["list_address"], "list@example.com")
+        self.assertEqual(checkpoint["path"],
+                         os.path.join(self.tmpdir, "test.mbox"))
+        self.assertEqual(checkpoint["count"], 4)
+        self.assertEqual(checkpoint["message_id"], "<msg3>")
+        # The thread ids are only appended once.
+        with open(checkpoint_path + ".threads") as threads_file:
+            thread_ids = [int(line) for line in threads_file]
+        self.assertEqual(
+            sorted(thread_ids),
+            sorted(Thread.objects.values_list("id", flat=True)))
+
+    def test_resume(self):
+        self._crash_import(10, 5, checkpoint_every=2)
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["resume"] = True
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_to_list", side_effect=add_to_list) as atl, \
+                patch("hyperkitty.management.commands.hyperkitty_import"
+                      ".compute_threads_order_and_depth") as mock_compute:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("Resuming after message <msg3> (4 messages read)",
+                      output.getvalue())
+        # The messages before the checkpoint are not read again.
+        self.assertEqual(atl.call_count, 6)
+        self.assertEqual(Email.objects.count(), 10)
+        # The threads of the first run are also computed.
+        called_thread_ids = set([
+            thread.starting_email.message_id
+            for thread in self._get_computed_threads(mock_compute)
+            ])
+        self.assertEqual(called_thread_ids,
+                         set(["msg0", "msg3", "msg6", "msg9"]))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, "test.mbox.checkpoint")))
+
+    def test_resume_parallel(self):
+        self._crash_import(10, 5, checkpoint_every=2)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["resume"] = True
+        kw["jobs"] = 2
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(Email.objects.count(), 10)
+        self.assertEqual(
+            Email.objects.get(message_id="msg5").parent.message_id, "msg4")
+
+    def test_resume_threads(self):
+        # The import was interrupted while computing the thread structure.
+        self._make_threads_mbox(6, 3)
+        mbox_path = os.path.join(self.tmpdir, "test.mbox")
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        call_command('hyperkitty_import', mbox_path, **kw)
+        first_thread = Email.objects.get(message_id="msg0").thread
+        thread = Email.objects.get(message_id="msg3").thread
+        with open(mbox_path + ".checkpoint", "w") as checkpoint_file:
+            json.dump({
+                "list_address": "list@example.com",
+                "mbox": [mbox_path],
+                "done": [mbox_path],
+                "stage": "threads",
+                "threads_done_up_to": first_thread.id,
+            }, checkpoint_file)
+        with open(mbox_path + ".checkpoint.threads", "w") as threads_file:
+            # The last line was not completely written.
+            threads_file.write("%d\n%d\n12" % (first_thread.id, thread.id))
+        kw["resume"] = True
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".compute_threads_order_and_depth") as mock_compute, \
+                patch("hyperkitty.management.commands.hyperkitty_import"
+                      ".add_to_list") as atl:
+            call_command('hyperkitty_import', mbox_path, **kw)
+        self.assertFalse(atl.called)
+        self.assertEqual(
+            self._get_computed_threads(mock_compute), [thread])
+        self.assertFalse(os.path.exists(mbox_path + ".checkpoint.threads"))
+
+    def test_resume_no_checkpoint(self):
+        self._make_threads_mbox(1, 1)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["resume"] = True
+        self.assertRaises(
+            CommandError, call_command, 'hyperkitty_import',
+            os.path.join(self.tmpdir, "test.mbox"), **kw)
+
+    def test_resume_other_list(self):
+        self._crash_import(10, 5, checkpoint_every=2)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["resume"] = True
+        kw["list_address"] = "other@example.com"
+        with self.assertRaises(CommandError) as cm:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("is for another import", str(cm.exception))
+
+    def test_commit_every(self):
+        # A bad message does not roll back the other messages of its
+        # transaction.
+        self._make_threads_mbox(7, 3)
+
+        def _add_to_list(list_name, message):
+            result = add_to_list(list_name, message)
+            if message["Message-Id"] == "<msg4>":
+                raise DataError("test error")
+            return result
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["commit_every"] = 3
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_to_list", side_effect=_add_to_list):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("Message msg4 failed to import, skipping",
+                      output.getvalue())
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["msg0", "msg1", "msg2", "msg3", "msg5", "msg6"])
+
+    def test_commit_every_checkpoint(self):
+        # The checkpoint only covers the committed messages.
+        self._crash_import(10, 5, checkpoint_every=1, commit_every=3)
+        self.assertEqual(Email.objects.count(), 3)
+        checkpoint_path = os.path.join(self.tmpdir, "test.mbox.checkpoint")
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.assertEqual(checkpoint["count"], 3)
+        self.assertEqual(checkpoint["message_id"], "<msg2>")
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import timedelta
+from email.message import EmailMessage
+
+from django.core.cache import cache
+from django.utils.timezone import now
+from mock import patch
+
+from hyperkitty.jobs.orphan_emails import (
+    Job, LAST_ID_KEY, LAST_ID_MARGIN, get_orphans)
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+class OrphanEmailsTestCase(TestCase):
+
+    def setUp(self):
+        # Don't reattach the orphans as soon as their parent arrives.
+        self.patcher = patch("hyperkitty.tasks.check_emails_orphans")
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def _add(self, msgid, in_reply_to=None, list_name="list@example.com"):
+        msg = EmailMessage()
+        msg["From"] = "sender@example.com"
+        msg["Message-ID"] = "<%s>" % msgid
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<%s>" % in_reply_to
+        msg.set_payload("dummy message")
+        add_to_list(list_name, msg)
+        return Email.objects.get(
+            mailinglist__name=list_name, message_id=msgid)
+
+    def test_get_orphans(self):
+        reply = self._add("msg2", in_reply_to="msg1")
+        self._add("msg3", in_reply_to="unknown")
+        self._add("msg4", in_reply_to="msg4")
+        self.assertEqual(list(get_orphans()), [])
+        parent = self._add("msg1")
+        # In another list
+        self._add("unknown", list_name="other@example.com")
+        self.assertEqual(list(get_orphans()), [(reply.id, parent.id)])
+
+    def test_after_id(self):
+        reply = self._add("msg2", in_reply_to="msg1")
+        parent = self._add("msg1")
+        self.assertEqual(
+            list(get_orphans(after_id=reply.id - 1)),
+            [(reply.id, parent.id)])
+        self.assertEqual(list(get_orphans(after_id=parent.id)), [])
+        # Only the parent is new.
+        self.assertEqual(
+            list(get_orphans(after_id=reply.id)), [(reply.id, parent.id)])
+        # Ignore the emails after the upper bound.
+        self.assertEqual(list(get_orphans(up_to_id=reply.id)), [])
+
+    def test_after_id_only_orphan_new(self):
+        parent = self._add("msg0")
+        reply = self._add("msg2", in_reply_to="msg1")
+        # Make it the parent after the reply has been archived.
+        Email.objects.filter(id=parent.id).update(message_id="msg1")
+        self.assertEqual(
+            list(get_orphans(after_id=parent.id)), [(reply.id, parent.id)])
+
+    def test_execute(self):
+        self._add("msg2", in_reply_to="msg1")
+        self._add("msg3", in_reply_to="msg2")
+        self._add("msg1")
+        Job().execute()
+        emails = dict(Email.objects.values_list("message_id", "parent_id"))
+        ids = dict(Email.objects.values_list("message_id", "id"))
+        self.assertEqual(emails, {
+            "msg1": None, "msg2": ids["msg1"], "msg3": ids["msg2"]})
+        self.assertEqual(
+            Email.objects.values("thread_id").distinct().count(), 1)
+        self.assertEqual(
+            cache.get(LAST_ID_KEY), max(ids["msg1"] - LAST_ID_MARGIN, 0))
+
+    def test_execute_after_id(self):
+        self._add("msg2", in_reply_to="msg1")
+        parent = self._add("msg1")
+        cache.set(LAST_ID_KEY, parent.id)
+        Job().execute()
+        self.assertIsNone(Email.objects.get(message_id="msg2").parent_id)
+
+    def test_execute_imported_parent(self):
+        # Imported emails have old archival dates, they must still be found.
+        self._add("msg2", in_reply_to="msg1")
+        cache.set(LAST_ID_KEY, Email.objects.get().id)
+        parent = self._add("msg1")
+        Email.objects.filter(id=parent.id).update(
+            archived_date=now() - timedelta(days=3650))
+        Job().execute()
+        self.assertEqual(
+            Email.objects.get(message_id="msg2").parent_id, parent.id)
+
+    def test_execute_error(self):
+        # An error on one pair does not prevent the other ones from being
+        # processed.
+        self._add("msg2", in_reply_to="msg1")
+        self._add("msg4", in_reply_to="msg3")
+        self._add("msg1")
+        self._add("msg3")
+        set_parent = Email.set_parent
+
+        def failing_set_parent(email, parent):
+            if email.message_id == "msg2":
+                raise ValueError("fail")
+            return set_parent(email, parent)
+        with patch.object(Email, "set_parent", failing_set_parent), \
+                patch("hyperkitty.jobs.orphan_emails.log") as log:
+            Job().execute()
+        self.assertTrue(log.exception.called)
+        emails = dict(Email.objects.values_list("message_id", "parent_id"))
+        ids = dict(Email.objects.values_list("message_id", "id"))
+        self.assertIsNone(emails["msg2"])
+        self.assertEqual(emails["msg4"], ids["msg3"])
+        self.assertIsNotNone(cache.get(LAST_ID_KEY))
@@ -20,13 +20,20 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from datetime import timedelta
 from email.message import EmailMessage
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import int_to_base36
 from django.utils.timezone import now
+from mock import patch
 
 from hyperkitty.models import MailingList, Email, Thread, Sender
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, compute_threads_order_and_depth,
+    get_thread_path, get_thread_positions, insert_email_position)
+from hyperkitty.lib.incoming import add_many_to_list, add_to_list
 from hyperkitty.tests.utils import TestCase
 
 
@@ -187,3 +194,228 @@ class TestThreadOrderDepth(TestCase):
         msg1.save()
         compute_thread_order_and_depth(thread)
         # Don't traceback with a "maximum recursion depth exceeded" error
+
+
+class TestThreadPositions(TestCase):
+
+    def test_classical_thread(self):
+        # 1
+        # |-2
+        # | `-4
+        # `-3
+        positions = get_thread_positions(
+            [(1, None), (2, 1), (3, 1), (4, 2)], 1)
+        self.assertEqual(
+            positions, {1: (0, 0), 2: (1, 1), 4: (2, 2), 3: (3, 1)})
+
+    def test_children_by_date(self):
+        # The emails are given in date order, whatever their ids.
+        positions = get_thread_positions([(1, None), (3, 1), (2, 1)], 1)
+        self.assertEqual(positions, {1: (0, 0), 3: (1, 1), 2: (2, 1)})
+
+    def test_reply_loops(self):
+        positions = get_thread_positions([(1, 1)], 1)
+        self.assertEqual(positions, {1: (0, 0)})
+        positions = get_thread_positions([(1, 3), (2, 1), (3, 2)], 1)
+        self.assertEqual(positions, {1: (0, 0), 2: (1, 1)})
+
+    def test_unreachable(self):
+        positions = get_thread_positions([(1, None), (2, 3), (3, 2)], 1)
+        self.assertEqual(positions, {1: (0, 0)})
+
+    def test_deep_thread(self):
+        # Don't traceback with a "maximum recursion depth exceeded" error
+        emails = [(1, None)] + [(num, num - 1) for num in range(2, 5001)]
+        positions = get_thread_positions(emails, 1)
+        self.assertEqual(positions[5000], (4999, 4999))
+
+
+class ThreadTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        self.sender = Sender.objects.create(address="sender@example.com")
+        self.date = now()
+
+    def make_thread(self, name, parents):
+        # The parents list contains the index of each email's parent.
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id=name)
+        emails = []
+        for index, parent in enumerate(parents):
+            email = Email.objects.create(
+                mailinglist=self.mlist, thread=thread, sender=self.sender,
+                message_id="%s-%d" % (name, index), subject=name,
+                content="message %d" % index, timezone=0,
+                date=self.date + timedelta(minutes=index),
+                parent=emails[parent] if parent is not None else None,
+                thread_order=42, thread_depth=42)
+            emails.append(email)
+        thread.starting_email = emails[0]
+        thread.save()
+        return thread
+
+    def get_positions(self, thread):
+        return list(thread.emails.order_by("date").values_list(
+            "thread_order", "thread_depth"))
+
+
+class TestThreadsOrderDepth(ThreadTestCase):
+
+    def test_same_as_single_thread(self):
+        parents = [None, 0, 0, 1, 3, 2, 1, 6]
+        thread1 = self.make_thread("thread1", parents)
+        thread2 = self.make_thread("thread2", parents)
+        compute_thread_order_and_depth(thread1)
+        compute_threads_order_and_depth([thread2.id])
+        self.assertEqual(
+            self.get_positions(thread1), self.get_positions(thread2))
+
+    def test_many_threads(self):
+        threads = [self.make_thread("thread%d" % num, [None, 0, 1, 0])
+                   for num in range(5)]
+        compute_threads_order_and_depth(
+            [thread.id for thread in threads], batch_size=2)
+        for thread in threads:
+            self.assertEqual(self.get_positions(thread),
+                             [(0, 0), (1, 1), (2, 2), (3, 1)])
+
+    def test_only_changed(self):
+        thread = self.make_thread("thread", [None, 0, 1])
+        compute_threads_order_and_depth([thread.id])
+        with CaptureQueriesContext(connection) as queries:
+            compute_threads_order_and_depth([thread.id])
+        self.assertFalse([q for q in queries.captured_queries
+                          if q["sql"].startswith("UPDATE")])
+        thread.emails.filter(message_id="thread-2").update(thread_depth=42)
+        with CaptureQueriesContext(connection) as queries:
+            compute_threads_order_and_depth([thread.id])
+        updates = [q["sql"] for q in queries.captured_queries
+                   if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.get_positions(thread),
+                         [(0, 0), (1, 1), (2, 2)])
+
+    def test_thread_path(self):
+        thread = self.make_thread("thread", [None, 0, 1, 0])
+        thread.emails.update(thread_path=None)
+        compute_threads_order_and_depth([thread.id])
+        ids = [int_to_base36(email_id) for email_id in
+               thread.emails.order_by("date").values_list("id", flat=True)]
+        self.assertEqual(
+            list(thread.emails.order_by("date").values_list(
+                "thread_path", flat=True)),
+            ["%s." % ids[0], "%s.%s." % (ids[0], ids[1]),
+             "%s.%s.%s." % (ids[0], ids[1], ids[2]),
+             "%s.%s." % (ids[0], ids[3])])
+
+    def test_thread_path_too_long(self):
+        self.assertIsNone(get_thread_path("1." * 127, 42))
+        self.assertIsNone(get_thread_path(None, 42))
+        self.assertEqual(get_thread_path("", 42), "16.")
+
+    def test_query_count(self):
+        threads = [self.make_thread("thread%d" % num, [None, 0, 0, 2])
+                   for num in range(10)]
+        Email.objects.update(thread_order=42, thread_depth=42)
+        # Two reads and one update, whatever the number of threads.
+        with CaptureQueriesContext(connection) as queries:
+            compute_threads_order_and_depth([t.id for t in threads])
+        self.assertEqual(len([
+            q for q in queries.captured_queries
+            if q["sql"].startswith(("SELECT", "UPDATE"))]), 3)
+
+    def test_single_thread(self):
+        thread = self.make_thread("thread", [None, 0, 1, 0])
+        thread.emails.update(thread_order=42, thread_depth=42)
+        thread.emails.filter(message_id="thread-0").update(
+            thread_order=0, thread_depth=0)
+        with CaptureQueriesContext(connection) as queries:
+            compute_thread_order_and_depth(thread)
+        updates = [q["sql"] for q in queries.captured_queries
+                   if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        # The starting email was already in place.
+        updated_ids = updates[0].rsplit("IN (", 1)[1].rstrip(")").split(",")
+        self.assertEqual(len(updated_ids), 3)
+        self.assertEqual(self.get_positions(thread),
+                         [(0, 0), (1, 1), (2, 2), (3, 1)])
+
+
+class TestInsertEmailPosition(ThreadTestCase):
+
+    def add_reply(self, thread, parent_id, minutes):
+        return Email.objects.create(
+            mailinglist=self.mlist, thread=thread, sender=self.sender,
+            message_id="reply-%d" % minutes, subject="reply",
+            content="reply", timezone=0,
+            date=self.date + timedelta(minutes=minutes),
+            parent=thread.emails.get(message_id=parent_id))
+
+    def assertFullyComputed(self, thread):
+        positions = self.get_positions(thread)
+        paths = list(thread.emails.order_by("date").values_list(
+            "thread_path", flat=True))
+        thread.emails.update(
+            thread_order=None, thread_depth=0, thread_path=None)
+        compute_thread_order_and_depth(thread)
+        self.assertEqual(positions, self.get_positions(thread))
+        self.assertEqual(paths, list(thread.emails.order_by(
+            "date").values_list("thread_path", flat=True)))
+
+    def test_new_thread(self):
+        thread = self.make_thread("thread", [None, 0, 0, 1, 3, 2, 1, 6, 0])
+        self.assertEqual(self.get_positions(thread)[0], (0, 0))
+        self.assertFullyComputed(thread)
+
+    def test_last_reply(self):
+        thread = self.make_thread("thread", [None, 0, 1, 0])
+        with patch("hyperkitty.tasks.compute_threads_positions") as ctp:
+            reply = self.add_reply(thread, "thread-1", 10)
+        self.assertFalse(ctp.mark_dirty.called)
+        self.assertEqual((reply.thread_order, reply.thread_depth), (3, 2))
+        self.assertFullyComputed(thread)
+
+    def test_older_reply(self):
+        # The reply is older than the other replies to its parent.
+        thread = self.make_thread("thread", [None, 0, 1, 0, 1])
+        reply = self.add_reply(thread, "thread-0", 0)
+        self.assertEqual((reply.thread_order, reply.thread_depth), (1, 1))
+        self.assertFullyComputed(thread)
+        reply = self.add_reply(thread, "thread-1", 3)
+        self.assertEqual((reply.thread_order, reply.thread_depth), (4, 2))
+        self.assertFullyComputed(thread)
+
+    def test_unpositioned_thread(self):
+        thread = self.make_thread("thread", [None, 0, 1])
+        thread.emails.filter(message_id="thread-2").update(thread_order=None)
+        with patch("hyperkitty.tasks.compute_threads_positions") as ctp:
+            self.add_reply(thread, "thread-1", 10)
+        ctp.mark_dirty.assert_called_with(thread.id)
+
+    def test_has_replies(self):
+        thread = self.make_thread("thread", [None, 0, 1])
+        email = thread.emails.get(message_id="thread-1")
+        self.assertFalse(insert_email_position(email))
+        self.assertTrue(insert_email_position(
+            email, [thread.emails.get(message_id="thread-2").id]))
+
+    def test_batch(self):
+        msgs = []
+        for num in range(1, 5):
+            msg = EmailMessage()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Date"] = "Mon, 0%d Jan 2018 00:00:00 +0000" % num
+            msg.set_payload("message %d" % num)
+            msgs.append(msg)
+        msgs[1]["In-Reply-To"] = "<msg1>"
+        msgs[2]["In-Reply-To"] = "<msg1>"
+        msgs[3]["In-Reply-To"] = "<msg2>"
+        with patch("hyperkitty.tasks.compute_threads_positions") as ctp:
+            add_many_to_list("example-list", msgs)
+        self.assertFalse(ctp.mark_dirty.called)
+        thread = Thread.objects.get(thread_id=Email.objects.get(
+            message_id="msg1").thread.thread_id)
+        self.assertEqual(self.get_positions(thread),
+                         [(0, 0), (1, 1), (3, 1), (2, 2)])
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+from email.message import EmailMessage
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.lib.counters import get_vote_changes, update_counters
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Email, Thread
+from hyperkitty.tests.utils import TestCase
+
+
+def _add_email(num, sender, reply_to=None, list_name="example-list"):
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["Message-ID"] = "<msg%d>" % num
+    if reply_to is not None:
+        msg["In-Reply-To"] = "<msg%d>" % reply_to
+    msg.set_payload("message %d" % num)
+    add_to_list(list_name, msg)
+    return Email.objects.get(message_id="msg%d" % num)
+
+
+class VoteChangesTestCase(TestCase):
+
+    def test_changes(self):
+        self.assertEqual(get_vote_changes(None, 1),
+                         {"likes": 1, "dislikes": 0})
+        self.assertEqual(get_vote_changes(1, -1),
+                         {"likes": -1, "dislikes": 1})
+        self.assertEqual(get_vote_changes(-1, None),
+                         {"likes": 0, "dislikes": -1})
+        self.assertEqual(get_vote_changes(1, 1),
+                         {"likes": 0, "dislikes": 0})
+
+
+class CountersTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="dummy")
+        self.email1 = _add_email(1, "sender1@example.com")
+        self.email2 = _add_email(2, "sender2@example.com", reply_to=1)
+        self.email3 = _add_email(3, "sender1@example.com", reply_to=2)
+
+    def _get_counters(self, thread_id=None):
+        if thread_id is None:
+            thread_id = self.email1.thread_id
+        thread = Thread.objects.get(id=thread_id)
+        return (thread.emails_count, thread.participants_count,
+                thread.likes, thread.dislikes, thread.votes_total)
+
+    def test_new_emails(self):
+        self.assertEqual(self._get_counters(), (3, 2, 0, 0, 0))
+
+    def test_deleted_email(self):
+        # sender1 has another email in the thread.
+        self.email3.delete()
+        self.assertEqual(self._get_counters(), (2, 2, 0, 0, 0))
+        Email.objects.get(id=self.email2.id).delete()
+        self.assertEqual(self._get_counters(), (1, 1, 0, 0, 0))
+
+    def test_votes(self):
+        other_user = User.objects.create(username="other")
+        self.email1.vote(1, self.user)
+        self.email2.vote(1, other_user)
+        self.assertEqual(self._get_counters(), (3, 2, 2, 0, 2))
+        self.email1.vote(-1, self.user)
+        self.assertEqual(self._get_counters(), (3, 2, 1, 1, 0))
+        self.assertEqual(self.email1.get_votes(), {
+            "likes": 0, "dislikes": 1, "status": "neutral"})
+        self.email1.vote(0, self.user)
+        self.assertEqual(self._get_counters(), (3, 2, 1, 0, 1))
+        self.assertEqual(self.email1.get_votes()["dislikes"], 0)
+        # The votes of a deleted email are removed from the thread.
+        Email.objects.get(id=self.email2.id).delete()
+        self.assertEqual(self._get_counters(), (2, 1, 0, 0, 0))
+
+    def test_save_keeps_counters(self):
+        thread = Thread.objects.get(id=self.email1.thread_id)
+        _add_email(4, "sender4@example.com", reply_to=1)
+        thread.save()
+        self.assertEqual(self._get_counters(), (4, 3, 0, 0, 0))
+
+    def test_set_parent(self):
+        email4 = _add_email(4, "sender4@example.com")
+        email4.vote(1, self.user)
+        former_thread_id = email4.thread_id
+        email5 = _add_email(5, "sender5@example.com", reply_to=4)
+        email6 = _add_email(6, "sender6@example.com")
+        email5.set_parent(self.email3)
+        self.assertEqual(self._get_counters(), (4, 3, 0, 0, 0))
+        self.assertEqual(self._get_counters(former_thread_id),
+                         (1, 1, 1, 0, 1))
+        email6.set_parent(self.email3)
+        self.assertEqual(self._get_counters(), (5, 4, 0, 0, 0))
+
+    def test_update_counters(self):
+        self.email1.vote(1, self.user)
+        thread_id = self.email1.thread_id
+        Thread.objects.update(emails_count=42, likes=0, votes_total=0)
+        Email.objects.filter(id=self.email2.id).update(dislikes=3)
+        self.assertEqual(update_counters([thread_id]), (1, 1))
+        self.assertEqual(self._get_counters(), (3, 2, 1, 0, 1))
+        self.assertEqual(
+            list(Email.objects.order_by("id").values_list(
+                "likes", "dislikes")),
+            [(1, 0), (0, 0), (0, 0)])
+        # Nothing to fix anymore.
+        self.assertEqual(update_counters([thread_id]), (0, 0))
+
+    def test_command(self):
+        other_email = _add_email(4, "sender4@example.com",
+                                 list_name="other-list")
+        Thread.objects.update(emails_count=0)
+        output = StringIO()
+        call_command("hyperkitty_update_counters", "example-list",
+                     stdout=output)
+        self.assertEqual(output.getvalue().strip(),
+                         "Fixed the counters of 1 threads and 0 emails")
+        self.assertEqual(self._get_counters()[0], 3)
+        self.assertEqual(self._get_counters(other_email.thread_id)[0], 0)
+        call_command("hyperkitty_update_counters", stdout=output)
+        self.assertEqual(self._get_counters(other_email.thread_id)[0], 1)
+        with self.assertRaises(CommandError):
+            call_command("hyperkitty_update_counters", "unknown-list",
+                         stdout=output)
@@ -25,15 +25,21 @@ import os
 from email.message import EmailMessage
 from email.policy import default
 from email import message_from_file
+from time import monotonic
 
 import mock
 from django.utils import timezone
-from django.db import IntegrityError, DataError
+from django.db import IntegrityError, DataError, connection
 from django.core.cache import cache
-
-from hyperkitty.models import MailingList, Email, Thread, Attachment
-from hyperkitty.lib.incoming import add_to_list, DuplicateMessage
-from hyperkitty.lib.utils import get_message_id_hash
+from django.test.utils import CaptureQueriesContext
+
+from hyperkitty.models import (
+    MailingList, Email, Thread, Attachment, Sender)
+from hyperkitty.lib import incoming
+from hyperkitty.lib.incoming import (
+    add_to_list, add_many_to_list, clear_caches, is_duplicate,
+    DuplicateMessage)
+from hyperkitty.lib.utils import BloomFilter, get_message_id_hash
 from hyperkitty.tests.utils import TestCase, get_test_file
 
 
@@ -536,5 +542,367 @@ class TestAddToList(TestCase):
             Email.return_value = email
             filter_mock = mock.Mock()
             filter_mock.exists.return_value = False
+            hashes_mock = filter_mock.values_list.return_value
+            hashes_mock.count.return_value = 0
+            hashes_mock.iterator.return_value = []
             Email.objects.filter.return_value = filter_mock
             self.assertRaises(ValueError, add_to_list, "example-list", msg)
+
+    def test_update_from_mailman_coalesced(self):
+        # Only the first message schedules an update of the list properties
+        # from Mailman.
+        with mock.patch("hyperkitty.tasks.update_from_mailman") as task:
+            for num in range(3):
+                msg = EmailMessage()
+                msg["From"] = "dummy@example.com"
+                msg["Message-ID"] = "<dummy%d>" % num
+                msg.set_payload("Fake Message")
+                add_to_list("example-list", msg)
+        task.delay.assert_called_once_with("example-list")
+
+
+class TestAddManyToList(TestCase):
+
+    def _make_message(self, msg_id, in_reply_to=None, date=None):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Subject"] = "Fake Subject"
+        msg["Message-ID"] = "<%s>" % msg_id
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<%s>" % in_reply_to
+        if date is not None:
+            msg["Date"] = date
+        msg.set_payload("Fake Message")
+        return msg
+
+    def test_basic(self):
+        messages = [self._make_message("msg1"), self._make_message("msg2")]
+        result = add_many_to_list("example-list", messages)
+        self.assertEqual(result, [
+            get_message_id_hash("msg1"), get_message_id_hash("msg2")])
+        self.assertEqual(Email.objects.count(), 2)
+        self.assertEqual(Thread.objects.count(), 2)
+        for email in Email.objects.all():
+            self.assertEqual(email.sender.address, "dummy@example.com")
+            self.assertEqual(email.thread.thread_id, email.message_id_hash)
+            self.assertEqual(email.thread.starting_email, email)
+            self.assertEqual(email.thread_order, 0)
+            self.assertEqual(email.thread_depth, 0)
+
+    def test_parents(self):
+        add_to_list("example-list", self._make_message("msg1"))
+        messages = [
+            self._make_message("msg2", in_reply_to="msg1"),
+            self._make_message("msg3"),
+            self._make_message("msg4", in_reply_to="msg3"),
+            self._make_message("msg5", in_reply_to="msg4"),
+            ]
+        add_many_to_list("example-list", messages)
+        emails = {e.message_id: e for e in Email.objects.all()}
+        self.assertEqual(emails["msg2"].parent_id, emails["msg1"].id)
+        self.assertEqual(emails["msg2"].thread_id, emails["msg1"].thread_id)
+        self.assertIsNone(emails["msg3"].parent_id)
+        self.assertEqual(emails["msg4"].parent_id, emails["msg3"].id)
+        self.assertEqual(emails["msg5"].parent_id, emails["msg4"].id)
+        self.assertEqual(emails["msg5"].thread_id, emails["msg3"].thread_id)
+        self.assertEqual(emails["msg5"].thread_depth, 2)
+        self.assertEqual(Thread.objects.count(), 2)
+
+    def test_duplicates(self):
+        add_to_list("example-list", self._make_message("msg1"))
+        messages = [
+            self._make_message("msg1"),
+            self._make_message("msg2"),
+            self._make_message("msg2"),
+            ]
+        result = add_many_to_list("example-list", messages)
+        self.assertIsInstance(result[0], DuplicateMessage)
+        self.assertEqual(result[1], get_message_id_hash("msg2"))
+        self.assertIsInstance(result[2], DuplicateMessage)
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_invalid_message(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("Dummy message")
+        result = add_many_to_list(
+            "example-list", [msg, self._make_message("msg1")])
+        self.assertIsInstance(result[0], ValueError)
+        self.assertEqual(result[1], get_message_id_hash("msg1"))
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_attachments(self):
+        with open(get_test_file("attachment-1.txt")) as email_file:
+            msg = message_from_file(email_file, EmailMessage, policy=default)
+        add_many_to_list("example-list", [msg])
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(Attachment.objects.count(), 1)
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.email, Email.objects.get())
+        self.assertEqual(attachment.size, 49)
+
+    def test_thread_date_active(self):
+        messages = [
+            self._make_message(
+                "msg1", date="Fri, 02 Nov 2012 16:07:54 +0000"),
+            self._make_message(
+                "msg2", in_reply_to="msg1",
+                date="Sat, 03 Nov 2012 16:07:54 +0000"),
+            ]
+        add_many_to_list("example-list", messages)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.date_active, datetime.datetime(
+            2012, 11, 3, 16, 7, 54, tzinfo=timezone.utc))
+        self.assertEqual(thread.emails_count, 2)
+
+    def test_recent_threads_cache(self):
+        mlist = MailingList.objects.create(name="example-list")
+        add_many_to_list("example-list", [
+            self._make_message("msg1"), self._make_message("msg2")])
+        self.assertEqual(
+            [t.thread_id for t in mlist.recent_threads],
+            [get_message_id_hash("msg2"), get_message_id_hash("msg1")])
+
+    def test_fall_back_on_data_error(self):
+        messages = [self._make_message("msg1"), self._make_message("msg2")]
+        with mock.patch("hyperkitty.lib.incoming._bulk_save") as bulk_save:
+            bulk_save.side_effect = DataError("test error")
+            result = add_many_to_list("example-list", messages)
+        self.assertEqual(result, [
+            get_message_id_hash("msg1"), get_message_id_hash("msg2")])
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_fall_back_on_integrity_error(self):
+        # The thread of msg "bad" already has a starting email: the batch
+        # fails, and so does that message when it is archived alone.
+        add_to_list("example-list", self._make_message("other"))
+        Thread.objects.update(thread_id=get_message_id_hash("bad"))
+        messages = [self._make_message("ok1"), self._make_message("bad"),
+                    self._make_message("ok2")]
+        result = add_many_to_list("example-list", messages)
+        self.assertEqual(result[0], get_message_id_hash("ok1"))
+        self.assertIsInstance(result[1], ValueError)
+        self.assertEqual(result[2], get_message_id_hash("ok2"))
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["ok1", "ok2", "other"])
+
+    def test_queries(self):
+        # The number of queries must not depend on the number of messages.
+        add_to_list("example-list", self._make_message("parent"))
+
+        def count_queries(prefix, number):
+            messages = [
+                self._make_message("%s%d" % (prefix, num), "parent")
+                for num in range(number)]
+            with CaptureQueriesContext(connection) as context:
+                add_many_to_list("example-list", messages)
+            return len(context.captured_queries)
+        with self.settings(HYPERKITTY_BATCH_MODE=True):
+            self.assertEqual(
+                count_queries("small", 2), count_queries("large", 20))
+        self.assertEqual(Email.objects.count(), 23)
+
+
+class TestIngestionCaches(TestCase):
+
+    # Don't count the queries of the tasks, they run synchronously here.
+    override_settings = {"HYPERKITTY_BATCH_MODE": True}
+
+    def setUp(self):
+        # The test transaction is never committed, run the callbacks now.
+        self._on_commit_patcher = mock.patch(
+            "hyperkitty.lib.incoming.transaction.on_commit",
+            lambda func: func())
+        self._on_commit_patcher.start()
+
+    def tearDown(self):
+        self._on_commit_patcher.stop()
+
+    def _make_msg(self, num, sender="dummy@example.com"):
+        msg = EmailMessage()
+        msg["From"] = sender
+        msg["Message-ID"] = "<dummy%d>" % num
+        msg.set_payload("Fake Message")
+        return msg
+
+    def _get_tables(self, queries):
+        tables = set()
+        for query in queries:
+            for table in ("hyperkitty_mailinglist", "hyperkitty_sender"):
+                if table in query["sql"]:
+                    tables.add(table)
+        return tables
+
+    def test_cached(self):
+        add_to_list("example-list", self._make_msg(1))
+        with CaptureQueriesContext(connection) as queries:
+            add_to_list("example-list", self._make_msg(2))
+        self.assertEqual(self._get_tables(queries.captured_queries), set())
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_cached_many(self):
+        add_many_to_list("example-list", [self._make_msg(1)])
+        with CaptureQueriesContext(connection) as queries:
+            add_many_to_list("example-list", [
+                self._make_msg(2),
+                self._make_msg(3, sender="dummy2@example.com"),
+                ])
+        # Only the new sender has been looked up.
+        self.assertEqual(self._get_tables(queries.captured_queries),
+                         set(["hyperkitty_sender"]))
+        self.assertTrue(
+            Sender.objects.filter(address="dummy2@example.com").exists())
+
+    def test_list_deleted(self):
+        add_to_list("example-list", self._make_msg(1))
+        MailingList.objects.get(name="example-list").delete()
+        add_to_list("example-list", self._make_msg(2))
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_list_modified(self):
+        add_to_list("example-list", self._make_msg(1))
+        mlist = MailingList.objects.get(name="example-list")
+        mlist.display_name = "Example list"
+        mlist.save()
+        self.assertIsNone(incoming._mailinglists.get("example-list"))
+
+    def test_sender_deleted(self):
+        add_to_list("example-list", self._make_msg(1))
+        Sender.objects.get(address="dummy@example.com").delete()
+        add_to_list("example-list", self._make_msg(2))
+        self.assertTrue(
+            Sender.objects.filter(address="dummy@example.com").exists())
+
+    def test_not_committed(self):
+        # Don't cache the objects before the transaction is committed.
+        self._on_commit_patcher.stop()
+        try:
+            add_to_list("example-list", self._make_msg(1))
+        finally:
+            self._on_commit_patcher.start()
+        self.assertIsNone(incoming._mailinglists.get("example-list"))
+        self.assertIsNone(incoming._senders.get("dummy@example.com"))
+
+
+class TestDuplicateFilter(TestCase):
+
+    override_settings = {"HYPERKITTY_BATCH_MODE": True}
+
+    def setUp(self):
+        # The test transaction is never committed, run the callbacks now.
+        self._on_commit_patcher = mock.patch(
+            "hyperkitty.lib.incoming.transaction.on_commit",
+            lambda func: func())
+        self._on_commit_patcher.start()
+
+    def tearDown(self):
+        self._on_commit_patcher.stop()
+
+    def _make_msg(self, num):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<dummy%d>" % num
+        msg.set_payload("Fake Message")
+        return msg
+
+    def _get_email_queries(self, queries):
+        return [q for q in queries if "hyperkitty_email" in q["sql"]]
+
+    def test_warmed_from_db(self):
+        add_to_list("example-list", self._make_msg(1))
+        clear_caches()
+        self.assertTrue(is_duplicate("example-list", "dummy1"))
+        self.assertFalse(is_duplicate("example-list", "dummy2"))
+        self.assertFalse(is_duplicate("other-list", "dummy1"))
+
+    def test_known_duplicate(self):
+        # A single indexed query checks for duplicates.
+        add_to_list("example-list", self._make_msg(1))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertRaises(DuplicateMessage, add_to_list,
+                              "example-list", self._make_msg(1))
+        self.assertEqual(
+            len(self._get_email_queries(queries.captured_queries)), 1)
+
+    def test_unknown_message(self):
+        # Emails that are not in the filter don't need a query once it is
+        # loaded.
+        add_to_list("example-list", self._make_msg(1))
+        is_duplicate("example-list", "dummy1")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(is_duplicate("example-list", "dummy2"))
+        self.assertEqual(
+            self._get_email_queries(queries.captured_queries), [])
+
+    def test_false_positive(self):
+        # The filter's positive answers are confirmed in the database.
+        add_to_list("example-list", self._make_msg(1))
+        with mock.patch.object(BloomFilter, "__contains__") as contains:
+            contains.return_value = True
+            self.assertFalse(is_duplicate("example-list", "dummy2"))
+
+    def test_known_duplicate_many(self):
+        add_many_to_list("example-list", [self._make_msg(1)])
+        with mock.patch("hyperkitty.lib.incoming._make_email") as make_email:
+            results = add_many_to_list("example-list", [self._make_msg(1)])
+        self.assertIsInstance(results[0], DuplicateMessage)
+        self.assertFalse(make_email.called)
+
+    def test_single_check(self):
+        # The callers use the filter before parsing the message, archiving
+        # only checks the database.
+        with mock.patch("hyperkitty.lib.incoming.is_duplicate") as is_dup:
+            add_to_list("example-list", self._make_msg(1))
+            add_many_to_list("example-list", [self._make_msg(2)])
+        self.assertFalse(is_dup.called)
+
+    def test_refresh(self):
+        # Only the new emails are read when the filter is refreshed.
+        with mock.patch("hyperkitty.lib.incoming.monotonic",
+                        return_value=1000):
+            self.assertFalse(is_duplicate("example-list", "dummy1"))
+        self._on_commit_patcher.stop()
+        try:
+            add_to_list("example-list", self._make_msg(1))
+        finally:
+            self._on_commit_patcher.start()
+        with mock.patch("hyperkitty.lib.incoming.monotonic",
+                        return_value=1030):
+            self.assertFalse(is_duplicate("example-list", "dummy1"))
+        with mock.patch("hyperkitty.lib.incoming.monotonic",
+                        return_value=1061), \
+                CaptureQueriesContext(connection) as queries:
+            self.assertTrue(is_duplicate("example-list", "dummy1"))
+        email_id = Email.objects.get().id
+        self.assertEqual(
+            incoming._known_messages.get("example-list").last_id, email_id)
+        self.assertFalse(any("COUNT" in query["sql"]
+                             for query in queries.captured_queries))
+
+    def test_unknown_duplicate(self):
+        # The filter may not know about emails archived by other processes,
+        # the database is still checked.
+        add_to_list("example-list", self._make_msg(1))
+        incoming._known_messages.set(
+            "example-list", incoming._KnownMessages(
+                BloomFilter(10), Email.objects.get().id, monotonic()))
+        self.assertFalse(is_duplicate("example-list", "dummy1"))
+        self.assertRaises(DuplicateMessage, add_to_list,
+                          "example-list", self._make_msg(1))
+
+    def test_deleted(self):
+        add_to_list("example-list", self._make_msg(1))
+        Email.objects.get(message_id="dummy1").delete()
+        self.assertFalse(is_duplicate("example-list", "dummy1"))
+        add_to_list("example-list", self._make_msg(1))
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_not_committed(self):
+        is_duplicate("example-list", "dummy1")
+        self._on_commit_patcher.stop()
+        try:
+            add_to_list("example-list", self._make_msg(1))
+        finally:
+            self._on_commit_patcher.start()
+        self.assertFalse(is_duplicate("example-list", "dummy1"))
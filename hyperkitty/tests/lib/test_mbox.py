@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import lzma
+import mailbox
+import os
+
+from hyperkitty.lib.mbox import MboxReader
+from hyperkitty.tests.utils import TestCase, get_test_file
+
+
+MBOX_DATA = (
+    b"Garbage before the first message\n"
+    b"From dummy@example.com Mon Jul 21 11:44:51 2008\n"
+    b"Message-ID: <msg1>\n"
+    b"\n"
+    b"First message\n"
+    b">From the quoted line\n"
+    b"\n"
+    b"From dummy@example.com Mon Jul 21 11:45:51 2008\n"
+    b"Message-ID: <msg2>\n"
+    b"\n"
+    b"No empty line before the separator\n"
+    b"From \n"
+    b"\n"
+    b"\n"
+    b"From dummy@example.com Mon Jul 21 11:46:51 2008\n"
+    b"Message-ID: <msg3>\n"
+    b"\n"
+    b"No newline at the end"
+    )
+
+
+class MboxReaderTestCase(TestCase):
+
+    def _write(self, data, filename="test.mbox", opener=open):
+        path = os.path.join(self.tmpdir, filename)
+        with opener(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _read_with_mailbox(self, path):
+        mbox = mailbox.mbox(path)
+        try:
+            return [(msg.get_from(), mbox.get_bytes(key))
+                    for key, msg in zip(mbox.keys(), mbox)]
+        finally:
+            mbox.close()
+
+    def _read(self, path):
+        with MboxReader(path) as reader:
+            return [(unixfrom, bytes(raw)) for unixfrom, raw in reader]
+
+    def test_same_as_mailbox(self):
+        path = self._write(MBOX_DATA)
+        expected = self._read_with_mailbox(path)
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(self._read(path), expected)
+        with MboxReader(path) as reader:
+            self.assertEqual(len(reader), 4)
+
+    def test_test_files(self):
+        for filename in ("non-ascii-headers.txt", "unixfrom-date.txt",
+                         "attachment-2.txt"):
+            path = get_test_file(filename)
+            self.assertEqual(self._read(path), self._read_with_mailbox(path))
+
+    def test_raw_messages_are_views(self):
+        path = self._write(MBOX_DATA)
+        with MboxReader(path) as reader:
+            unixfrom, raw = next(iter(reader))
+            self.assertIsInstance(raw, memoryview)
+            self.assertEqual(
+                bytes(raw), b"Message-ID: <msg1>\n\nFirst message\n"
+                            b">From the quoted line\n")
+            raw.release()
+
+    def test_compressed(self):
+        expected = self._read_with_mailbox(self._write(MBOX_DATA))
+        for extension, opener in ((".gz", gzip.open), (".xz", lzma.open)):
+            path = self._write(MBOX_DATA, "test.mbox" + extension, opener)
+            self.assertEqual(self._read(path), expected)
+            with MboxReader(path) as reader:
+                self.assertTrue(reader.is_compressed())
+                self.assertRaises(TypeError, len, reader)
+
+    def test_messages_after(self):
+        plain = self._write(MBOX_DATA)
+        compressed = self._write(MBOX_DATA, "test.mbox.gz", gzip.open)
+        for path in (plain, compressed):
+            with MboxReader(path) as reader:
+                offsets = [offset for offset, unixfrom, raw
+                           in reader.messages()]
+                self.assertEqual(
+                    offsets[0], len(b"Garbage before the first message\n"))
+                self.assertEqual(len(offsets), 4)
+                after = [(unixfrom, bytes(raw)) for offset, unixfrom, raw
+                         in reader.messages(after=offsets[1])]
+            self.assertEqual(after, self._read(path)[2:])
+
+    def test_empty(self):
+        path = self._write(b"")
+        with MboxReader(path) as reader:
+            self.assertEqual(len(reader), 0)
+            self.assertEqual(list(reader), [])
+
+    def test_close_with_referenced_messages(self):
+        path = self._write(MBOX_DATA)
+        reader = MboxReader(path)
+        messages = list(reader)
+        reader.close()
+        self.assertEqual(bytes(messages[0][1])[:19], b"Message-ID: <msg1>\n")
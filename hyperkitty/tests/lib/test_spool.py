@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import os
+from email.message import EmailMessage
+
+from django.utils import timezone
+
+from hyperkitty.lib.spool import process_spool, spool_message
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.spool_dir = os.path.join(self.tmpdir, "spool")
+        self._override_setting("HYPERKITTY_ARCHIVE_SPOOL", self.spool_dir)
+
+    def _spool(self, msg_id, in_reply_to=None, unixfrom=None):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<%s>" % msg_id
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<%s>" % in_reply_to
+        msg.set_payload("Dummy message")
+        spool_message("list@example.com", msg.as_bytes(), unixfrom)
+
+    def test_process(self):
+        self._spool("msg1",
+                    unixfrom="dummy@example.com Mon Jul 21 11:59:48 2013")
+        self._spool("msg2", in_reply_to="msg1")
+        self.assertEqual(process_spool(), 2)
+        self.assertEqual(Email.objects.count(), 2)
+        msg1 = Email.objects.get(message_id="msg1")
+        msg2 = Email.objects.get(message_id="msg2")
+        self.assertEqual(msg2.parent_id, msg1.id)
+        self.assertEqual(
+            msg1.archived_date,
+            datetime.datetime(2013, 7, 21, 11, 59, 48, tzinfo=timezone.utc))
+        self.assertEqual(
+            os.listdir(os.path.join(self.spool_dir, "list@example.com")), [])
+
+    def test_from_line_in_body(self):
+        # Lines starting with "From " must not split the message.
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg.set_payload("line one\nFrom here on\nline three\n")
+        spool_message("list@example.com", msg.as_bytes(),
+                      "dummy@example.com Mon Jul 21 11:59:48 2013")
+        self.assertEqual(process_spool(), 1)
+        self.assertEqual(
+            Email.objects.get().content,
+            "line one\nFrom here on\nline three\n")
+
+    def test_empty_file(self):
+        spool_message("list@example.com", b"")
+        self.assertEqual(process_spool(), 0)
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.spool_dir, ".failed", "list@example.com"))), 1)
+
+    def test_batches(self):
+        for num in range(5):
+            self._spool("msg%d" % num)
+        self.assertEqual(process_spool(batch_size=2), 5)
+        self.assertEqual(Email.objects.count(), 5)
+
+    def test_duplicate(self):
+        self._spool("msg1")
+        process_spool()
+        self._spool("msg1")
+        self.assertEqual(process_spool(), 1)
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(
+            os.listdir(os.path.join(self.spool_dir, "list@example.com")), [])
+
+    def test_failed(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("No Message-ID")
+        spool_message("list@example.com", msg.as_bytes())
+        self.assertEqual(process_spool(), 0)
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.spool_dir, ".failed", "list@example.com"))), 1)
+
+    def test_locked(self):
+        self._spool("msg1")
+        with open(os.path.join(self.spool_dir, ".lock"), "w") as lockfile:
+            lockfile.write("%d\n" % os.getpid())
+        self.assertEqual(process_spool(), 0)
+        self.assertEqual(Email.objects.count(), 0)
+
+    def test_no_spool(self):
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=None):
+            self.assertEqual(process_spool(), 0)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from email.message import EmailMessage
+
+from mock import Mock, patch
+
+from hyperkitty.lib import timing
+from hyperkitty.lib.incoming import add_many_to_list, add_to_list
+from hyperkitty.tests.utils import TestCase
+
+
+def hook_for_settings(stage, duration):
+    hook_for_settings.calls.append((stage, duration))
+
+
+class TimingTestCase(TestCase):
+
+    def setUp(self):
+        timing.reset()
+
+    def tearDown(self):
+        timing.reset()
+
+    def test_histogram(self):
+        histogram = timing.Histogram()
+        for duration in (0.00005, 0.002, 0.003, 10):
+            histogram.add(duration)
+        result = histogram.as_dict()
+        self.assertEqual(result["count"], 4)
+        self.assertEqual(result["min"], 0.00005)
+        self.assertEqual(result["max"], 10)
+        self.assertAlmostEqual(result["total"], 10.00505)
+        self.assertEqual(result["buckets"]["0.0001"], 1)
+        self.assertEqual(result["buckets"]["0.005"], 2)
+        self.assertEqual(result["buckets"]["+Inf"], 1)
+        self.assertEqual(sum(result["buckets"].values()), 4)
+
+    def test_nested(self):
+        # The nested stages are not counted in the enclosing stage.
+        clock = iter([0, 1, 3, 10])
+        with patch("hyperkitty.lib.timing.perf_counter",
+                   lambda: next(clock)):
+            with timing.timed("outer"):
+                with timing.timed("inner"):
+                    pass
+        timings = timing.get_timings()
+        self.assertEqual(timings["inner"]["total"], 2)
+        self.assertEqual(timings["outer"]["total"], 8)
+
+    def test_hooks(self):
+        hook = Mock()
+        timing.add_hook(hook)
+        try:
+            timing.record("stage", 1.5)
+        finally:
+            timing.remove_hook(hook)
+        hook.assert_called_once_with("stage", 1.5)
+
+    def test_setting_hook(self):
+        hook_for_settings.calls = []
+        path = "hyperkitty.tests.lib.test_timing.hook_for_settings"
+        with self.settings(HYPERKITTY_TIMING_HOOK=path):
+            timing.record("stage", 1.5)
+        self.assertEqual(hook_for_settings.calls, [("stage", 1.5)])
+
+    def test_failing_hook(self):
+        hook = Mock(side_effect=ValueError)
+        timing.add_hook(hook)
+        try:
+            timing.record("stage", 1.5)
+        finally:
+            timing.remove_hook(hook)
+        self.assertEqual(timing.get_timings()["stage"]["count"], 1)
+
+    def test_summary(self):
+        timing.record("fast", 1)
+        timing.record("slow", 2)
+        timing.record("slow", 4)
+        self.assertEqual(timing.format_summary(), [
+            "slow: 2 calls, 6.000s total, 3.000000s mean",
+            "fast: 1 calls, 1.000s total, 1.000000s mean",
+        ])
+
+    def _make_message(self, num, in_reply_to=None):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<msg%d>" % in_reply_to
+        msg.set_payload("Dummy message")
+        return msg
+
+    def test_add_to_list(self):
+        add_to_list("example-list", self._make_message(1))
+        add_to_list("example-list", self._make_message(2, in_reply_to=1))
+        timings = timing.get_timings()
+        for stage in ("list_lookup", "dedup_check", "header_parsing",
+                      "scrubbing", "sender_resolution", "save",
+                      "attachments", "signal_handlers"):
+            self.assertEqual(timings[stage]["count"], 2, stage)
+        self.assertEqual(timings["parent_lookup"]["count"], 1)
+
+    def test_add_many_to_list(self):
+        add_many_to_list("example-list", [
+            self._make_message(1), self._make_message(2, in_reply_to=1)])
+        timings = timing.get_timings()
+        for stage in ("list_lookup", "dedup_check", "sender_resolution",
+                      "parent_lookup", "save", "attachments"):
+            self.assertEqual(timings[stage]["count"], 1, stage)
+        for stage in ("header_parsing", "scrubbing"):
+            self.assertEqual(timings[stage]["count"], 2, stage)
+        self.assertIn("signal_handlers", timings)
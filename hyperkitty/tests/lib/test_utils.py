@@ -27,8 +27,10 @@ from traceback import format_exc
 
 from django.utils import timezone
 from django.utils.timezone import get_fixed_timezone
+from mock import patch
 
 from hyperkitty.lib import utils
+from hyperkitty.tests.benchmarks.headers import check, get_corpus
 from hyperkitty.tests.utils import TestCase, get_test_file
 
 
@@ -190,6 +192,16 @@ class TestUtils(TestCase):
                                      tzinfo=timezone.utc)
         self.assertEqual(parsed, expected)
 
+    def test_headers_corpus(self):
+        # The fast paths in parsedate() and header_to_unicode() must give the
+        # same results as the full parsers.
+        dates, headers = get_corpus()
+        self.assertEqual(check(dates, headers), [])
+
+    def test_plain_header_bytes(self):
+        self.assertEqual(utils.header_to_unicode(b"  Plain header"),
+                         "Plain header")
+
     def test_unknown_encoding(self):
         """Unknown encodings should just replace unknown characters"""
         header = "=?x-gbk?Q?Frank_B=A8=B9ttner?="
@@ -241,3 +253,81 @@ Dummy Message
         # utf-8 characters are perfectly legitimate here (RFC 6532) and
         # stripping it here makes no sense at all
         self.assertEqual(ref_id, "ref-\xed")
+
+
+class TestLRUCache(TestCase):
+
+    def test_get_set(self):
+        lru = utils.LRUCache(maxsize=2)
+        lru.set("a", 1)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("b", 2), 2)
+
+    def test_eviction(self):
+        lru = utils.LRUCache(maxsize=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        # "b" is the least recently used entry.
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_timeout(self):
+        lru = utils.LRUCache(maxsize=2, timeout=10)
+        with patch("hyperkitty.lib.utils.monotonic") as monotonic:
+            monotonic.return_value = 100
+            lru.set("a", 1)
+            monotonic.return_value = 105
+            self.assertEqual(lru.get("a"), 1)
+            monotonic.return_value = 111
+            self.assertIsNone(lru.get("a"))
+        self.assertEqual(len(lru), 0)
+
+    def test_delete_clear(self):
+        lru = utils.LRUCache(maxsize=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.delete("a")
+        lru.delete("unknown")
+        self.assertIsNone(lru.get("a"))
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+    def test_values(self):
+        lru = utils.LRUCache(maxsize=2, timeout=10)
+        with patch("hyperkitty.lib.utils.monotonic") as monotonic:
+            monotonic.return_value = 100
+            lru.set("a", 1)
+            monotonic.return_value = 105
+            lru.set("b", 2)
+            self.assertEqual(sorted(lru.values()), [1, 2])
+            monotonic.return_value = 111
+            self.assertEqual(lru.values(), [2])
+
+
+class TestBloomFilter(TestCase):
+
+    def test_contains(self):
+        bloom = utils.BloomFilter(capacity=1000)
+        bloom.update("item%d" % num for num in range(1000))
+        for num in range(1000):
+            self.assertIn("item%d" % num, bloom)
+        false_positives = sum(
+            1 for num in range(1000, 11000) if "item%d" % num in bloom)
+        # About 1% with the default parameters.
+        self.assertLess(false_positives, 300)
+
+    def test_size(self):
+        bloom = utils.BloomFilter(capacity=1000)
+        self.assertEqual(len(bloom._bits), 1250)
+
+    def test_is_full(self):
+        bloom = utils.BloomFilter(capacity=2)
+        bloom.update(["a", "b"])
+        self.assertFalse(bloom.is_full())
+        bloom.add("c")
+        self.assertTrue(bloom.is_full())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.utils.http import int_to_base36
+from django.utils.timezone import now
+
+from hyperkitty.tests.utils import MigrationTestCase
+
+
+class ThreadPathTestCase(MigrationTestCase):
+
+    migrate_from = '0020_mailinglist_last_synced'
+    migrate_to = '0021_email_thread_path'
+
+    def test_populate(self):
+        MailingList = self.old_apps.get_model("hyperkitty", "MailingList")
+        Sender = self.old_apps.get_model("hyperkitty", "Sender")
+        Thread = self.old_apps.get_model("hyperkitty", "Thread")
+        Email = self.old_apps.get_model("hyperkitty", "Email")
+        mlist = MailingList.objects.create(name="list@example.com")
+        sender = Sender.objects.create(address="user@example.com")
+        thread = Thread.objects.create(mailinglist=mlist, thread_id="test")
+        emails = {}
+        for msg_id, parent in (("msg1", None), ("msg1.1", "msg1"),
+                               ("msg1.1.1", "msg1.1"), ("msg1.2", "msg1")):
+            emails[msg_id] = Email.objects.create(
+                mailinglist=mlist, sender=sender, thread=thread,
+                message_id=msg_id, message_id_hash=msg_id,
+                parent=emails.get(parent), subject="test", content="test",
+                date=now(), timezone=0)
+        thread.starting_email = emails["msg1"]
+        thread.save()
+        new_apps = self.migrate()
+        Email = new_apps.get_model("hyperkitty", "Email")
+        paths = dict(Email.objects.values_list("message_id", "thread_path"))
+
+        def _path(*msg_ids):
+            return "".join(
+                "%s." % int_to_base36(emails[msg_id].id) for msg_id in msg_ids)
+        self.assertEqual(paths, {
+            "msg1": _path("msg1"),
+            "msg1.1": _path("msg1", "msg1.1"),
+            "msg1.1.1": _path("msg1", "msg1.1", "msg1.1.1"),
+            "msg1.2": _path("msg1", "msg1.2"),
+            })
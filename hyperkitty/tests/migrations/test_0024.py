@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from hyperkitty.tests.utils import MigrationTestCase
+
+
+class PendingItemUniqueTestCase(MigrationTestCase):
+
+    migrate_from = '0023_pendingitem'
+    migrate_to = '0024_pendingitem_unique'
+
+    def test_remove_duplicates(self):
+        PendingItem = self.old_apps.get_model("hyperkitty", "PendingItem")
+        for func_name, value in (("func1", "1"), ("func1", "1"),
+                                 ("func1", "2"), ("func2", "1")):
+            PendingItem.objects.create(func_name=func_name, value=value)
+        new_apps = self.migrate()
+        PendingItem = new_apps.get_model("hyperkitty", "PendingItem")
+        self.assertEqual(
+            sorted(PendingItem.objects.values_list("func_name", "value")),
+            [("func1", "1"), ("func1", "2"), ("func2", "1")])
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from email.message import EmailMessage
+
+from django.core.cache import cache
+from django.test import override_settings
+from mock import patch
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models.common import (
+    CachedValue, LocalCache, local_cache, prefetch_cached_values)
+from hyperkitty.models.email import Email
+from hyperkitty.models.thread import Thread
+from hyperkitty.tests.utils import TestCase
+
+
+class CountingValue(CachedValue):
+
+    def __init__(self, key):
+        self.cache_key = key
+        self.value = 0
+
+    def get_value(self):
+        self.value += 1
+        return self.value
+
+
+class LocalCacheTestCase(TestCase):
+
+    def test_disabled(self):
+        value = CountingValue("test")
+        self.assertEqual(value(), 1)
+        cache.set("test", 42)
+        self.assertEqual(value(), 42)
+        self.assertEqual(len(local_cache._entries), 0)
+
+    @override_settings(HYPERKITTY_LOCAL_CACHE_TIMEOUT=60)
+    def test_local_hit(self):
+        value = CountingValue("test")
+        self.assertEqual(value(), 1)
+        with patch("hyperkitty.models.common.cache") as shared_cache:
+            self.assertEqual(value(), 1)
+        self.assertFalse(shared_cache.get.called)
+        # Rebuilding updates the local value.
+        self.assertEqual(value.rebuild(), 2)
+        self.assertEqual(value(), 2)
+
+    @override_settings(HYPERKITTY_LOCAL_CACHE_TIMEOUT=60)
+    def test_changed_elsewhere(self):
+        value1 = CountingValue("test1")
+        value2 = CountingValue("test2")
+        self.assertEqual(value1(), 1)
+        self.assertEqual(value2(), 1)
+        local_cache.check_interval = 0
+        self.addCleanup(delattr, local_cache, "check_interval")
+        # A local change only drops the changed key.
+        value1.rebuild()
+        cache.set("test2", 42)
+        self.assertEqual(value2(), 1)
+        # Another process changes a value.
+        other_process = LocalCache()
+        cache.set("test2", 42)
+        other_process.changed({"test2": 42})
+        self.assertEqual(value1(), 2)
+        self.assertEqual(value2(), 42)
+
+    @override_settings(HYPERKITTY_LOCAL_CACHE_TIMEOUT=60)
+    def test_other_keys_kept(self):
+        # A change in another process only drops the changed key.
+        value1 = CountingValue("test1")
+        value2 = CountingValue("test2")
+        self.assertEqual(value1(), 1)
+        self.assertEqual(value2(), 1)
+        local_cache.check_interval = 0
+        self.addCleanup(delattr, local_cache, "check_interval")
+        cache.set("test2", 42)
+        LocalCache().changed({"test2": 42})
+        with patch("hyperkitty.models.common.cache") as shared_cache:
+            shared_cache.get_many.side_effect = cache.get_many
+            self.assertEqual(value1(), 1)
+        self.assertFalse(shared_cache.get.called)
+        self.assertEqual(value2(), 42)
+
+    @override_settings(HYPERKITTY_LOCAL_CACHE_TIMEOUT=60)
+    def test_check_interval(self):
+        value = CountingValue("test")
+        self.assertEqual(value(), 1)
+        cache.set("test", 42)
+        LocalCache().changed({"test": 42})
+        # The version isn't read again right away.
+        self.assertEqual(value(), 1)
+
+    @override_settings(HYPERKITTY_LOCAL_CACHE_TIMEOUT=60)
+    def test_timeout(self):
+        value = CountingValue("test")
+        with patch("hyperkitty.models.common.monotonic", return_value=1000):
+            self.assertEqual(value(), 1)
+        cache.set("test", 42)
+        with patch("hyperkitty.models.common.monotonic", return_value=1059):
+            self.assertEqual(value(), 1)
+        with patch("hyperkitty.models.common.monotonic", return_value=1061):
+            self.assertEqual(value(), 42)
+
+
+class PrefetchCachedValuesTestCase(TestCase):
+
+    def setUp(self):
+        for num in range(1, 7):
+            msg = EmailMessage()
+            msg["From"] = "sender%d@example.com" % (num % 3)
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Subject %d" % num
+            if num > 3:
+                msg["In-Reply-To"] = "<msg%d>" % (num - 3)
+            msg.set_payload("message %d" % num)
+            add_to_list("example-list", msg)
+        cache.clear()
+
+    def test_values(self):
+        threads = list(Thread.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            prefetch_cached_values(threads, ["subject"])
+        with self.assertNumQueries(0):
+            subjects = [thread.subject for thread in threads]
+        self.assertEqual(subjects, ["Subject 1", "Subject 2", "Subject 3"])
+        # The values have been stored in the cache.
+        threads = list(Thread.objects.order_by("id"))
+        with self.assertNumQueries(0):
+            prefetch_cached_values(threads, ["subject"])
+        self.assertEqual([thread.subject for thread in threads], subjects)
+
+    def test_single_cache_call(self):
+        threads = list(Thread.objects.all())
+        prefetch_cached_values(threads, ["subject"])
+        threads = list(Thread.objects.all())
+        with patch("hyperkitty.models.common.cache") as mock_cache:
+            mock_cache.get_many.side_effect = cache.get_many
+            prefetch_cached_values(threads, ["subject"])
+            for thread in threads:
+                thread.subject
+        self.assertEqual(mock_cache.get_many.call_count, 1)
+        self.assertEqual(
+            len(mock_cache.get_many.call_args[0][0]), len(threads))
+        self.assertFalse(mock_cache.get.called)
+        self.assertFalse(mock_cache.set_many.called)
+
+    def test_only_misses(self):
+        threads = list(Thread.objects.order_by("id"))
+        threads[0].subject
+        cache.set(threads[1].cached_values["subject"]._get_cache_key(),
+                  "Cached")
+        with patch("hyperkitty.models.thread.Subject.get_values",
+                   return_value={}) as get_values:
+            prefetch_cached_values(threads, ["subject"])
+        get_values.assert_called_once_with(threads[2:])
+        self.assertEqual(threads[0].subject, "Subject 1")
+        self.assertEqual(threads[1].subject, "Cached")
+
+    def test_rebuild(self):
+        thread = Thread.objects.order_by("id").first()
+        prefetch_cached_values([thread], ["subject"])
+        Email.objects.filter(message_id="msg1").update(subject="Changed")
+        thread.cached_values["subject"].rebuild()
+        self.assertEqual(thread.subject, "Changed")
+
+
+class LockedValue(CountingValue):
+
+    lock_timeout = 60
+
+
+class StampedeTestCase(TestCase):
+
+    def test_stale_copy(self):
+        value = LockedValue("test")
+        self.assertEqual(value(), 1)
+        self.assertEqual(cache.get("test:stale"), 1)
+        self.assertIsNone(cache.get("test:lock"))
+        # Values without a lock timeout have no stale copy.
+        CountingValue("other")()
+        self.assertIsNone(cache.get("other:stale"))
+
+    def test_locked_stale(self):
+        value = LockedValue("test")
+        self.assertEqual(value(), 1)
+        cache.delete("test")
+        cache.set("test:lock", True)
+        # Another process is rebuilding the value.
+        self.assertEqual(value(), 1)
+        self.assertEqual(value.value, 1)
+        self.assertIsNone(cache.get("test"))
+
+    def test_locked_no_stale(self):
+        value = LockedValue("test")
+        cache.set("test:lock", True)
+        self.assertEqual(value(), 1)
+        # It is left to the process that holds the lock to store the value.
+        self.assertIsNone(cache.get("test"))
+        self.assertIsNone(cache.get("test:stale"))
+
+    def test_lock_held_during_rebuild(self):
+        value = LockedValue("test")
+
+        def get_value():
+            self.assertTrue(cache.get("test:lock"))
+            return 42
+        value.get_value = get_value
+        self.assertEqual(value(), 42)
+        self.assertIsNone(cache.get("test:lock"))
+
+    def test_lock_released_on_error(self):
+        value = LockedValue("test")
+        value.get_value = lambda: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            value()
+        self.assertIsNone(cache.get("test:lock"))
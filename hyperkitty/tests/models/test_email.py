@@ -20,9 +20,15 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from datetime import timedelta
 from email.message import EmailMessage
 from mimetypes import guess_all_extensions
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import int_to_base36
+from mock import patch
+
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, Thread
 from hyperkitty.tests.utils import TestCase
@@ -187,6 +193,93 @@ class EmailSetParentTestCase(TestCase):
         email1 = _create_tree(["msg1"])[0]
         self.assertRaises(ValueError, email1.set_parent, email1)
 
+    def test_failed_recompute(self):
+        # The emails are not moved if their positions can't be recomputed.
+        email1, email2 = _create_tree(["msg1", "msg2"])
+        thread_id = email2.thread_id
+        with patch("hyperkitty.models.email.compute_thread_order_and_depth",
+                   side_effect=ValueError):
+            self.assertRaises(ValueError, email2.set_parent, email1)
+        email2 = Email.objects.get(id=email2.id)
+        self.assertIsNone(email2.parent_id)
+        self.assertEqual(email2.thread_id, thread_id)
+        self.assertEqual(Thread.objects.count(), 2)
+
+    def test_subthread_without_paths(self):
+        tree = ["msg1", "msg2", "msg2.1", "msg2.1.1", "msg2.2"]
+        emails = _create_tree(tree)
+        Email.objects.update(thread_path=None)
+        emails[1].refresh_from_db()
+        emails[1].set_parent(emails[0])
+        thread = Thread.objects.get()
+        self.assertEqual(
+            tree, list(thread.emails.order_by(
+                "thread_order").values_list("message_id", flat=True)))
+
+    def test_subthread_queries(self):
+        # Moving a subthread takes the same number of queries whatever its
+        # size. The list's caches don't matter here.
+        patcher = patch("hyperkitty.models.mailinglist.MailingList."
+                        "on_thread_deleted")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        query_counts = []
+        for size in (2, 10):
+            tree = ["msg%d" % size] + [
+                "msg%d.%s" % (size, ".".join(["1"] * (num + 1)))
+                for num in range(size)]
+            emails = _create_tree(["start%d" % size] + tree)
+            with CaptureQueriesContext(connection) as queries:
+                emails[1].set_parent(emails[0])
+            query_counts.append(len(queries))
+            self.assertEqual(
+                Email.objects.filter(thread_id=emails[0].thread_id).count(),
+                size + 2)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_date_active(self):
+        email1, email2, email3 = _create_tree(["msg1", "msg2", "msg2.1"])
+        email3.date = email1.date + timedelta(days=1)
+        email3.save(update_fields=["date"])
+        email2.set_parent(email1)
+        self.assertEqual(
+            Thread.objects.get(id=email1.thread_id).date_active, email3.date)
+
+    def test_thread_path(self):
+        emails = _create_tree(["msg1", "msg1.1", "msg1.1.1", "msg2"])
+        emails[3].set_parent(emails[1])
+        for email in Email.objects.all():
+            if email.parent is None:
+                self.assertEqual(email.thread_path, "%s." % int_to_base36(
+                    email.id))
+            else:
+                self.assertEqual(email.thread_path, "%s%s." % (
+                    email.parent.thread_path, int_to_base36(email.id)))
+
+
+class EmailSubthreadTestCase(TestCase):
+
+    def setUp(self):
+        self.emails = _create_tree(
+            ["msg1", "msg1.1", "msg1.1.1", "msg1.1.2", "msg1.2"])
+
+    def test_subthread(self):
+        email = Email.objects.get(message_id="msg1.1")
+        with self.assertNumQueries(2):
+            subthread = list(email._get_subthread())
+        self.assertEqual(
+            sorted(e.message_id for e in subthread),
+            ["msg1.1", "msg1.1.1", "msg1.1.2"])
+
+    def test_subthread_without_paths(self):
+        # Emails imported in batch mode have no path until their thread is
+        # computed.
+        Email.objects.filter(message_id="msg1.1.2").update(thread_path=None)
+        email = Email.objects.get(message_id="msg1.1")
+        self.assertEqual(
+            sorted(e.message_id for e in email._get_subthread()),
+            ["msg1.1", "msg1.1.1", "msg1.1.2"])
+
 
 class EmailDeleteTestCase(TestCase):
 
@@ -25,13 +25,14 @@ from email.message import EmailMessage
 from random import shuffle
 
 from django.contrib.auth.models import User
-from django.utils.timezone import utc
+from django.utils.timezone import now, utc
 from django_mailman3.tests.utils import FakeMMList
+from mock import patch
 
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import MailingList, Thread, ArchivePolicy
 from hyperkitty.models.mailinglist import (
-    RecentThreads, TopThreads, PopularThreads, FirstDate)
+    RecentThreads, TopThreads, PopularThreads, FirstDate, LazyThreads)
 from hyperkitty.tests.utils import TestCase
 
 
@@ -76,6 +77,42 @@ class MailingListTestCase(TestCase):
         self.assertTrue(self.ml.created_at.tzinfo is not None)
         self.assertEqual(self.ml.created_at, new_date.replace(tzinfo=utc))
 
+    def test_update_from_mailman_last_synced(self):
+        self.assertIsNone(self.ml.last_synced)
+        self.ml.update_from_mailman()
+        self.assertIsNotNone(self.ml.last_synced)
+        self.assertEqual(
+            MailingList.objects.get(pk=self.ml.pk).last_synced,
+            self.ml.last_synced)
+
+    def test_update_from_mailman_unchanged(self):
+        self.ml.update_from_mailman()
+        # Nothing changed in Mailman, the list must not be saved again.
+        with patch.object(self.ml, "save") as save:
+            self.ml.update_from_mailman()
+        self.assertFalse(save.called)
+        self.mailman_ml.display_name = "new-value"
+        with patch.object(self.ml, "save") as save:
+            self.ml.update_from_mailman()
+        self.assertTrue(save.called)
+
+    def test_schedule_mailman_update(self):
+        with patch("hyperkitty.tasks.update_from_mailman") as task:
+            self.ml.schedule_mailman_update()
+            self.ml.schedule_mailman_update()
+        # The second update is already scheduled.
+        task.delay.assert_called_once_with("list@example.com")
+
+    def test_schedule_mailman_update_interval(self):
+        self.ml.last_synced = now() - timedelta(minutes=5)
+        with patch("hyperkitty.tasks.update_from_mailman") as task:
+            with self.settings(HYPERKITTY_MAILMAN_SYNC_INTERVAL=10 * 60):
+                self.ml.schedule_mailman_update()
+            self.assertFalse(task.delay.called)
+            with self.settings(HYPERKITTY_MAILMAN_SYNC_INTERVAL=60):
+                self.ml.schedule_mailman_update()
+            task.delay.assert_called_once_with("list@example.com")
+
     def test_get_threads_between(self):
         # the get_threads_between method should return all threads that have
         # been active between the two specified dates, including the threads
@@ -200,6 +237,43 @@ class RecentThreadsTestCase(TestCase):
             ["msg%d" % i for i in range(1, 21)]
             )
 
+    def _add_threads(self, count):
+        for i in range(count):
+            msg = EmailMessage()
+            msg["From"] = "sender@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg.set_payload("message %d" % i)
+            add_to_list(self.ml.name, msg)
+
+    def test_single_query(self):
+        self._add_threads(10)
+        self.cached_value.rebuild()
+        with self.assertNumQueries(1):
+            threads = list(self.cached_value())
+            for thread in threads:
+                thread.starting_email.message_id
+                thread.category
+        self.assertEqual(len(threads), 10)
+
+    def test_slice_before_loading(self):
+        self._add_threads(10)
+        thread_ids = self.cached_value.get_value()
+        threads = self.cached_value()[2:5]
+        self.assertIsInstance(threads, LazyThreads)
+        self.assertEqual(threads.thread_ids, thread_ids[2:5])
+        with self.assertNumQueries(1):
+            self.assertEqual([t.id for t in threads], thread_ids[2:5])
+            self.assertEqual(threads[0].id, thread_ids[2])
+
+    def test_deleted_thread(self):
+        self._add_threads(3)
+        thread_ids = self.cached_value.get_value()
+        Thread.objects.filter(id=thread_ids[1]).delete()
+        threads = LazyThreads(thread_ids)
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(
+            [t.id for t in threads], [thread_ids[0], thread_ids[2]])
+
 
 class TopThreadsTestCase(TestCase):
 
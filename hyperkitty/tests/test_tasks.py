@@ -22,9 +22,15 @@
 
 from email.message import EmailMessage
 
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_q.conf import Conf
+from django_q.tasks import AsyncTask
+
 from hyperkitty import tasks
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models.email import Email
+from hyperkitty.models.task import PendingItem
 from hyperkitty.models.thread import Thread
 from hyperkitty.tests.utils import TestCase
 from mock import patch
@@ -61,10 +67,10 @@ class TaskTestCase(TestCase):
         msg_orig["From"] = "sender1@example.com"
         msg_orig["Message-ID"] = "<msgid1>"
         msg_orig.set_payload("original message")
-        with patch("hyperkitty.tasks.check_orphans") as mock_co:
+        with patch("hyperkitty.tasks.check_emails_orphans") as mock_co:
             add_to_list("example-list", msg_reply)
             add_to_list("example-list", msg_orig)
-            self.assertEqual(mock_co.delay.call_count, 2)
+            self.assertEqual(mock_co.mark_dirty.call_count, 2)
         orig = Email.objects.get(message_id="msgid1")
         reply = Email.objects.get(message_id="msgid2")
         self.assertIsNone(reply.parent)
@@ -72,3 +78,189 @@ class TaskTestCase(TestCase):
         tasks.check_orphans(orig.id)
         reply.refresh_from_db()
         self.assertEqual(reply.parent_id, orig.pk)
+
+
+class SingletonAsyncTestCase(TestCase):
+
+    def setUp(self):
+        # Don't run the tasks synchronously, and don't actually queue them.
+        self._patchers = [
+            patch.object(Conf, "SYNC", False),
+            patch.object(AsyncTask, "run", autospec=True,
+                         return_value="task-id"),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+        self.run_mock = AsyncTask.run
+
+    def tearDown(self):
+        for patcher in self._patchers:
+            patcher.stop()
+
+    def test_cache_key(self):
+        task1 = tasks.SingletonAsync(tasks.update_from_mailman, "list1")
+        task2 = tasks.SingletonAsync(tasks.update_from_mailman, "list2")
+        task3 = tasks.SingletonAsync(tasks.update_from_mailman, "list1")
+        self.assertTrue(task1._cache_key.startswith(
+            "task:status:hyperkitty.tasks.update_from_mailman:"))
+        self.assertNotEqual(task1._cache_key, task2._cache_key)
+        self.assertEqual(task1._cache_key, task3._cache_key)
+
+    def test_coalesce(self):
+        self.assertEqual(
+            tasks.update_from_mailman.delay("list1"), "task-id")
+        self.assertIsNone(tasks.update_from_mailman.delay("list1"))
+        tasks.update_from_mailman.delay("list2")
+        self.assertEqual(self.run_mock.call_count, 2)
+        metrics = tasks.get_task_metrics()
+        self.assertEqual(metrics["update_from_mailman"], {
+            "enqueued": 2, "coalesced": 1, "dropped": 0})
+
+    def test_unlock(self):
+        task = tasks.SingletonAsync(tasks.update_from_mailman, "list1")
+        task.run()
+        self.assertIsNotNone(cache.get(task._cache_key))
+        with patch.object(tasks.MailingList, "objects"):
+            tasks.unlock_and_call(
+                tasks.update_from_mailman, task._cache_key, "list1")
+        self.assertIsNone(cache.get(task._cache_key))
+        tasks.update_from_mailman.delay("list1")
+        self.assertEqual(self.run_mock.call_count, 2)
+
+    def test_debounce(self):
+        with patch.object(tasks.SingletonAsync, "DEBOUNCE", 60), \
+                patch("hyperkitty.tasks.schedule") as schedule:
+            tasks.update_from_mailman.delay("list1")
+            tasks.update_from_mailman.delay("list1")
+        self.assertFalse(self.run_mock.called)
+        self.assertEqual(schedule.call_count, 1)
+        args = schedule.call_args[0]
+        kwargs = schedule.call_args[1]
+        self.assertEqual(args[0], "hyperkitty.tasks.unlock_and_call")
+        self.assertEqual(args[1], "hyperkitty.tasks.update_from_mailman")
+        self.assertEqual(args[3], "list1")
+        self.assertGreater(kwargs["next_run"], now())
+
+    def test_batch(self):
+        for thread_id in (1, 2, 1, 3):
+            tasks.rebuild_threads_cache_new_email.delay(thread_id)
+        self.assertEqual(self.run_mock.call_count, 1)
+        func_path = "hyperkitty.tasks.rebuild_threads_cache_new_email"
+        self.assertEqual(tasks.pop_pending(func_path), [1, 2, 3])
+        self.assertEqual(tasks.pop_pending(func_path), [])
+        metrics = tasks.get_task_metrics()
+        self.assertEqual(metrics["rebuild_threads_cache_new_email"], {
+            "enqueued": 1, "coalesced": 3, "dropped": 0})
+
+    def test_batch_run(self):
+        func_path = "hyperkitty.tasks.rebuild_threads_cache_new_email"
+        tasks.add_pending(func_path, 1)
+        tasks.add_pending(func_path, 2)
+        with patch("hyperkitty.tasks.rebuild_threads_cache_new_email") as rb:
+            tasks.run_batch(func_path)
+            tasks.run_batch(func_path)
+        rb.assert_called_once_with([1, 2])
+
+    def test_pending_in_database(self):
+        # The arguments are not lost if the cache is cleared.
+        func_path = "hyperkitty.tasks.rebuild_mailinglists_cache_for_month"
+        tasks.add_pending(func_path, ("list@example.com", 2019, 1))
+        tasks.add_pending(func_path, ("list@example.com", 2019, 1))
+        tasks.add_pending(func_path, ("list@example.com", 2019, 2))
+        cache.clear()
+        self.assertEqual(PendingItem.objects.count(), 2)
+        self.assertEqual(tasks.pop_pending(func_path), [
+            ("list@example.com", 2019, 1), ("list@example.com", 2019, 2)])
+        self.assertFalse(PendingItem.objects.exists())
+
+    def test_pending_unique(self):
+        # Each item is only stored once until it is processed.
+        func_path = "hyperkitty.tasks.rebuild_threads_cache_new_email"
+        tasks.add_pending(func_path, 1)
+        with self.assertNumQueries(1):
+            tasks.add_pending(func_path, 1)
+        tasks.add_pending(func_path, 2)
+        self.assertEqual(PendingItem.objects.count(), 2)
+        self.assertEqual(tasks.pop_pending(func_path), [1, 2])
+        tasks.add_pending(func_path, 1)
+        self.assertEqual(tasks.pop_pending(func_path), [1])
+
+    def test_pop_pending_other_task(self):
+        tasks.add_pending("hyperkitty.tasks.check_emails_orphans", 1)
+        tasks.add_pending("hyperkitty.tasks.compute_threads_positions", 2)
+        self.assertEqual(
+            tasks.pop_pending("hyperkitty.tasks.check_emails_orphans"), [1])
+        self.assertEqual(
+            list(PendingItem.objects.values_list("func_name", flat=True)),
+            ["hyperkitty.tasks.compute_threads_positions"])
+
+    def test_mark_dirty(self):
+        for thread_id in (1, 2, 1):
+            tasks.rebuild_threads_cache_new_email.mark_dirty(thread_id)
+        self.assertFalse(self.run_mock.called)
+        with patch("hyperkitty.tasks.rebuild_threads_cache_new_email") as rb:
+            tasks.run_dirty_batches()
+            tasks.run_dirty_batches()
+        rb.assert_called_once_with([1, 2])
+
+    def test_run_dirty_batches_error(self):
+        # A failing batch must not prevent the other ones from running.
+        tasks.rebuild_threads_cache_new_email.mark_dirty(1)
+        tasks.compute_threads_positions.mark_dirty(1)
+        with patch("hyperkitty.tasks.rebuild_threads_cache_new_email") as rb, \
+                patch("hyperkitty.tasks.compute_threads_positions") as ctp:
+            rb.side_effect = ValueError
+            tasks.run_dirty_batches()
+        ctp.assert_called_once_with([1])
+
+    def test_run_batch_failing_item(self):
+        # A failing item does not prevent the other ones from being
+        # processed, and is dropped.
+        for thread_id in (1, 2, 3):
+            tasks.rebuild_threads_cache_new_email.mark_dirty(thread_id)
+        processed = []
+
+        def _rebuild(thread_ids):
+            if 2 in thread_ids:
+                raise TypeError
+            processed.extend(thread_ids)
+        with patch("hyperkitty.tasks.rebuild_threads_cache_new_email",
+                   side_effect=_rebuild), \
+                patch("hyperkitty.tasks.log") as log:
+            tasks.run_dirty_batches()
+        self.assertEqual(processed, [1, 3])
+        self.assertEqual(log.exception.call_count, 1)
+        metrics = tasks.get_task_metrics()
+        self.assertEqual(
+            metrics["rebuild_threads_cache_new_email"]["dropped"], 1)
+        self.assertFalse(PendingItem.objects.exists())
+
+    def test_new_emails(self):
+        # New emails only mark the objects dirty, each one is processed once.
+        # The replies are positioned in their thread right away.
+        for num in range(3):
+            msg = EmailMessage()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msgid%d>" % num
+            if num:
+                msg["In-Reply-To"] = "<msgid0>"
+            msg["Date"] = "15 Feb 2015 00:0%d:00 UTC" % num
+            msg.set_payload("message %d" % num)
+            add_to_list("example-list", msg)
+        queued = [call[0][0].kwargs["task_name"]
+                  for call in self.run_mock.call_args_list]
+        self.assertNotIn("compute_thread_positions", queued)
+        self.assertNotIn("check_orphans", queued)
+        thread = Thread.objects.get()
+        with patch("hyperkitty.tasks.compute_thread_order_and_depth") \
+                as ctod, \
+                patch("hyperkitty.tasks._check_orphans") as co, \
+                patch("hyperkitty.tasks._rebuild_thread_cache_new_email") \
+                as rtc:
+            tasks.run_dirty_batches()
+        self.assertFalse(ctod.called)
+        self.assertEqual(
+            list(thread.emails.order_by("thread_order").values_list(
+                "message_id", flat=True)), ["msgid0", "msgid1", "msgid2"])
+        rtc.assert_called_once_with(thread)
+        self.assertEqual(co.call_count, 3)
@@ -37,6 +37,9 @@ from django.test import TestCase as DjangoTestCase, TransactionTestCase
 from django.core.cache import cache
 from mock import Mock, patch
 
+from hyperkitty.lib.incoming import clear_caches
+from hyperkitty.models.common import local_cache
+
 
 def setup_logging(tmpdir):
     formatter = logging.Formatter(fmt="%(message)s")
@@ -93,6 +96,8 @@ class TestCase(DjangoTestCase):
     def _post_teardown(self):
         self._mm_client_patcher.stop()
         cache.clear()
+        local_cache.clear()
+        clear_caches()
         for key, value in self._old_settings.items():
             if value is None:
                 delattr(settings, key)
@@ -20,18 +20,21 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+import datetime
 import json
+import os
 from email.message import EmailMessage
 from io import BytesIO
 
 import mock
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.utils import timezone
 from django_mailman3.models import MailDomain
 
 from hyperkitty.models.email import Email
 from hyperkitty.utils import reverse
-from hyperkitty.views.mailman import _get_url
+from hyperkitty.views.mailman import _get_url, _message_from_bytes
 from hyperkitty.tests.utils import TestCase
 
 
@@ -72,6 +75,19 @@ class ArchiveTestCase(TestCase):
         msg["Date"] = "Fri, 02 Nov 2012 16:07:54"
         msg.set_payload("Fake Message")
         self.message = BytesIO(msg.as_string().encode("utf-8"))
+        msg2 = EmailMessage()
+        msg2["From"] = "dummy@example.com"
+        msg2["Subject"] = "Re: Fake Subject"
+        msg2["Message-ID"] = "<dummy2>"
+        msg2["In-Reply-To"] = "<dummy>"
+        msg2["Date"] = "Fri, 02 Nov 2012 16:17:54"
+        msg2.set_payload("Fake Reply")
+        self.message2 = BytesIO(msg2.as_string().encode("utf-8"))
+        self.mbox = BytesIO(
+            b"From dummy@example.com Fri Nov  2 16:07:54 2012\n" +
+            msg.as_string().encode("utf-8") + b"\n\n" +
+            b"From dummy@example.com Fri Nov  2 16:17:54 2012\n" +
+            msg2.as_string().encode("utf-8") + b"\n\n")
         self.url = "{}?key={}".format(
             reverse('hk_mailman_archive'),
             settings.MAILMAN_ARCHIVER_KEY,
@@ -94,6 +110,67 @@ class ArchiveTestCase(TestCase):
         })
         self.assertEqual(Email.objects.filter(message_id="dummy").count(), 1)
 
+    def _check_many(self, response):
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertEqual(result, {"results": [
+            {"url": "https://example.com/list/list@example.com/message/"
+                    "QKODQBCADMDSP5YPOPKECXQWEQAMXZL3/"},
+            {"url": "https://example.com/list/list@example.com/message/"
+                    "IA6HC3VHG6X6WVHUAVE435LSP4ILU3YY/"},
+        ]})
+        self.assertEqual(Email.objects.count(), 2)
+        reply = Email.objects.get(message_id="dummy2")
+        self.assertEqual(reply.parent.message_id, "dummy")
+
+    def test_many_messages(self):
+        response = self.client.post(
+            self.url,
+            data={
+                "mlist": "list@example.com",
+                "message": [self.message, self.message2],
+            }
+        )
+        self._check_many(response)
+
+    def test_mbox(self):
+        response = self.client.post(
+            self.url,
+            data={
+                "mlist": "list@example.com",
+                "mbox": self.mbox,
+            }
+        )
+        self._check_many(response)
+        email = Email.objects.get(message_id="dummy")
+        self.assertEqual(email.archived_date, datetime.datetime(
+            2012, 11, 2, 16, 7, 54, tzinfo=timezone.utc))
+
+    def test_many_messages_error(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("No Message-ID")
+        response = self.client.post(
+            self.url,
+            data={
+                "mlist": "list@example.com",
+                "message": [
+                    self.message,
+                    BytesIO(msg.as_string().encode("utf-8"))],
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertEqual(len(result["results"]), 2)
+        self.assertIn("url", result["results"][0])
+        self.assertIn("error", result["results"][1])
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_no_message(self):
+        response = self.client.post(
+            self.url, data={"mlist": "list@example.com"})
+        self.assertEqual(response.status_code, 400)
+
     def test_data_error(self):
         with mock.patch("hyperkitty.views.mailman.add_to_list") as atl:
             atl.side_effect = ValueError("test error")
@@ -110,3 +187,117 @@ class ArchiveTestCase(TestCase):
         self.assertEqual(result, {
             "error": "test error",
         })
+
+    def _archive_first(self):
+        # The test transaction is never committed, run the callbacks now.
+        with mock.patch("hyperkitty.lib.incoming.transaction.on_commit",
+                        lambda func: func()):
+            self.client.post(self.url, data={
+                "mlist": "list@example.com", "message": self.message})
+        self.message.seek(0)
+
+    def test_known_duplicate(self):
+        # Known duplicates are not parsed.
+        self._archive_first()
+        with mock.patch("hyperkitty.views.mailman._message_from_bytes",
+                        side_effect=_message_from_bytes) as mfb:
+            response = self.client.post(self.url, data={
+                "mlist": "list@example.com", "message": self.message})
+        self.assertFalse(mfb.called)
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertEqual(result, {
+            "url": "https://example.com/list/list@example.com/message/"
+                   "QKODQBCADMDSP5YPOPKECXQWEQAMXZL3/"
+        })
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_known_duplicate_mbox(self):
+        self._archive_first()
+        with mock.patch("hyperkitty.views.mailman._message_from_bytes",
+                        side_effect=_message_from_bytes) as mfb:
+            response = self.client.post(self.url, data={
+                "mlist": "list@example.com", "mbox": self.mbox})
+        self.assertEqual(mfb.call_count, 1)
+        self._check_many(response)
+
+
+class UrlsTestCase(TestCase):
+
+    def test_many_msgids(self):
+        url = "{}?key={}&mlist=list@example.com&msgid=<dummy>&msgid=<dummy2>"
+        response = self.client.get(url.format(
+            reverse('hk_mailman_urls'), settings.MAILMAN_ARCHIVER_KEY))
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertEqual(result, {"urls": [
+            "https://example.com/list/list@example.com/message/"
+            "QKODQBCADMDSP5YPOPKECXQWEQAMXZL3/",
+            "https://example.com/list/list@example.com/message/"
+            "IA6HC3VHG6X6WVHUAVE435LSP4ILU3YY/",
+        ]})
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.spool_dir = os.path.join(self.tmpdir, "spool")
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Subject"] = "Fake Subject"
+        msg["Message-ID"] = "<dummy>"
+        msg["Date"] = "Fri, 02 Nov 2012 16:07:54"
+        msg.set_payload("Fake Message")
+        self.message = BytesIO(msg.as_string().encode("utf-8"))
+        self.url = "{}?key={}".format(
+            reverse('hk_mailman_archive'),
+            settings.MAILMAN_ARCHIVER_KEY,
+        )
+
+    def test_spool(self):
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.spool_dir):
+            response = self.client.post(
+                self.url,
+                data={
+                    "mlist": "list@example.com",
+                    "message": self.message,
+                }
+            )
+        self.assertEqual(response.status_code, 202)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertEqual(result, {
+            "url": "https://example.com/list/list@example.com/message/"
+                   "QKODQBCADMDSP5YPOPKECXQWEQAMXZL3/"
+        })
+        self.assertEqual(Email.objects.count(), 0)
+        spooled = os.listdir(os.path.join(self.spool_dir, "list@example.com"))
+        self.assertEqual(len(spooled), 1)
+
+    def test_spool_no_message_id(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("No Message-ID")
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.spool_dir):
+            response = self.client.post(
+                self.url,
+                data={
+                    "mlist": "list@example.com",
+                    "message": BytesIO(msg.as_string().encode("utf-8")),
+                }
+            )
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode(response.charset))
+        self.assertIn("error", result)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.spool_dir, "list@example.com")))
+
+    def test_spool_bad_list_name(self):
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.spool_dir):
+            response = self.client.post(
+                self.url,
+                data={
+                    "mlist": "../list@example.com",
+                    "message": self.message,
+                }
+            )
+        self.assertEqual(response.status_code, 400)
@@ -99,6 +99,7 @@ class MessageViewsTestCase(TestCase):
                           msg.message_id_hash))
             resp = self.client.post(url, {"vote": "0"})
             self.assertEqual(resp.status_code, 200)
+            msg.refresh_from_db()
             votes = msg.get_votes()
             self.assertEqual(votes["likes"], 0)
             self.assertEqual(votes["dislikes"], 0)
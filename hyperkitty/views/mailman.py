@@ -21,8 +21,9 @@
 #
 
 import json
-from email import message_from_binary_file
+from email import message_from_bytes
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from email.policy import default
 from functools import wraps
 
@@ -36,8 +37,11 @@ from django.views.decorators.http import require_POST
 from django_mailman3.models import MailDomain
 from urllib.parse import urljoin
 
-from hyperkitty.lib.incoming import add_to_list, DuplicateMessage
-from hyperkitty.lib.utils import get_message_id_hash
+from hyperkitty.lib.incoming import (
+    add_to_list, add_many_to_list, is_duplicate, DuplicateMessage)
+from hyperkitty.lib.spool import get_spool_dir, spool_message
+from hyperkitty.lib.utils import (
+    get_message_id, get_message_id_hash, split_mbox)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -70,15 +74,26 @@ def key_and_ip_auth(func):
     return _decorator
 
 
-def _get_url(mlist_fqdn, msg_id=None):
+def _get_domain(mlist_fqdn):
+    # We use the MailDomain association from django_mailman3 to find out the
+    # proper domain.
+    mail_domain = mlist_fqdn.split("@")[1]
+    try:
+        return MailDomain.objects.get(
+            mail_domain=mail_domain).site.domain
+    except MailDomain.DoesNotExist:
+        return mail_domain
+
+
+def _get_url(mlist_fqdn, msg_id=None, domain=None):
     # We can't use HttpRequest.build_absolute_uri() because the mailman API may
     # be accessed via localhost.
     # https://docs.djangoproject.com/en/dev/ref/request-response/#django.http.HttpRequest.build_absolute_uri
     # https://docs.djangoproject.com/en/dev/ref/contrib/sites/#getting-the-current-domain-for-full-urls
     # result = urljoin(public_url, urlunquote(
     #                  reverse('hk_list_overview', args=[mlist_fqdn])))
-    # We use the MailDomain association from django_mailman3 to find out the
-    # proper domain.
+    # The domain can be passed when building several URLs for the same list,
+    # to only look it up once.
     if msg_id is None:
         url = reverse('hk_list_overview', args=[mlist_fqdn])
     else:
@@ -86,19 +101,29 @@ def _get_url(mlist_fqdn, msg_id=None):
         url = reverse('hk_message_index', kwargs={
             "mlist_fqdn": mlist_fqdn, "message_id_hash": msg_hash})
     relative_url = urlunquote(url)
-    mail_domain = mlist_fqdn.split("@")[1]
-    try:
-        domain = MailDomain.objects.get(
-            mail_domain=mail_domain).site.domain
-    except MailDomain.DoesNotExist:
-        domain = mail_domain
+    if domain is None:
+        domain = _get_domain(mlist_fqdn)
     return urljoin("https://%s" % domain, relative_url)
 
 
+def _message_from_bytes(unixfrom, raw_message):
+    msg = message_from_bytes(raw_message, _class=EmailMessage, policy=default)
+    if unixfrom:
+        msg.set_unixfrom(unixfrom)
+    return msg
+
+
 @key_and_ip_auth
 def urls(request):
-    result = _get_url(request.GET["mlist"], request.GET.get("msgid"))
-    return HttpResponse(json.dumps({"url": result}),
+    mlist_fqdn = request.GET["mlist"]
+    msg_ids = request.GET.getlist("msgid")
+    if len(msg_ids) <= 1:
+        result = _get_url(mlist_fqdn, request.GET.get("msgid"))
+        return HttpResponse(json.dumps({"url": result}),
+                            content_type='application/javascript')
+    domain = _get_domain(mlist_fqdn)
+    result = [_get_url(mlist_fqdn, msg_id, domain) for msg_id in msg_ids]
+    return HttpResponse(json.dumps({"urls": result}),
                         content_type='application/javascript')
 
 
@@ -107,20 +132,115 @@ def urls(request):
 @csrf_exempt
 def archive(request):
     mlist_fqdn = request.POST["mlist"]
-    if "message" not in request.FILES:
+    if "mbox" in request.FILES:
+        raw_messages = list(split_mbox(request.FILES["mbox"]))
+    elif "message" in request.FILES:
+        raw_messages = [
+            (None, msg_file.read())
+            for msg_file in request.FILES.getlist("message")
+        ]
+    else:
         raise SuspiciousOperation
-    msg = message_from_binary_file(
-        request.FILES['message'], _class=EmailMessage, policy=default)
-    try:
-        add_to_list(mlist_fqdn, msg)
-    except DuplicateMessage as e:
-        logger.info("Duplicate email with message-id '%s'", e.args[0])
-    except ValueError as e:
-        logger.warning("Could not archive the email with message-id '%s': %s",
-                       msg.get("Message-Id", None), e)
-        return HttpResponse(json.dumps({"error": str(e)}),
-                            content_type='application/javascript')
-    url = _get_url(mlist_fqdn, msg['Message-Id'])
-    logger.info("Archived message %s to %s", msg['Message-Id'], url)
+    many = "mbox" in request.FILES or len(raw_messages) > 1
+    if get_spool_dir() is not None:
+        return _spool(mlist_fqdn, raw_messages, many)
+    if not many:
+        return _archive_one(mlist_fqdn, *raw_messages[0])
+    return _archive_many(mlist_fqdn, raw_messages)
+
+
+def _get_known_duplicate(mlist_fqdn, raw_message):
+    # Only parse the headers, the known duplicates are rejected before the
+    # rest of the message is parsed. Returns the Message-ID of a duplicate.
+    headers = BytesHeaderParser(policy=default).parsebytes(raw_message)
+    if "Message-Id" not in headers:
+        return None
+    msg_id = get_message_id(headers)
+    if is_duplicate(mlist_fqdn, msg_id):
+        return msg_id
+    return None
+
+
+def _archive_one(mlist_fqdn, unixfrom, raw_message):
+    msg_id = _get_known_duplicate(mlist_fqdn, raw_message)
+    if msg_id is not None:
+        logger.info("Duplicate email with message-id '%s'", msg_id)
+    else:
+        msg = _message_from_bytes(unixfrom, raw_message)
+        try:
+            add_to_list(mlist_fqdn, msg)
+        except DuplicateMessage as e:
+            logger.info("Duplicate email with message-id '%s'", e.args[0])
+        except ValueError as e:
+            logger.warning(
+                "Could not archive the email with message-id '%s': %s",
+                msg.get("Message-Id", None), e)
+            return HttpResponse(json.dumps({"error": str(e)}),
+                                content_type='application/javascript')
+        msg_id = msg['Message-Id']
+    url = _get_url(mlist_fqdn, msg_id)
+    logger.info("Archived message %s to %s", msg_id, url)
     return HttpResponse(json.dumps({"url": url}),
                         content_type='application/javascript')
+
+
+def _archive_many(mlist_fqdn, raw_messages):
+    # Archive several messages at once. The result is a list with, for each
+    # message, the same object as the one returned for a single message.
+    domain = _get_domain(mlist_fqdn)
+    results = [None] * len(raw_messages)
+    to_archive = []
+    for index, (unixfrom, raw_message) in enumerate(raw_messages):
+        msg_id = _get_known_duplicate(mlist_fqdn, raw_message)
+        if msg_id is None:
+            to_archive.append(
+                (index, _message_from_bytes(unixfrom, raw_message)))
+            continue
+        logger.info("Duplicate email with message-id '%s'", msg_id)
+        results[index] = {"url": _get_url(mlist_fqdn, msg_id, domain)}
+    if to_archive:
+        archived = add_many_to_list(
+            mlist_fqdn, [msg for index, msg in to_archive])
+    else:
+        archived = []
+    for (index, msg), result in zip(to_archive, archived):
+        if isinstance(result, DuplicateMessage):
+            logger.info("Duplicate email with message-id '%s'",
+                        result.args[0])
+        elif isinstance(result, ValueError):
+            logger.warning(
+                "Could not archive the email with message-id '%s': %s",
+                msg.get("Message-Id", None), result)
+            results[index] = {"error": str(result)}
+            continue
+        url = _get_url(mlist_fqdn, msg['Message-Id'], domain)
+        logger.info("Archived message %s to %s", msg['Message-Id'], url)
+        results[index] = {"url": url}
+    return HttpResponse(json.dumps({"results": results}),
+                        content_type='application/javascript')
+
+
+def _spool(mlist_fqdn, raw_messages, many):
+    # Only check that the messages can be archived and store them in the
+    # spool, they will be archived by the hyperkitty_process_spool command.
+    if "/" in mlist_fqdn or mlist_fqdn.startswith("."):
+        raise SuspiciousOperation
+    domain = _get_domain(mlist_fqdn)
+    results = []
+    for unixfrom, raw_message in raw_messages:
+        headers = BytesHeaderParser(policy=default).parsebytes(raw_message)
+        if "Message-Id" not in headers:
+            logger.warning("Could not spool an email without a Message-Id")
+            results.append({"error": "No 'Message-Id' header in email"})
+            continue
+        spool_message(mlist_fqdn, raw_message, unixfrom)
+        url = _get_url(mlist_fqdn, headers['Message-Id'], domain)
+        logger.info("Spooled message %s for %s", headers['Message-Id'], url)
+        results.append({"url": url})
+    if many:
+        result = {"results": results}
+    else:
+        result = results[0]
+    status = 202 if any("url" in r for r in results) else 200
+    return HttpResponse(json.dumps(result), status=status,
+                        content_type='application/javascript')
@@ -36,7 +36,9 @@ from django.views.decorators.cache import cache_page
 from django_mailman3.lib.mailman import get_mailman_user_id
 from django_mailman3.lib.paginator import paginate
 
-from hyperkitty.models import Favorite, MailingList
+from hyperkitty.models import Email, Favorite, MailingList
+from hyperkitty.models.common import prefetch_cached_values
+from hyperkitty.models.mailinglist import LazyThreads
 from hyperkitty.lib.view_helpers import (
     get_category_widget, get_months, get_display_dates, daterange,
     check_mlist_private)
@@ -162,16 +164,24 @@ def overview(request, mlist_fqdn=None):
     return render(request, "hyperkitty/overview.html", context)
 
 
+def _overview_threads(request, mlist, threads, empty):
+    threads = list(threads)
+    prefetch_cached_values(threads, ["subject"])
+    return render(request, "hyperkitty/fragments/overview_threads.html", {
+        'mlist': mlist,
+        'threads': threads,
+        'empty': empty,
+        })
+
+
 @check_mlist_private
 # @cache_page(3600 * 12)  # cache for 12 hours
 def overview_recent_threads(request, mlist_fqdn):
     """Return the most recently updated threads."""
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
-    return render(request, "hyperkitty/fragments/overview_threads.html", {
-        'mlist': mlist,
-        'threads': mlist.recent_threads[:20],
-        'empty': _('No discussions this month (yet).'),
-        })
+    return _overview_threads(
+        request, mlist, mlist.recent_threads[:20],
+        _('No discussions this month (yet).'))
 
 
 @check_mlist_private
@@ -179,11 +189,9 @@ def overview_recent_threads(request, mlist_fqdn):
 def overview_pop_threads(request, mlist_fqdn):
     """Return the threads with the most votes."""
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
-    return render(request, "hyperkitty/fragments/overview_threads.html", {
-        'mlist': mlist,
-        'threads': mlist.popular_threads,
-        "empty": _('No vote has been cast this month (yet).'),
-        })
+    return _overview_threads(
+        request, mlist, mlist.popular_threads,
+        _('No vote has been cast this month (yet).'))
 
 
 @check_mlist_private
@@ -191,11 +199,9 @@ def overview_pop_threads(request, mlist_fqdn):
 def overview_top_threads(request, mlist_fqdn):
     """Return the threads with the most answers."""
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
-    return render(request, "hyperkitty/fragments/overview_threads.html", {
-        'mlist': mlist,
-        'threads': mlist.top_threads,
-        "empty": _('No discussions this month (yet).'),
-        })
+    return _overview_threads(
+        request, mlist, mlist.top_threads,
+        _('No discussions this month (yet).'))
 
 
 @check_mlist_private
@@ -208,11 +214,9 @@ def overview_favorites(request, mlist_fqdn):
             thread__mailinglist=mlist, user=request.user)]
     else:
         favorites = []
-    return render(request, "hyperkitty/fragments/overview_threads.html", {
-        'mlist': mlist,
-        'threads': favorites,
-        "empty": _('You have not flagged any discussions (yet).'),
-        })
+    return _overview_threads(
+        request, mlist, favorites,
+        _('You have not flagged any discussions (yet).'))
 
 
 @check_mlist_private
@@ -224,18 +228,18 @@ def overview_posted_to(request, mlist_fqdn):
         mm_user_id = get_mailman_user_id(request.user)
         threads_posted_to = []
         if mm_user_id is not None:
-            for thread in mlist.recent_threads:
-                senders = set(
-                    [e.sender.mailman_id for e in thread.emails.all()])
-                if mm_user_id in senders:
-                    threads_posted_to.append(thread)
+            recent_thread_ids = mlist.recent_threads.thread_ids
+            posted_to_ids = set(Email.objects.filter(
+                thread_id__in=recent_thread_ids,
+                sender__mailman_id=mm_user_id,
+                ).values_list("thread_id", flat=True))
+            threads_posted_to = LazyThreads([
+                pk for pk in recent_thread_ids if pk in posted_to_ids])
     else:
         threads_posted_to = []
-    return render(request, "hyperkitty/fragments/overview_threads.html", {
-        'mlist': mlist,
-        'threads': threads_posted_to,
-        "empty": _('You have not posted to this list (yet).'),
-        })
+    return _overview_threads(
+        request, mlist, threads_posted_to,
+        _('You have not posted to this list (yet).'))
 
 
 @check_mlist_private
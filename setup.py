@@ -45,7 +45,6 @@ REQUIRES = [
     "django-compressor>=1.3",
     "mailmanclient>=3.1.1",
     "python-dateutil >= 2.0",
-    "networkx>=1.9.1",
     # django-haystack>=2.5.0 suffices for Django-1.11
     "django-haystack>=2.8.0",
     "django-extensions>=1.3.7",